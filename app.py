@@ -1,12 +1,12 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, g, abort, has_request_context
 import os
 import json
 from datetime import datetime, timedelta
 import requests
+import requests.adapters
 import io
 import xlsxwriter
 from werkzeug.middleware.proxy_fix import ProxyFix
-from functools import lru_cache
 import threading
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -17,11 +17,32 @@ import time
 import copy
 import multiprocessing
 import random
+import queue
+import collections
+import collections.abc
 import logging
 # Импортируем модули geopy
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+from geopy.exc import GeopyError
 import socket
+import sys
+import ipaddress
+import sqlite3
+import struct
+import gzip
+import lzma
+import zlib
+import array
+import bisect
+import math
+import concurrent.futures
+import csv
+import re
+try:
+    import fcntl
+except ImportError:
+    # На Windows flock недоступен, блокировка работает только внутри процесса
+    fcntl = None
 
 # Настройка логирования для Render
 logging.basicConfig(
@@ -55,31 +76,127 @@ if IS_RENDER and os.environ.get('ALLOW_ALL_LOCATIONS') is None:
 # Путь к файлу данных
 DATA_FILE = os.environ.get('DATA_FILE', os.path.join(os.path.dirname(__file__), 'participants.json'))
 
+# Формат файла участников: 'json' (читаемый массив с отступами) или 'packed'
+# (записи с префиксом длины, сгруппированные в сегменты и сжатые DATA_COMPRESSION:
+# 'none', 'gzip' или 'lzma'). Формат существующего файла определяется при чтении
+# автоматически, поэтому после смены DATA_FORMAT файл переводится в новый формат при
+# следующей записи (или сразу скриптом convert_participants.py)
+DATA_FORMAT = os.environ.get('DATA_FORMAT', 'json').lower()
+DATA_COMPRESSION = os.environ.get('DATA_COMPRESSION', 'gzip').lower()
+
+# Способ хранения участников:
+#   'json'    - весь список перезаписывается в DATA_FILE при каждом изменении
+#   'journal' - DATA_FILE только импортируется, изменения дописываются в JOURNAL_FILE
+#   'sqlite'  - база SQLite (SQLITE_FILE), при первом запуске импортирует DATA_FILE
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json').lower()
+
+# Путь к журналу регистраций (одна JSON-строка на операцию)
+JOURNAL_FILE = os.environ.get('JOURNAL_FILE', os.path.splitext(DATA_FILE)[0] + '.jsonl')
+
+# Снимок участников для режима 'journal' и условия фонового уплотнения журнала:
+# проверка раз в SNAPSHOT_INTERVAL секунд или сразу, когда журнал после снимка
+# вырос до SNAPSHOT_MIN_LOG_BYTES байт
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', os.path.splitext(DATA_FILE)[0] + '.snapshot.json')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 300))
+SNAPSHOT_MIN_LOG_BYTES = int(os.environ.get('SNAPSHOT_MIN_LOG_BYTES', 1024 * 1024))
+
+# Путь к базе SQLite
+SQLITE_FILE = os.environ.get('SQLITE_FILE', os.path.splitext(DATA_FILE)[0] + '.db')
+
+# Групповая запись регистраций: параллельные регистрации собираются в очередь и
+# сохраняются одной записью на диск не реже, чем раз в GROUP_COMMIT_MAX_LATENCY_MS
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'false').lower() == 'true'
+GROUP_COMMIT_MAX_LATENCY_MS = float(os.environ.get('GROUP_COMMIT_MAX_LATENCY_MS', 5))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 100))
+
+# Ключи идемпотентности регистрации: повтор запроса с тем же ключом в течение
+# IDEMPOTENCY_TTL секунд возвращает исходный номер участника; в памяти процесса
+# хранится не больше IDEMPOTENCY_MAX_KEYS ключей
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 600))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000))
+
+# Холодное хранение (только для STORAGE_BACKEND=json): участники, зарегистрированные больше
+# COLD_AFTER_DAYS дней назад (0 - не переносить), переносятся фоновым уплотнением в сжатые
+# неизменяемые сегменты по COLD_SEGMENT_RECORDS записей; в памяти остаётся только их индекс
+COLD_AFTER_DAYS = float(os.environ.get('COLD_AFTER_DAYS', 0))
+COLD_SEGMENT_RECORDS = int(os.environ.get('COLD_SEGMENT_RECORDS', 1000))
+COLD_COMPRESSION = os.environ.get('COLD_COMPRESSION', 'lzma').lower()
+
+# Проверка целостности участников: число процессов (0 - по числу ядер процессора)
+VERIFY_WORKERS = int(os.environ.get('VERIFY_WORKERS', 0))
+
+# Отложенная проверка местоположения: /register сохраняет участника со статусом 'pending'
+# и отвечает сразу, а город проверяется в DEFERRED_VERIFICATION_WORKERS фоновых потоках.
+# Результаты записываются пачками до DEFERRED_VERIFICATION_MAX_BATCH участников, собранными
+# не дольше DEFERRED_VERIFICATION_MAX_LATENCY_MS. Участник, оставшийся в 'pending' дольше
+# DEFERRED_VERIFICATION_RETRY секунд, проверяется повторно
+DEFERRED_VERIFICATION = os.environ.get('DEFERRED_VERIFICATION', 'false').lower() == 'true'
+DEFERRED_VERIFICATION_WORKERS = int(os.environ.get('DEFERRED_VERIFICATION_WORKERS', 4))
+DEFERRED_VERIFICATION_MAX_BATCH = int(os.environ.get('DEFERRED_VERIFICATION_MAX_BATCH', 100))
+DEFERRED_VERIFICATION_MAX_LATENCY_MS = float(os.environ.get('DEFERRED_VERIFICATION_MAX_LATENCY_MS', 1000))
+DEFERRED_VERIFICATION_RETRY = int(os.environ.get('DEFERRED_VERIFICATION_RETRY', 60))
+# Статусы проверки местоположения; у участников без статуса город проверен при регистрации
+VERIFICATION_LABELS = {'pending': 'Проверяется', 'confirmed': 'Подтверждён', 'rejected': 'Отклонён'}
+
+# Кэш геолокации по IP и по координатам: файл SQLite, общий для всех процессов gunicorn
+# и сохраняющийся между перезапусками. Запись живёт GEO_CACHE_TTL секунд; при превышении
+# GEO_CACHE_MAX_ENTRIES вытесняются записи, которые дольше всех не использовались
+GEO_CACHE_FILE = os.environ.get('GEO_CACHE_FILE', os.path.join(os.path.dirname(DATA_FILE), 'geo_cache.db'))
+GEO_CACHE_TTL = int(os.environ.get('GEO_CACHE_TTL', 3600))
+GEO_CACHE_MAX_ENTRIES = int(os.environ.get('GEO_CACHE_MAX_ENTRIES', 100000))
+# Сколько секунд помнить неудачу (город не определён), чтобы не повторять сразу всю цепочку сервисов
+GEO_NEGATIVE_TTL = int(os.environ.get('GEO_NEGATIVE_TTL', 60))
+# Координаты в кэше группируются по ячейкам сетки размером GEO_GRID_METERS метров (0 - без сетки):
+# когда GEO_GRID_SAMPLES точных ответов для разных точек ячейки совпали, ячейка отвечает за все
+# свои точки. Ячейка на границе города (ответы разошлись) и дальше проверяется по точным координатам
+GEO_GRID_METERS = float(os.environ.get('GEO_GRID_METERS', 100))
+GEO_GRID_SAMPLES = int(os.environ.get('GEO_GRID_SAMPLES', 2))
+
+# Сервисы геолокации опрашиваются с подстраховкой: следующий запускается, если предыдущие
+# не ответили за GEO_HEDGE_DELAY_MS миллисекунд, и побеждает первый верный ответ.
+# GEO_LOOKUP_BUDGET - сколько секунд запрос ждёт ответа всех сервисов вместе
+GEO_HEDGE_DELAY_MS = float(os.environ.get('GEO_HEDGE_DELAY_MS', 500))
+GEO_LOOKUP_BUDGET = float(os.environ.get('GEO_LOOKUP_BUDGET', 4))
+GEO_PROVIDER_THREADS = int(os.environ.get('GEO_PROVIDER_THREADS', 16))
+# Автомат отключения: после GEO_BREAKER_FAILURES ошибок подряд сервис не опрашивается
+# GEO_BREAKER_COOL_OFF секунд. GEO_RETRY_RATIO - доля запросов, которую можно повторить после сбоя.
+# Если лимит частоты запросов к сервису исчерпан дольше чем на GEO_RATE_LIMIT_MAX_WAIT секунд, сервис пропускается
+GEO_BREAKER_FAILURES = int(os.environ.get('GEO_BREAKER_FAILURES', 5))
+GEO_BREAKER_COOL_OFF = float(os.environ.get('GEO_BREAKER_COOL_OFF', 30))
+GEO_RETRY_RATIO = float(os.environ.get('GEO_RETRY_RATIO', 0.1))
+GEO_RATE_LIMIT_MAX_WAIT = float(os.environ.get('GEO_RATE_LIMIT_MAX_WAIT', 1))
+
+# Локальная база IP-диапазонов (CSV или двоичный файл build_ip_ranges.py); проверяется
+# раньше кэша и сетевых сервисов геолокации. Если файла нет, база не используется
+IP_RANGES_FILE = os.environ.get('IP_RANGES_FILE', os.path.join(os.path.dirname(__file__), 'ip_ranges.bin'))
+
+# Полигоны городов и районов (GeoJSON): координаты проверяются локально, раньше кэша
+# и сетевых сервисов. Если файла нет, город определяется через Nominatim
+CITY_POLYGONS_FILE = os.environ.get('CITY_POLYGONS_FILE', os.path.join(os.path.dirname(__file__), 'city_polygons.geojson'))
+# Размер ячейки сетки индекса полигонов в градусах (0.01 - около 1 км)
+CITY_POLYGONS_CELL = float(os.environ.get('CITY_POLYGONS_CELL', 0.01))
+# Обращаться к сетевым сервисам, если точка не попала ни в один полигон
+CITY_POLYGONS_FALLBACK = os.environ.get('CITY_POLYGONS_FALLBACK', 'true').lower() == 'true'
+
 # Путь к файлу с настройками
 SETTINGS_FILE = os.environ.get('SETTINGS_FILE', os.path.join(os.path.dirname(__file__), 'settings.json'))
 
-# Добавляем блокировку для безопасной работы с файлом данных при конкурентном доступе
-data_lock = threading.Lock()
-settings_lock = threading.Lock()
+# Дополнительные розыгрыши: идентификаторы через запятую (латиница, цифры, '-' и '_').
+# Розыгрыш доступен по адресам с префиксом /r/<id>/ и хранит участников, счётчик номеров
+# и настройки в отдельном каталоге RAFFLES_DIR/<id>; адреса без префикса - основной розыгрыш
+RAFFLE_IDS = [raffle_id.strip() for raffle_id in os.environ.get('RAFFLE_IDS', '').split(',') if raffle_id.strip()]
+RAFFLES_DIR = os.environ.get('RAFFLES_DIR', os.path.join(os.path.dirname(DATA_FILE), 'raffles'))
 
 # Создаем файл участников, если он не существует
 if not os.path.exists(DATA_FILE):
     with open(DATA_FILE, 'w', encoding='utf-8') as f:
         json.dump([], f)
 
-# Создаем файл настроек, если он не существует
-if not os.path.exists(SETTINGS_FILE):
-    with settings_lock:
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump({
-                "whatsapp_link": "https://chat.whatsapp.com/EIa4wkifsVQDttzjOKlOY3"
-            }, f, ensure_ascii=False, indent=4)
-
-# Кэш для настроек с временем жизни
-settings_cache = {
-    'data': None,
-    'timestamp': 0
+# Настройки нового розыгрыша (и при ошибке чтения файла настроек)
+DEFAULT_SETTINGS = {
+    "whatsapp_link": "https://chat.whatsapp.com/EIa4wkifsVQDttzjOKlOY3"
 }
+
 SETTINGS_CACHE_TTL = 60  # 60 секунд
 
 # Настройки для резервного копирования
@@ -96,41 +213,12 @@ BACKUP_SETTINGS = {
 scheduler_event = threading.Event()
 
 def load_settings():
-    """Загрузка настроек из файла с кэшированием"""
-    global settings_cache
-    current_time = datetime.now().timestamp()
-    
-    # Если есть актуальные данные в кэше, возвращаем их
-    if settings_cache['data'] is not None and current_time - settings_cache['timestamp'] < SETTINGS_CACHE_TTL:
-        return settings_cache['data']
-    
-    # Иначе загружаем из файла
-    with settings_lock:
-        try:
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
-                # Обновляем кэш
-                settings_cache['data'] = settings
-                settings_cache['timestamp'] = current_time
-                return settings
-        except:
-            # В случае ошибки возвращаем настройки по умолчанию
-            default_settings = {
-                "whatsapp_link": "https://chat.whatsapp.com/EIa4wkifsVQDttzjOKlOY3"
-            }
-            settings_cache['data'] = default_settings
-            settings_cache['timestamp'] = current_time
-            return default_settings
+    """Загрузка настроек текущего розыгрыша с кэшированием"""
+    return current_raffle().load_settings()
 
 def save_settings(settings_data):
-    """Сохранение настроек в файл"""
-    with settings_lock:
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(settings_data, f, ensure_ascii=False, indent=4)
-        
-        # Обновляем кэш
-        settings_cache['data'] = settings_data
-        settings_cache['timestamp'] = datetime.now().timestamp()
+    """Сохранение настроек текущего розыгрыша в файл"""
+    current_raffle().save_settings(settings_data)
 
 # Список допустимых городов и районов
 ALLOWED_CITIES = [
@@ -163,13 +251,15 @@ ALLOWED_CITIES = [
     'турали'
 ]
 
+DEFAULT_ALLOWED_CITIES = frozenset(ALLOWED_CITIES)
+
 # Для тестирования на хостинге - разрешаем все города, если установлена переменная окружения
 if os.environ.get('ALLOW_ALL_LOCATIONS') == 'true':
-    def check_location_allowed(city):
+    def check_location_allowed(city, raffle=None):
         return True
 else:
-    def check_location_allowed(city):
-        return city in ALLOWED_CITIES
+    def check_location_allowed(city, raffle=None):
+        return city in (raffle or current_raffle()).allowed_cities()
 
 # Функция для безопасного получения реального IP-адреса клиента
 def get_client_ip():
@@ -195,23 +285,977 @@ def get_client_ip():
     logger.info(f"IP из remote_addr: {ip}")
     return ip
 
-# Кэш для данных о местоположении по IP
-ip_location_cache = {}
+class GeoCache:
+    """Кэш результатов геолокации с временем жизни и вытеснением давно не использованных записей.
+    
+    Хранится в SQLite (режим WAL), поэтому общий для всех процессов gunicorn и не теряется
+    при перезапуске. Ошибка базы не мешает геолокации: запрос считается промахом кэша.
+    """
+    
+    KINDS = ('ip', 'coordinates')
+    # Время использования записи обновляется не чаще раза в TOUCH_INTERVAL секунд, чтобы
+    # попадания в кэш почти никогда не требовали записи в базу
+    TOUCH_INTERVAL = 60
+    # Размер кэша проверяется раз в EVICT_EVERY добавлений
+    EVICT_EVERY = 100
+    # Счётчики попаданий сбрасываются в базу не чаще раза в STATS_FLUSH_INTERVAL секунд
+    STATS_FLUSH_INTERVAL = 10
+    
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS geo_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires REAL NOT NULL,
+            used REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_geo_cache_used ON geo_cache(used)',
+        'CREATE INDEX IF NOT EXISTS idx_geo_cache_expires ON geo_cache(expires)',
+        '''CREATE TABLE IF NOT EXISTS geo_cache_stats (
+            kind TEXT PRIMARY KEY,
+            hits INTEGER NOT NULL,
+            misses INTEGER NOT NULL
+        )''',
+    ]
+    
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = max(1, min(self.EVICT_EVERY, max_entries // 10))
+        # Соединение открывается отдельно для каждого потока (и заново после fork)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Попадания и промахи этого процесса, ещё не сброшенные в базу
+        self.pending = {kind: [0, 0] for kind in self.KINDS}
+        self.last_flush = time.monotonic()
+        self.puts = 0
+    
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+    
+    def get(self, kind, key, count=True):
+        """Сохранённый результат или None (count=False - не учитывать в статистике попаданий)"""
+        now = time.time()
+        cache_key = f"{kind}:{key}"
+        value = None
+        try:
+            conn = self._connect()
+            row = conn.execute('SELECT value, expires, used FROM geo_cache WHERE key = ?', (cache_key,)).fetchone()
+            if row is not None and row[1] > now:
+                value = json.loads(row[0])
+                if now - row[2] > self.TOUCH_INTERVAL:
+                    conn.execute('UPDATE geo_cache SET used = ? WHERE key = ?', (now, cache_key))
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning(f"Ошибка чтения кэша геолокации: {e}")
+        if count:
+            self.count(kind, value is not None)
+        return value
+    
+    def put(self, kind, key, value, ttl=None):
+        """Сохранение результата на ttl секунд (по умолчанию - на время жизни кэша)"""
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO geo_cache (key, value, expires, used) VALUES (?, ?, ?, ?)',
+                         (f"{kind}:{key}", json.dumps(value, ensure_ascii=False),
+                          now + (self.ttl if ttl is None else ttl), now))
+            with self.lock:
+                self.puts += 1
+                evict = self.puts % self.evict_every == 0
+            if evict:
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка записи в кэш геолокации: {e}")
+    
+    def add_sample(self, kind, key, location, ttl=None):
+        """Атомарный учёт ответа для ячейки одним UPSERT: совпавший город увеличивает счётчик
+        samples, другой город помечает ячейку как граничную, истёкшая запись начинается заново"""
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO geo_cache (key, value, expires, used) "
+                "VALUES (:key, json_object('location', json(:location), 'samples', 1), :expires, :now) "
+                "ON CONFLICT(key) DO UPDATE SET value = CASE "
+                "WHEN geo_cache.expires <= :now THEN excluded.value "
+                "WHEN json_extract(geo_cache.value, '$.location') IS NULL THEN geo_cache.value "
+                "WHEN json_extract(geo_cache.value, '$.location.city') IS :city "
+                "THEN json_set(geo_cache.value, '$.samples', json_extract(geo_cache.value, '$.samples') + 1) "
+                "ELSE json_object('border', json('true')) END, "
+                "expires = CASE WHEN geo_cache.expires > :now AND json_extract(geo_cache.value, '$.location') IS NULL "
+                "THEN geo_cache.expires ELSE excluded.expires END, used = excluded.used",
+                {'key': f"{kind}:{key}", 'location': json.dumps(location, ensure_ascii=False),
+                 'city': location.get('city'), 'expires': now + (self.ttl if ttl is None else ttl), 'now': now})
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка записи в кэш геолокации: {e}")
+    
+    def _evict(self, conn, now):
+        # Удаляем истёкшие записи, затем давно не использованные - с запасом в 10% от предела,
+        # чтобы не вытеснять по нескольку записей при каждой проверке
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM geo_cache WHERE expires <= ?', (now,))
+            excess = conn.execute('SELECT COUNT(*) FROM geo_cache').fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute('DELETE FROM geo_cache WHERE key IN (SELECT key FROM geo_cache ORDER BY used LIMIT ?)',
+                             (excess + self.max_entries // 10,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def _take_pending_locked(self):
+        pending = self.pending
+        self.pending = {kind: [0, 0] for kind in self.KINDS}
+        self.last_flush = time.monotonic()
+        return pending
+    
+    def count(self, kind, hit):
+        """Учёт попадания или промаха в статистике"""
+        with self.lock:
+            self.pending[kind][0 if hit else 1] += 1
+            if time.monotonic() - self.last_flush < self.STATS_FLUSH_INTERVAL:
+                return
+            pending = self._take_pending_locked()
+        self._flush(pending)
+    
+    def _flush(self, pending):
+        try:
+            conn = self._connect()
+            for kind, (hits, misses) in pending.items():
+                if hits or misses:
+                    conn.execute(
+                        'INSERT INTO geo_cache_stats (kind, hits, misses) VALUES (?, ?, ?) '
+                        'ON CONFLICT(kind) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses',
+                        (kind, hits, misses))
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка записи статистики кэша геолокации: {e}")
+    
+    def stats(self):
+        """Размер кэша и доля попаданий по всем процессам"""
+        with self.lock:
+            pending = self._take_pending_locked()
+        self._flush(pending)
+        conn = self._connect()
+        counters = {kind: (0, 0) for kind in self.KINDS}
+        for kind, hits, misses in conn.execute('SELECT kind, hits, misses FROM geo_cache_stats'):
+            counters[kind] = (hits, misses)
+        
+        def rate(hits, misses):
+            return round(hits / (hits + misses), 4) if hits + misses else None
+        
+        total_hits = sum(hits for hits, misses in counters.values())
+        total_misses = sum(misses for hits, misses in counters.values())
+        return {
+            'entries': conn.execute('SELECT COUNT(*) FROM geo_cache').fetchone()[0],
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': total_hits,
+            'misses': total_misses,
+            'hit_rate': rate(total_hits, total_misses),
+            'kinds': {
+                kind: {'hits': hits, 'misses': misses, 'hit_rate': rate(hits, misses)}
+                for kind, (hits, misses) in counters.items()
+            }
+        }
+
+
+geo_cache = GeoCache(GEO_CACHE_FILE, GEO_CACHE_TTL, GEO_CACHE_MAX_ENTRIES)
+
+IP_RANGES_MAGIC = b'PRTI'
+IP_RANGES_VERSION = 1
+# Заголовок: магия, версия, длина таблицы мест (JSON), число диапазонов IPv4 и IPv6
+_IP_RANGES_HEADER = struct.Struct('>4sBIII')
+# Диапазон IPv4: начало, конец, номер места
+_IPV4_RANGE = struct.Struct('>III')
+# Диапазон IPv6: начало и конец (по две половины по 64 бита), номер места
+_IPV6_RANGE = struct.Struct('>QQQQI')
+_IPV4_ADDRESS = struct.Struct('>I')
+_LOCATION_KEYS = ('city', 'region', 'country')
+
+def _parse_ip_range_row(row):
+    """Строка CSV (начало,конец,город,регион,страна или сеть/префикс,,город,...) ->
+    (версия IP, начало, конец, место)"""
+    if len(row) < 3:
+        raise ValueError("нужны как минимум начало диапазона, конец и город")
+    first = row[0].strip()
+    if '/' in first:
+        network = ipaddress.ip_network(first, strict=False)
+        start, end = network.network_address, network.broadcast_address
+    else:
+        start = ipaddress.ip_address(first)
+        end = ipaddress.ip_address(row[1].strip() or first)
+    if start.version != end.version or int(end) < int(start):
+        raise ValueError(f"неверный диапазон {start} - {end}")
+    location = tuple(row[i].strip() if i < len(row) else '' for i in (2, 3, 4))
+    return start.version, int(start), int(end), (location[0].lower(),) + location[1:]
+
+class IpRangeTable:
+    """Таблица IP-диапазонов с местоположением.
+    
+    Диапазоны не пересекаются и отсортированы по началу, поэтому поиск - один bisect
+    по массиву начал отдельно для IPv4 и IPv6.
+    """
+    
+    def __init__(self, locations, ranges):
+        self.locations = locations
+        # Версия IP -> (начала, концы, номера мест)
+        self.ranges = ranges
+    
+    @classmethod
+    def build(cls, rows):
+        """Таблица из кортежей (версия IP, начало, конец, место); пересечения - ошибка"""
+        location_numbers = {}
+        by_version = {4: [], 6: []}
+        for version, start, end, location in rows:
+            number = location_numbers.setdefault(location, len(location_numbers))
+            by_version[version].append((start, end, number))
+        ranges = {}
+        for version, items in by_version.items():
+            items.sort()
+            for previous, current in zip(items, items[1:]):
+                if current[0] <= previous[1]:
+                    raise ValueError(f"Диапазоны пересекаются: {ipaddress.ip_address(previous[0])} - "
+                                     f"{ipaddress.ip_address(previous[1])} и {ipaddress.ip_address(current[0])}")
+            starts = [start for start, end, number in items]
+            ends = [end for start, end, number in items]
+            if version == 4:
+                # Адреса IPv4 помещаются в массив чисел, он занимает в разы меньше памяти
+                starts, ends = array.array('Q', starts), array.array('Q', ends)
+            ranges[version] = (starts, ends, array.array('I', (number for start, end, number in items)))
+        return cls(list(location_numbers), ranges)
+    
+    @classmethod
+    def from_csv(cls, f):
+        """Таблица из CSV; строки, начинающиеся с '#', и заголовок пропускаются"""
+        rows = []
+        for line_number, row in enumerate(csv.reader(f), 1):
+            if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+                continue
+            try:
+                rows.append(_parse_ip_range_row(row))
+            except ValueError as e:
+                if line_number == 1:
+                    continue  # заголовок
+                raise ValueError(f"Строка {line_number}: {e}")
+        return cls.build(rows)
+    
+    @classmethod
+    def read(cls, path):
+        """Чтение таблицы из двоичного файла (build_ip_ranges.py) или из CSV"""
+        with open(path, 'rb') as f:
+            header = f.read(_IP_RANGES_HEADER.size)
+            if not header.startswith(IP_RANGES_MAGIC):
+                f.seek(0)
+                return cls.from_csv(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+            magic, version, locations_size, v4_count, v6_count = _IP_RANGES_HEADER.unpack(header)
+            if version != IP_RANGES_VERSION:
+                raise ValueError(f"Неподдерживаемая версия файла IP-диапазонов: {version}")
+            locations = [tuple(location) for location in json.loads(f.read(locations_size).decode('utf-8'))]
+            v4 = list(_IPV4_RANGE.iter_unpack(f.read(v4_count * _IPV4_RANGE.size)))
+            v6 = list(_IPV6_RANGE.iter_unpack(f.read(v6_count * _IPV6_RANGE.size)))
+        if len(v4) != v4_count or len(v6) != v6_count:
+            raise ValueError("Файл IP-диапазонов обрезан")
+        ranges = {
+            4: (array.array('Q', (item[0] for item in v4)), array.array('Q', (item[1] for item in v4)),
+                array.array('I', (item[2] for item in v4))),
+            6: ([item[0] << 64 | item[1] for item in v6], [item[2] << 64 | item[3] for item in v6],
+                array.array('I', (item[4] for item in v6))),
+        }
+        return cls(locations, ranges)
+    
+    def write(self, path):
+        """Запись таблицы в двоичный файл (через временный файл)"""
+        def write(f):
+            locations = json.dumps(self.locations, ensure_ascii=False).encode('utf-8')
+            v4_starts, v4_ends, v4_numbers = self.ranges[4]
+            v6_starts, v6_ends, v6_numbers = self.ranges[6]
+            f.write(_IP_RANGES_HEADER.pack(IP_RANGES_MAGIC, IP_RANGES_VERSION, len(locations),
+                                           len(v4_starts), len(v6_starts)))
+            f.write(locations)
+            for item in zip(v4_starts, v4_ends, v4_numbers):
+                f.write(_IPV4_RANGE.pack(*item))
+            for start, end, number in zip(v6_starts, v6_ends, v6_numbers):
+                f.write(_IPV6_RANGE.pack(start >> 64, start & 0xFFFFFFFFFFFFFFFF,
+                                         end >> 64, end & 0xFFFFFFFFFFFFFFFF, number))
+        _write_file_atomically(path, write, binary=True)
+    
+    def __len__(self):
+        return sum(len(starts) for starts, ends, numbers in self.ranges.values())
+    
+    def lookup(self, ip_address):
+        """Местоположение для IP-адреса или None, если адрес не входит ни в один диапазон"""
+        try:
+            # Адрес IPv4 быстрее разобрать через inet_pton, чем через ipaddress
+            version, value = 4, _IPV4_ADDRESS.unpack(socket.inet_pton(socket.AF_INET, ip_address))[0]
+        except (OSError, TypeError):
+            try:
+                address = ipaddress.ip_address(ip_address)
+            except ValueError:
+                return None
+            if address.version == 6 and address.ipv4_mapped is not None:
+                address = address.ipv4_mapped
+            version, value = address.version, int(address)
+        starts, ends, numbers = self.ranges[version]
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return dict(zip(_LOCATION_KEYS, self.locations[numbers[i]]))
+
+class LocalGeoFile:
+    """Локальный файл геоданных (IP-диапазоны, полигоны городов); перечитывается после замены.
+    
+    read(path) строит из файла таблицу с методом lookup. Если файла нет, lookup возвращает None.
+    """
+    
+    # Как часто проверять, не заменён ли файл
+    CHECK_INTERVAL = 30
+    
+    def __init__(self, path, read, description):
+        self.path = path
+        self.read = read
+        self.description = description
+        self.table = None
+        self.identity = None
+        self.checked = None
+        self.lock = threading.Lock()
+    
+    def _reload(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.checked is not None and now - self.checked < self.CHECK_INTERVAL:
+                return
+            self.checked = now
+            identity = _file_identity(self.path) if self.path else None
+            if identity == self.identity:
+                return
+            self.identity = identity
+            if identity is None:
+                self.table = None
+                return
+            try:
+                self.table = self.read(self.path)
+                logger.info(f"Загружен файл {self.path} ({self.description}): {len(self.table)} записей")
+            except (OSError, ValueError) as e:
+                # Остаётся прежняя таблица, если она была
+                logger.error(f"Ошибка загрузки файла {self.path} ({self.description}): {e}")
+    
+    def get(self):
+        """Текущая таблица или None, если файла нет"""
+        if self.checked is None or time.monotonic() - self.checked >= self.CHECK_INTERVAL:
+            self._reload()
+        return self.table
+    
+    def lookup(self, *args):
+        table = self.get()
+        return table.lookup(*args) if table is not None else None
+
+def _point_in_rings(x, y, rings):
+    """Проверка точки по правилу чётности: внутри, если луч вправо пересекает границу нечётное число раз"""
+    inside = False
+    for ring in rings:
+        xj, yj = ring[-1]
+        for xi, yi in ring:
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            xj, yj = xi, yi
+    return inside
+
+def _segments_cross(px, py, qx, qy, a, b):
+    """Пересекает ли отрезок (p, q) ребро (a, b)"""
+    (ax, ay), (bx, by) = a, b
+    d1 = (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+    d2 = (bx - ax) * (qy - ay) - (by - ay) * (qx - ax)
+    if (d1 > 0) == (d2 > 0):
+        return False
+    d3 = (qx - px) * (ay - py) - (qy - py) * (ax - px)
+    d4 = (qx - px) * (by - py) - (qy - py) * (bx - px)
+    return (d3 > 0) != (d4 > 0)
+
+def _ring_area(ring):
+    return abs(sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]))) / 2
+
+class CityPolygonIndex:
+    """Полигоны городов и районов с индексом-сеткой для определения города по координатам.
+    
+    Рёбра полигонов раскладываются по ячейкам сетки. Если через ячейку не проходит граница
+    полигона, ответ один для всех её точек. Иначе точка сравнивается с центром ячейки: отрезок
+    от центра до точки пересекает только рёбра этой ячейки, и каждое пересечение меняет
+    ответ на противоположный. Положение центра ячейки вычисляется один раз при первом запросе.
+    Если точка попала в несколько полигонов (район внутри города), выбирается меньший.
+    """
+    
+    def __init__(self, regions, cell_size):
+        # Район: (местоположение, кольца [(долгота, широта), ...], рамка (x1, y1, x2, y2)); меньшие первыми
+        self.regions = regions
+        self.cell_size = cell_size
+        # Названия городов и районов, для которых есть полигоны
+        self.cities = frozenset(region[0]['city'] for region in regions)
+        self.bbox = (
+            min(region[2][0] for region in regions), min(region[2][1] for region in regions),
+            max(region[2][2] for region in regions), max(region[2][3] for region in regions)
+        ) if regions else None
+        # Ячейка -> {номер района: рёбра, рамки которых задевают ячейку}
+        self.edges = {}
+        for number, (location, rings, bbox) in enumerate(regions):
+            for ring in rings:
+                for a, b in zip(ring, ring[1:] + ring[:1]):
+                    x1, x2 = sorted((a[0], b[0]))
+                    y1, y2 = sorted((a[1], b[1]))
+                    for cell in self._cells(x1, y1, x2, y2):
+                        self.edges.setdefault(cell, {}).setdefault(number, []).append((a, b))
+        # Ячейка -> [(номер района, центр внутри, рёбра или None)], заполняется при запросах
+        self.cells = {}
+    
+    @classmethod
+    def read(cls, path, cell_size=None):
+        """Полигоны из GeoJSON (Polygon или MultiPolygon; название в свойстве name)"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        features = data.get('features', []) if data.get('type') == 'FeatureCollection' else [data]
+        regions = []
+        for number, feature in enumerate(features, 1):
+            properties = feature.get('properties') or {}
+            geometry = feature.get('geometry') or {}
+            name = (properties.get('name') or '').strip()
+            if not name:
+                raise ValueError(f"Объект {number}: не задано свойство name")
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                raise ValueError(f"Объект {number} ({name}): неподдерживаемая геометрия {geometry.get('type')}")
+            rings = []
+            area = 0
+            for polygon in polygons:
+                for ring_number, ring in enumerate(polygon):
+                    points = [(float(point[0]), float(point[1])) for point in ring]
+                    if len(points) > 1 and points[0] == points[-1]:
+                        points.pop()
+                    if len(points) < 3:
+                        raise ValueError(f"Объект {number} ({name}): в кольце меньше трёх точек")
+                    rings.append(points)
+                    # Первое кольцо многоугольника - внешняя граница, остальные - вырезы
+                    area += -_ring_area(points) if ring_number else _ring_area(points)
+            bbox = (min(x for ring in rings for x, y in ring), min(y for ring in rings for x, y in ring),
+                    max(x for ring in rings for x, y in ring), max(y for ring in rings for x, y in ring))
+            location = {
+                'city': name.lower(),
+                'region': properties.get('region', ''),
+                'country': properties.get('country', '')
+            }
+            regions.append((area, number, (location, rings, bbox)))
+        regions.sort(key=lambda item: item[:2])
+        return cls([region for area, number, region in regions], cell_size or CITY_POLYGONS_CELL)
+    
+    def __len__(self):
+        return len(self.regions)
+    
+    def _cells(self, x1, y1, x2, y2):
+        size = self.cell_size
+        for cx in range(math.floor(x1 / size), math.floor(x2 / size) + 1):
+            for cy in range(math.floor(y1 / size), math.floor(y2 / size) + 1):
+                yield cx, cy
+    
+    def _cell_entries(self, cell):
+        entries = self.cells.get(cell)
+        if entries is not None:
+            return entries
+        size = self.cell_size
+        x1, y1 = cell[0] * size, cell[1] * size
+        x2, y2 = x1 + size, y1 + size
+        center_x, center_y = x1 + size / 2, y1 + size / 2
+        cell_edges = self.edges.get(cell, {})
+        entries = []
+        for number, (location, rings, bbox) in enumerate(self.regions):
+            if bbox[0] > x2 or bbox[2] < x1 or bbox[1] > y2 or bbox[3] < y1:
+                continue
+            edges = cell_edges.get(number)
+            center_inside = _point_in_rings(center_x, center_y, rings)
+            if edges or center_inside:
+                entries.append((number, center_inside, edges))
+        # Запись в словарь атомарна; при гонке ячейка просто вычислится дважды
+        self.cells[cell] = entries
+        return entries
+    
+    def lookup(self, lat, lng):
+        """Местоположение по координатам или None, если точка вне всех полигонов"""
+        try:
+            x, y = float(lng), float(lat)
+        except (TypeError, ValueError):
+            return None
+        if self.bbox is None or not (self.bbox[0] <= x <= self.bbox[2] and self.bbox[1] <= y <= self.bbox[3]):
+            return None
+        size = self.cell_size
+        cell = (math.floor(x / size), math.floor(y / size))
+        center_x, center_y = (cell[0] + 0.5) * size, (cell[1] + 0.5) * size
+        for number, center_inside, edges in self._cell_entries(cell):
+            inside = center_inside
+            if edges:
+                for a, b in edges:
+                    if _segments_cross(center_x, center_y, x, y, a, b):
+                        inside = not inside
+            if inside:
+                return dict(self.regions[number][0])
+        return None
+
+
+ip_ranges = LocalGeoFile(IP_RANGES_FILE, IpRangeTable.read, 'IP-диапазоны')
+city_polygons = LocalGeoFile(CITY_POLYGONS_FILE, CityPolygonIndex.read, 'полигоны городов')
+
+class SingleFlight:
+    """Объединение одновременных запросов с одним ключом: первый выполняет запрос,
+    остальные ждут и получают его результат (в пределах процесса)"""
+    
+    def __init__(self, wait_timeout):
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+    
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+        if not leader:
+            if call['done'].wait(self.wait_timeout):
+                if call['error'] is not None:
+                    raise call['error']
+                # Копия, чтобы ожидавшие запросы не делили один словарь
+                return dict(call['result'])
+            # Первый запрос завис дольше бюджета - выполняем сами
+            return function()
+        try:
+            call['result'] = function()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
 
-# Время жизни кэша местоположения (1 час)
-IP_CACHE_TTL = 3600
+# Одновременные определения местоположения для одного IP или одной ячейки сетки координат
+geo_flights = SingleFlight(GEO_LOOKUP_BUDGET + 5)
+
+def _cache_location(kind, key, result):
+    """Сохранение результата в кэш; неудача (город не определён) хранится GEO_NEGATIVE_TTL секунд,
+    чтобы повторные проверки не проходили всю цепочку сервисов заново, но и не запоминали сбой надолго"""
+    if result.get('city') == 'неизвестный город':
+        # GEO_NEGATIVE_TTL=0 отключает запоминание неудач
+        if GEO_NEGATIVE_TTL > 0:
+            geo_cache.put(kind, key, result, ttl=GEO_NEGATIVE_TTL)
+        return False
+    geo_cache.put(kind, key, result)
+    return True
 
-@lru_cache(maxsize=128)
 def get_location_from_ip(ip_address):
-    """Получение информации о местоположении по IP-адресу с использованием нескольких методов"""
-    # Проверяем кэш
-    current_time = datetime.now().timestamp()
-    if ip_address in ip_location_cache:
-        cache_entry = ip_location_cache[ip_address]
-        if current_time - cache_entry['timestamp'] < IP_CACHE_TTL:
-            logger.info(f"Использован кэш для IP {ip_address}")
-            return cache_entry['data']
+    """Получение информации о местоположении по IP-адресу (через локальную базу
+    IP-диапазонов и общий кэш геолокации)"""
+    location = ip_ranges.lookup(ip_address)
+    if location is not None:
+        return location
+    cached = geo_cache.get('ip', ip_address)
+    if cached is not None:
+        logger.info(f"Использован кэш для IP {ip_address}")
+        return cached
+    
+    def resolve():
+        result = _lookup_location_from_ip(ip_address)
+        _cache_location('ip', ip_address, result)
+        return result
+    
+    # Одновременные запросы с одного IP (например, за NAT оператора) ждут один запрос к сервисам
+    return geo_flights.do(('ip', ip_address), resolve)
+
+class GeoProviderUnavailable(Exception):
+    """Сервис геолокации пропущен без запроса: отключён после ошибок или исчерпан лимит запросов"""
+
+
+class TokenBucket:
+    """Ограничение частоты запросов: rate запросов в секунду, не больше burst подряд"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, max_wait):
+        """Получение разрешения на запрос; ждёт не дольше max_wait секунд, иначе возвращает False"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait > max_wait:
+                return False
+            # Токен занимается сразу (счёт может уйти в минус), поэтому ждущие запросы идут по очереди
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+class CircuitBreaker:
+    """Автомат отключения сервиса: после failure_threshold ошибок подряд сервис пропускается
+    cool_off секунд, затем пропускается один пробный запрос. Удачный пробный запрос
+    включает сервис, неудачный - отключает ещё на cool_off секунд."""
+    
+    def __init__(self, name, failure_threshold, cool_off):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cool_off = cool_off
+        self.failures = 0
+        self.open_until = None
+        self.trial = False
+        self.lock = threading.Lock()
+    
+    @property
+    def state(self):
+        if self.open_until is None:
+            return 'closed'
+        return 'open' if time.monotonic() < self.open_until or self.trial else 'half-open'
+    
+    def allow(self):
+        with self.lock:
+            if self.open_until is None:
+                return True
+            if time.monotonic() < self.open_until or self.trial:
+                return False
+            self.trial = True
+            return True
+    
+    def release(self):
+        """Разрешённый запрос так и не был отправлен"""
+        with self.lock:
+            self.trial = False
+    
+    def record_success(self):
+        with self.lock:
+            if self.open_until is not None:
+                logger.info(f"Сервис геолокации {self.name} снова доступен")
+            self.failures = 0
+            self.open_until = None
+            self.trial = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.open_until is None and self.failures >= self.failure_threshold):
+                logger.warning(f"Сервис геолокации {self.name} отключён на {self.cool_off} сек. "
+                               f"после {self.failures} ошибок подряд")
+                self.open_until = time.monotonic() + self.cool_off
+            self.trial = False
+
+
+class RetryBudget:
+    """Бюджет повторов: каждый запрос добавляет ratio повтора (не больше limit в запасе),
+    каждый повтор тратит один. Когда сервис сбоит массово, повторы быстро кончаются
+    и не умножают нагрузку на него."""
+    
+    def __init__(self, ratio, limit=10):
+        self.ratio = ratio
+        self.limit = limit
+        self.balance = float(limit)
+        self.lock = threading.Lock()
+    
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.limit, self.balance + self.ratio)
+    
+    def withdraw(self):
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class GeoProviderClient:
+    """Клиент сервиса геолокации: пул соединений (requests.Session), ограничение частоты,
+    автомат отключения и бюджет повторов. Один клиент на сервис, общий для всех потоков"""
+    
+    # Ответы с этими кодами считаются сбоем сервиса
+    FAILURE_STATUSES = frozenset([429, 500, 502, 503, 504])
+    
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=GEO_PROVIDER_THREADS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limiter = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(name, GEO_BREAKER_FAILURES, GEO_BREAKER_COOL_OFF)
+        self.retry_budget = RetryBudget(GEO_RETRY_RATIO)
+        self.rate_limited = 0
+        self.retries = 0
+    
+    def get(self, url, **kwargs):
+        """GET-запрос через пул соединений клиента"""
+        def request():
+            response = self.session.get(url, **kwargs)
+            if response.status_code in self.FAILURE_STATUSES:
+                raise requests.HTTPError(f"{self.name} вернул код {response.status_code}", response=response)
+            return response
+        return self.call(request)
+    
+    def call(self, request):
+        """Выполнение запроса к сервису; при сбое - не больше одного повтора из бюджета"""
+        self.retry_budget.deposit()
+        retried = False
+        while True:
+            if not self.breaker.allow():
+                raise GeoProviderUnavailable(f"{self.name} отключён после ошибок")
+            if not self.limiter.acquire(GEO_RATE_LIMIT_MAX_WAIT):
+                self.breaker.release()
+                self.rate_limited += 1
+                raise GeoProviderUnavailable(f"{self.name}: превышен лимит запросов")
+            try:
+                result = request()
+            except (requests.RequestException, GeopyError) as e:
+                self.breaker.record_failure()
+                if not retried and self.breaker.state == 'closed' and self.retry_budget.withdraw():
+                    retried = True
+                    self.retries += 1
+                    logger.info(f"Повтор запроса к {self.name} после ошибки: {e}")
+                    continue
+                raise
+            except BaseException:
+                # Ошибка не говорит о состоянии сервиса (например, ValueError из geopy на неверных
+                # аргументах), но пробный запрос должен быть освобождён, иначе сервис не включится никогда
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return result
+    
+    def stats(self):
+        return {
+            'state': self.breaker.state,
+            'failures': self.breaker.failures,
+            'rate_limited': self.rate_limited,
+            'retries': self.retries
+        }
+
+
+# Клиенты сервисов геолокации с ограничением частоты (запросов в секунду, подряд).
+# Прямые запросы к OSM API и geopy идут в один Nominatim и делят его лимит 1 запрос в секунду
+geo_clients = {
+    'ip-api.com': GeoProviderClient('ip-api.com', rate=0.75, burst=10),  # бесплатно 45 запросов в минуту
+    'ipinfo.io': GeoProviderClient('ipinfo.io', rate=5, burst=10),
+    'nominatim': GeoProviderClient('nominatim', rate=1, burst=1),
+}
+
+_nominatim_geocoder = None
+
+def _nominatim():
+    """Общий геокодер geopy: его адаптер держит открытые соединения между запросами"""
+    global _nominatim_geocoder
+    if _nominatim_geocoder is None:
+        _nominatim_geocoder = Nominatim(user_agent="car_raffle_app_v2")
+    return _nominatim_geocoder
+
+
+class GeoProviderStats:
+    """Счётчики и задержки запросов к сервисам геолокации (в этом процессе)"""
+    
+    # Сколько последних задержек каждого сервиса хранить для медианы и 95-го перцентиля
+    WINDOW = 200
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.providers = {}
+    
+    def _entry_locked(self, name):
+        entry = self.providers.get(name)
+        if entry is None:
+            entry = self.providers[name] = {
+                'calls': 0, 'answers': 0, 'empty': 0, 'errors': 0, 'skipped': 0, 'wins': 0,
+                'latencies': collections.deque(maxlen=self.WINDOW)
+            }
+        return entry
+    
+    def record(self, name, outcome, elapsed):
+        """Учёт завершённого запроса: outcome - 'answers', 'empty', 'errors' или 'skipped'"""
+        with self.lock:
+            entry = self._entry_locked(name)
+            entry['calls'] += 1
+            entry[outcome] += 1
+            entry['latencies'].append(elapsed)
+    
+    def record_win(self, name):
+        """Ответ сервиса оказался первым верным и был использован"""
+        with self.lock:
+            self._entry_locked(name)['wins'] += 1
+    
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for name, entry in self.providers.items():
+                latencies = sorted(entry['latencies'])
+                stats = {key: value for key, value in entry.items() if key != 'latencies'}
+                if latencies:
+                    stats['avg_ms'] = round(sum(latencies) / len(latencies) * 1000, 1)
+                    stats['p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 1)
+                    stats['p95_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+                result[name] = stats
+            return result
+
+
+geo_provider_stats = GeoProviderStats()
+
+# Потоки для запросов к сервисам геолокации (общие для всех запросов процесса)
+geo_provider_pool = concurrent.futures.ThreadPoolExecutor(max_workers=GEO_PROVIDER_THREADS,
+                                                          thread_name_prefix='geo-provider')
+
+def _call_provider(name, provider, args):
+    started = time.monotonic()
+    try:
+        result = provider(*args)
+    except GeoProviderUnavailable as e:
+        geo_provider_stats.record(name, 'skipped', time.monotonic() - started)
+        logger.info(f"Пропускаем {name}: {e}")
+        raise
+    except Exception as e:
+        geo_provider_stats.record(name, 'errors', time.monotonic() - started)
+        logger.error(f"Ошибка при использовании {name}: {e}")
+        raise
+    geo_provider_stats.record(name, 'answers' if result else 'empty', time.monotonic() - started)
+    return result
+
+def _hedged_lookup(providers, args, description):
+    """Опрос сервисов геолокации с подстраховкой.
     
+    Сервисы запускаются по очереди: следующий - если предыдущие не ответили за
+    GEO_HEDGE_DELAY_MS или ответили ошибкой. Побеждает первый верный ответ, остальные
+    запросы отменяются (уже отправленные дорабатывают в фоне, их ответ не ждём).
+    Возвращает ответ или None, если за GEO_LOOKUP_BUDGET секунд верного ответа нет.
+    """
+    started = time.monotonic()
+    deadline = started + GEO_LOOKUP_BUDGET
+    remaining = list(providers)
+    pending = {}
+    next_launch = started
+    try:
+        while True:
+            now = time.monotonic()
+            if remaining and (now >= next_launch or not pending):
+                name, provider = remaining.pop(0)
+                logger.info(f"Пробуем определить местоположение через {name}")
+                pending[geo_provider_pool.submit(_call_provider, name, provider, args)] = name
+                next_launch = now + GEO_HEDGE_DELAY_MS / 1000
+            if not pending:
+                return None
+            if now >= deadline:
+                logger.warning(f"Сервисы геолокации не ответили за {GEO_LOOKUP_BUDGET} сек. ({description})")
+                return None
+            timeout = deadline - now
+            if remaining:
+                timeout = min(timeout, max(next_launch - now, 0))
+            done, _ = concurrent.futures.wait(pending, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if result:
+                    geo_provider_stats.record_win(name)
+                    logger.info(f"Местоположение ({description}) определено через {name} "
+                                f"за {time.monotonic() - started:.2f} сек.")
+                    return result
+                # Сервис не помог - следующий запускаем сразу, не дожидаясь задержки
+                next_launch = time.monotonic()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def _ip_api_location(ip_address):
+    """Местоположение по IP через ip-api.com"""
+    response = geo_clients['ip-api.com'].get(f"http://ip-api.com/json/{ip_address}", timeout=5)
+    if response.status_code != 200:
+        logger.warning(f"ip-api.com вернул код {response.status_code}")
+        return None
+    data = response.json()
+    if data.get('status') != 'success':
+        logger.warning(f"ip-api.com вернул ошибку: {data}")
+        return None
+    logger.info(f"Успешно получили данные от ip-api.com: {data}")
+    return {
+        'city': data.get('city', '').lower(),
+        'region': data.get('regionName', ''),
+        'country': data.get('country', '')
+    }
+
+def _ipinfo_location(ip_address):
+    """Местоположение по IP через ipinfo.io"""
+    response = geo_clients['ipinfo.io'].get(f"https://ipinfo.io/{ip_address}/json", timeout=5)
+    if response.status_code != 200:
+        logger.warning(f"ipinfo.io вернул код {response.status_code}")
+        return None
+    data = response.json()
+    logger.info(f"Получили данные от ipinfo.io: {data}")
+    if 'city' not in data:
+        return None
+    return {
+        'city': data.get('city', '').lower(),
+        'region': data.get('region', ''),
+        'country': data.get('country', '')
+    }
+
+def _geopy_ip_location(ip_address):
+    """Местоположение по IP через geopy (Nominatim)"""
+    geolocator = _nominatim()
+    location = geo_clients['nominatim'].call(lambda: geolocator.geocode(ip_address, timeout=5))
+    if not location:
+        logger.warning(f"Geopy не смог найти местоположение для IP {ip_address}")
+        return None
+    logger.info(f"Geopy нашел местоположение: {location.address}")
+    address = geo_clients['nominatim'].call(
+        lambda: geolocator.reverse(f"{location.latitude}, {location.longitude}", timeout=5))
+    if not address or not address.raw.get('address'):
+        return None
+    address_data = address.raw['address']
+    city = address_data.get('city', '').lower()
+    if not city:
+        city = address_data.get('town', '').lower()
+    if not city:
+        city = address_data.get('village', '').lower()
+    result = {
+        'city': city,
+        'region': address_data.get('state', ''),
+        'country': address_data.get('country', '')
+    }
+    logger.info(f"Определены данные через geopy: {result}")
+    return result
+
+# Сервисы геолокации по IP в порядке предпочтения
+IP_LOCATION_PROVIDERS = [
+    ('ip-api.com', _ip_api_location),
+    ('ipinfo.io', _ipinfo_location),
+    ('geopy', _geopy_ip_location),
+]
+
+def _lookup_location_from_ip(ip_address):
+    """Определение местоположения по IP-адресу с использованием нескольких методов"""
     try:
         # Для тестового режима и локальной разработки
         if ip_address == '127.0.0.1' or ip_address == 'localhost':
@@ -224,55 +1268,9 @@ def get_location_from_ip(ip_address):
         
         logger.info(f"Определение местоположения для IP: {ip_address}")
         
-        # Пытаемся использовать ip-api.com (надежный сервис)
-        try:
-            logger.info(f"Пробуем определить местоположение через ip-api.com")
-            response = requests.get(f"http://ip-api.com/json/{ip_address}", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('status') == 'success':
-                    logger.info(f"Успешно получили данные от ip-api.com: {data}")
-                    result = {
-                        'city': data.get('city', '').lower(),
-                        'region': data.get('regionName', ''),
-                        'country': data.get('country', '')
-                    }
-                    # Сохраняем в кэш
-                    ip_location_cache[ip_address] = {
-                        'data': result,
-                        'timestamp': current_time
-                    }
-                    return result
-                else:
-                    logger.warning(f"ip-api.com вернул ошибку: {data}")
-            else:
-                logger.warning(f"ip-api.com вернул код {response.status_code}")
-        except Exception as e:
-            logger.error(f"Ошибка при использовании ip-api.com: {e}")
-        
-        # Пробуем альтернативный сервис ipinfo.io
-        try:
-            logger.info(f"Пробуем определить местоположение через ipinfo.io")
-            response = requests.get(f"https://ipinfo.io/{ip_address}/json", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                logger.info(f"Получили данные от ipinfo.io: {data}")
-                if 'city' in data:
-                    result = {
-                        'city': data.get('city', '').lower(),
-                        'region': data.get('region', ''),
-                        'country': data.get('country', '')
-                    }
-                    # Сохраняем в кэш
-                    ip_location_cache[ip_address] = {
-                        'data': result,
-                        'timestamp': current_time
-                    }
-                    return result
-            else:
-                logger.warning(f"ipinfo.io вернул код {response.status_code}")
-        except Exception as e:
-            logger.error(f"Ошибка при использовании ipinfo.io: {e}")
+        result = _hedged_lookup(IP_LOCATION_PROVIDERS, (ip_address,), f"IP {ip_address}")
+        if result is not None:
+            return result
         
         # Как запасной вариант для IP-адресов Дагестана, определяем по диапазону
         # Для примера (это надо заменить на реальные диапазоны Дагестана)
@@ -289,43 +1287,6 @@ def get_location_from_ip(ip_address):
                     'country': 'Россия'
                 }
         
-        # Пытаемся использовать geopy как последний вариант
-        logger.info(f"Пробуем определить местоположение через geopy")
-        try:
-            geolocator = Nominatim(user_agent="car_raffle_app_v2")
-            location = geolocator.geocode(ip_address, timeout=5)
-            
-            if location:
-                logger.info(f"Geopy нашел местоположение: {location.address}")
-                address = geolocator.reverse(f"{location.latitude}, {location.longitude}", timeout=5)
-                
-                if address and address.raw.get('address'):
-                    address_data = address.raw['address']
-                    city = address_data.get('city', '').lower()
-                    if not city:
-                        city = address_data.get('town', '').lower()
-                    if not city:
-                        city = address_data.get('village', '').lower()
-                    
-                    result = {
-                        'city': city,
-                        'region': address_data.get('state', ''),
-                        'country': address_data.get('country', '')
-                    }
-                    
-                    logger.info(f"Определены данные через geopy: {result}")
-                    
-                    # Сохраняем в кэш
-                    ip_location_cache[ip_address] = {
-                        'data': result,
-                        'timestamp': current_time
-                    }
-                    return result
-            else:
-                logger.warning(f"Geopy не смог найти местоположение для IP {ip_address}")
-        except (GeocoderTimedOut, GeocoderServiceError) as e:
-            logger.error(f"Ошибка при определении местоположения через geopy: {e}")
-        
         # Временный вариант: возвращаем данные по умолчанию
         logger.warning(f"Не удалось определить город, возвращаем неизвестный город")
         return {
@@ -334,223 +1295,3186 @@ def get_location_from_ip(ip_address):
             'country': 'Россия'
         }
         
-    except Exception as e:
-        logger.error(f"Критическая ошибка при определении местоположения: {e}")
-        # Безопасное возвращение значения по умолчанию в случае ошибки
-        return {
-            'city': 'неизвестный город',
-            'region': 'неизвестный регион',
-            'country': 'Россия'
+    except Exception as e:
+        logger.error(f"Критическая ошибка при определении местоположения: {e}")
+        # Безопасное возвращение значения по умолчанию в случае ошибки
+        return {
+            'city': 'неизвестный город',
+            'region': 'неизвестный регион',
+            'country': 'Россия'
+        }
+
+def _polygons_cover(index, raffle):
+    """Покрывают ли полигоны все разрешённые города розыгрыша. Файл полигонов готовится
+    для ALLOWED_CITIES; у розыгрыша со своим списком в полигонах должен быть каждый город"""
+    allowed = (raffle or current_raffle()).allowed_cities()
+    return allowed == DEFAULT_ALLOWED_CITIES or allowed <= index.cities
+
+def get_location_from_coordinates(lat, lng, raffle=None):
+    """Получение информации о местоположении по координатам (через локальные полигоны
+    городов и общий кэш геолокации)"""
+    try:
+        lat_value, lng_value = float(lat), float(lng)
+    except (TypeError, ValueError):
+        lat_value = lng_value = math.nan
+    if not (-90 <= lat_value <= 90 and -180 <= lng_value <= 180):
+        # Неразбираемые или невозможные координаты (в том числе nan и inf) в сервисы не отправляются
+        logger.warning(f"Некорректные координаты: lat={lat}, lng={lng}")
+        return {
+            'city': 'неизвестный город',
+            'region': 'неизвестный регион',
+            'country': 'Россия'
+        }
+    location = city_polygons.lookup(lat_value, lng_value)
+    if location is not None:
+        return location
+    index = city_polygons.get() if not CITY_POLYGONS_FALLBACK else None
+    if index is not None and _polygons_cover(index, raffle):
+        # Полигоны покрывают все разрешённые территории: точка вне них не требует проверки в сети
+        return {
+            'city': 'неизвестный город',
+            'region': 'неизвестный регион',
+            'country': 'Россия'
+        }
+    key = f"{lat_value:.6f},{lng_value:.6f}"
+    cell_key = cell = None
+    if GEO_GRID_METERS > 0:
+        cell_key = _coordinate_cell_key(lat_value, lng_value)
+        cell = geo_cache.get('coordinates', cell_key, count=False)
+        if cell is not None and cell.get('samples', 0) >= GEO_GRID_SAMPLES:
+            geo_cache.count('coordinates', True)
+            logger.info(f"Использован кэш ячейки {cell_key} для координат {key}")
+            return cell['location']
+    cached = geo_cache.get('coordinates', key)
+    if cached is not None:
+        logger.info(f"Использован кэш для координат {key}")
+        return cached
+    
+    def resolve():
+        result = _lookup_location_from_coordinates(lat_value, lng_value)
+        if _cache_location('coordinates', key, result) and cell_key is not None:
+            _record_cell_sample(cell_key, cell, result)
+        return result
+    
+    # Одновременные проверки точек одной ячейки ждут один запрос к сервисам, только если у ячейки
+    # уже есть ответ; пока ячейка не проверена или лежит на границе города, объединяются лишь
+    # запросы с одинаковыми координатами
+    flight_key = cell_key if cell is not None and 'location' in cell else key
+    return geo_flights.do(('coordinates', flight_key), resolve)
+
+def _coordinate_cell_key(lat, lng):
+    """Ключ ячейки сетки GEO_GRID_METERS x GEO_GRID_METERS метров, в которую попадает точка"""
+    lat_step = GEO_GRID_METERS / 111320
+    row = math.floor(lat / lat_step)
+    # Шаг по долготе берётся по широте середины ряда, чтобы ячейки были примерно квадратными
+    lng_step = lat_step / max(math.cos(math.radians((row + 0.5) * lat_step)), 0.01)
+    return f"cell:{GEO_GRID_METERS:g}:{row}:{math.floor(lng / lng_step)}"
+
+def _record_cell_sample(cell_key, cell, location):
+    """Учёт точного ответа для точки ячейки: совпавшие ответы подтверждают ячейку, разные -
+    означают, что через ячейку проходит граница, и она больше не отвечает за свои точки"""
+    # Решение принимается внутри SQLite: чтение cell здесь нужно только для журнала, иначе
+    # параллельные воркеры теряли бы инкременты друг друга
+    if cell is not None and 'location' in cell and cell['location'].get('city') != location.get('city'):
+        logger.info(f"Ячейка {cell_key} на границе: {cell['location'].get('city')} и {location.get('city')}")
+    geo_cache.add_sample('coordinates', cell_key, location)
+
+def _osm_reverse_location(lat, lng):
+    """Местоположение по координатам прямым запросом к OpenStreetMap Nominatim API"""
+    response = geo_clients['nominatim'].get(
+        f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lng}&zoom=18&addressdetails=1",
+        headers={'User-Agent': 'CarRaffle/1.0'},
+        timeout=5
+    )
+    if response.status_code != 200:
+        logger.warning(f"OSM API вернул код {response.status_code}")
+        return None
+    data = response.json()
+    logger.info(f"Данные от OSM API: {data}")
+    if 'address' not in data:
+        return None
+    city = data['address'].get('city', '').lower()
+    if not city:
+        city = data['address'].get('town', '').lower()
+    if not city:
+        city = data['address'].get('village', '').lower()
+    if not city and 'state' in data['address'] and 'дагестан' in data['address']['state'].lower():
+        city = 'махачкала'
+        
+    logger.info(f"Определен город через OSM API: {city}")
+    
+    return {
+        'city': city,
+        'region': data['address'].get('state', ''),
+        'country': data['address'].get('country', '')
+    }
+
+def _geopy_reverse_location(lat, lng):
+    """Местоположение по координатам через geopy (Nominatim)"""
+    geolocator = _nominatim()
+    
+    # Получаем информацию о местоположении по координатам
+    location = geo_clients['nominatim'].call(lambda: geolocator.reverse(f"{lat}, {lng}", timeout=5))
+    
+    if not location or not location.raw.get('address'):
+        logger.warning(f"Geopy не вернул данных для координат {lat}, {lng}")
+        return None
+    
+    address_data = location.raw['address']
+    logger.info(f"Данные от geopy: {address_data}")
+    
+    city = address_data.get('city', '').lower()
+    if not city:
+        city = address_data.get('town', '').lower()
+    if not city:
+        city = address_data.get('village', '').lower()
+    if not city and 'locality' in address_data:
+        city = address_data.get('locality', '').lower()
+    if not city and 'suburb' in address_data:
+        city = address_data.get('suburb', '').lower()
+    
+    # Проверка на районы Махачкалы
+    if not city and 'state' in address_data and 'state_district' in address_data:
+        state = address_data.get('state', '').lower()
+        district = address_data.get('state_district', '').lower()
+        if 'дагестан' in state and ('махачкала' in district or 'махачкалинский' in district):
+            city = 'махачкала'
+            
+    # Запасной вариант для Дагестана
+    if not city and 'state' in address_data and 'дагестан' in address_data.get('state', '').lower():
+        # Проверяем попадание в координаты Махачкалы (грубое приближение)
+        if 42.9 <= float(lat) <= 43.1 and 47.3 <= float(lng) <= 47.6:
+            city = 'махачкала'
+    
+    logger.info(f"Определен город через geopy: {city}")
+            
+    return {
+        'city': city,
+        'region': address_data.get('state', ''),
+        'country': address_data.get('country', '')
+    }
+
+# Сервисы геолокации по координатам в порядке предпочтения
+COORDINATE_LOCATION_PROVIDERS = [
+    ('OSM API', _osm_reverse_location),
+    ('geopy', _geopy_reverse_location),
+]
+
+def _lookup_location_from_coordinates(lat, lng):
+    """Определение местоположения по координатам с использованием нескольких методов"""
+    try:
+        logger.info(f"Определение местоположения по координатам: {lat}, {lng}")
+        
+        result = _hedged_lookup(COORDINATE_LOCATION_PROVIDERS, (lat, lng), f"координаты {lat}, {lng}")
+        if result is not None:
+            return result
+        
+        # Проверка попадания в область Махачкалы (грубый вариант)
+        if 42.9 <= float(lat) <= 43.1 and 47.3 <= float(lng) <= 47.6:
+            logger.info(f"Координаты {lat}, {lng} попадают в регион Махачкалы")
+            return {
+                'city': 'махачкала',
+                'region': 'Дагестан',
+                'country': 'Россия'
+            }
+            
+        # В случае неудачи, возвращаем данные по умолчанию
+        logger.warning(f"Не удалось определить город по координатам, возвращаем данные по умолчанию")
+        return {
+            'city': 'неизвестный город',
+            'region': 'неизвестный регион',
+            'country': 'Россия'
+        }
+    except Exception as e:
+        logger.error(f"Критическая ошибка при определении местоположения по координатам: {e}")
+        # Безопасное возвращение значения по умолчанию в случае ошибки
+        return {
+            'city': 'неизвестный город',
+            'region': 'неизвестный регион',
+            'country': 'Россия'
+        }
+
+def normalize_phone(phone):
+    """Нормализация телефона для сравнения (удаляем все, кроме цифр)"""
+    return ''.join(filter(str.isdigit, phone or ''))
+
+def canonical_phone_key(phone):
+    """Канонический ключ телефона для поиска и проверки повторной регистрации.
+    
+    Оставляем только цифры, заменяем ведущую 8 на 7 у 11-значных номеров и берём
+    последние 10 цифр, чтобы +7 988..., 8 988... и 988... давали один и тот же ключ.
+    """
+    normalized_phone = normalize_phone(phone)
+    if len(normalized_phone) == 11 and normalized_phone.startswith('8'):
+        normalized_phone = '7' + normalized_phone[1:]
+    return normalized_phone[-10:] if len(normalized_phone) >= 10 else normalized_phone
+
+def participant_phone_key(participant):
+    """Ключ телефона участника (вычисляется при записи и хранится в самой записи)"""
+    phone_key = participant.get('phone_key')
+    if phone_key is None:
+        phone_key = canonical_phone_key(participant.get('phone'))
+    return phone_key
+
+def _file_identity(path):
+    """Идентичность файла (inode, размер, время изменения) для проверки актуальности кэша"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def _fsync_directory(path):
+    """Сброс на диск записи каталога после переименования файла (не поддерживается на Windows)"""
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _write_file_atomically(path, write, binary=False):
+    """Запись файла через временный файл и os.replace.
+    
+    Читатели и восстановление после сбоя видят либо старую, либо новую версию файла целиком.
+    """
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with (open(tmp_path, 'wb') if binary else open(tmp_path, 'w', encoding='utf-8')) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_directory(os.path.dirname(path))
+
+# Временный файл старше этого (в секундах) считается брошенным, даже если PID занят другим процессом
+STALE_TEMP_FILE_AGE = 3600
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _remove_stale_temp_files(path):
+    """Удаление временных файлов path.tmp.<pid>[.<поток>], оставшихся после завершения процесса
+    посреди записи (например, потока уплотнения). Файлы живых процессов не трогаются"""
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + '.tmp.'
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        tmp_path = os.path.join(directory, name)
+        pid = name[len(prefix):].split('.')[0]
+        try:
+            stale = (not pid.isdigit() or not _process_alive(int(pid))
+                     or now - os.path.getmtime(tmp_path) > STALE_TEMP_FILE_AGE)
+            if stale:
+                os.remove(tmp_path)
+                logger.warning(f"Удалён незавершённый временный файл {tmp_path}")
+        except FileNotFoundError:
+            pass
+
+def _iter_json_array(path, chunk_size=64 * 1024):
+    """Потоковое чтение JSON-массива: элементы разбираются и отдаются по одному.
+    
+    Файл читается кусками, поэтому в памяти нет ни всего текста, ни второго полного списка.
+    Отсутствующий файл считается пустым массивом.
+    """
+    decoder = json.JSONDecoder()
+    try:
+        f = open(path, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return
+    with f:
+        buffer = ''
+        pos = 0
+        eof = False
+        started = False
+        need_separator = False
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"Неожиданный конец JSON-массива в {path}")
+                chunk = f.read(chunk_size)
+                buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                continue
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"Ожидался JSON-массив в {path}")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            if need_separator:
+                if buffer[pos] != ',':
+                    raise ValueError(f"Ожидалась запятая между элементами JSON-массива в {path}")
+                need_separator = False
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            # Элемент, упирающийся в конец буфера, мог быть обрезан: дочитываем и разбираем заново
+            if end is None or (end == len(buffer) and not eof):
+                chunk = f.read(chunk_size)
+                buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                continue
+            yield item
+            pos = end
+            need_separator = True
+
+# Формат 'packed': заголовок PACKED_MAGIC + версия + код сжатия, затем сегменты
+# [длина сегмента][сжатые данные]; внутри сегмента записи [длина][компактный JSON]
+PACKED_MAGIC = b'PRTP'
+PACKED_VERSION = 1
+PACKED_SEGMENT_RECORDS = 256
+PACKED_COMPRESSIONS = {'none': 0, 'gzip': 1, 'lzma': 2}
+_PACKED_HEADER = struct.Struct('>4sBB')
+_PACKED_LENGTH = struct.Struct('>I')
+
+def _compress_segment(data, compression_code):
+    if compression_code == PACKED_COMPRESSIONS['gzip']:
+        # mtime=0, чтобы одинаковые данные давали одинаковый файл
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if compression_code == PACKED_COMPRESSIONS['lzma']:
+        return lzma.compress(data)
+    return data
+
+def _decompress_segment(data, compression_code):
+    if compression_code == PACKED_COMPRESSIONS['gzip']:
+        return gzip.decompress(data)
+    if compression_code == PACKED_COMPRESSIONS['lzma']:
+        return lzma.decompress(data)
+    return data
+
+def _write_packed(f, participants, compression='gzip'):
+    """Запись участников в формате 'packed' в открытый двоичный файл"""
+    if compression not in PACKED_COMPRESSIONS:
+        raise ValueError(f"Неизвестное значение DATA_COMPRESSION: {compression}")
+    compression_code = PACKED_COMPRESSIONS[compression]
+    f.write(_PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, compression_code))
+    for start in range(0, len(participants), PACKED_SEGMENT_RECORDS):
+        segment = bytearray()
+        for participant in participants[start:start + PACKED_SEGMENT_RECORDS]:
+            record = json.dumps(participant, ensure_ascii=False, separators=(',', ':'),
+                                default=_participant_json_default).encode('utf-8')
+            segment += _PACKED_LENGTH.pack(len(record))
+            segment += record
+        data = _compress_segment(bytes(segment), compression_code)
+        f.write(_PACKED_LENGTH.pack(len(data)))
+        f.write(data)
+
+def _iter_packed_records(path):
+    """Потоковое чтение файла 'packed': в памяти одновременно только один сегмент"""
+    with open(path, 'rb') as f:
+        header = f.read(_PACKED_HEADER.size)
+        if len(header) < _PACKED_HEADER.size:
+            raise ValueError(f"Обрезанный заголовок файла участников {path}")
+        magic, version, compression_code = _PACKED_HEADER.unpack(header)
+        if magic != PACKED_MAGIC or version != PACKED_VERSION:
+            raise ValueError(f"Неподдерживаемый формат файла участников {path}")
+        while True:
+            prefix = f.read(_PACKED_LENGTH.size)
+            if not prefix:
+                return
+            if len(prefix) < _PACKED_LENGTH.size:
+                raise ValueError(f"Обрезанный сегмент в файле участников {path}")
+            (length,) = _PACKED_LENGTH.unpack(prefix)
+            data = f.read(length)
+            if len(data) < length:
+                raise ValueError(f"Обрезанный сегмент в файле участников {path}")
+            segment = _decompress_segment(data, compression_code)
+            pos = 0
+            while pos < len(segment):
+                (length,) = _PACKED_LENGTH.unpack_from(segment, pos)
+                pos += _PACKED_LENGTH.size
+                yield json.loads(segment[pos:pos + length])
+                pos += length
+
+def _iter_participants_file(path):
+    """Потоковое чтение файла участников; формат (json или packed) определяется по заголовку"""
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(len(PACKED_MAGIC))
+    except FileNotFoundError:
+        return iter(())
+    if magic == PACKED_MAGIC:
+        return _iter_packed_records(path)
+    return _iter_json_array(path)
+
+def _read_participants_file(path):
+    """Чтение полного списка участников из файла в формате JSON-массива или packed"""
+    return list(_iter_participants_file(path))
+
+def _write_participants_file(path, participants, data_format='json', compression='gzip'):
+    """Атомарная запись файла участников в заданном формате"""
+    if data_format == 'packed':
+        _write_file_atomically(path, lambda f: _write_packed(f, participants, compression), binary=True)
+    elif data_format == 'json':
+        _write_file_atomically(path, lambda f: json.dump(
+            participants, f, ensure_ascii=False, indent=4, default=_participant_json_default))
+    else:
+        raise ValueError(f"Неизвестное значение DATA_FORMAT: {data_format}")
+
+def _read_journal_entries(journal_file, offset=0):
+    """Чтение операций журнала начиная с байтового смещения.
+    
+    Возвращает список операций и смещение, до которого журнал прочитан. Недописанная
+    последняя строка не считается прочитанной и будет разобрана при следующем вызове.
+    """
+    try:
+        with open(journal_file, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], 0
+    
+    end = data.rfind(b'\n') + 1
+    entries = []
+    for line in data[:end].splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entries.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            # Повреждённая строка (например, после сбоя во время записи) пропускается
+            logger.warning(f"Пропущена повреждённая строка журнала {journal_file}: {line[:100]!r}")
+    return entries, offset + end
+
+def _append_json_lines(path, offset, entries):
+    """Дозапись JSON-строк одной записью с принудительным сбросом на диск.
+    
+    offset - смещение, до которого файл уже прочитан; всё после него считается недописанной
+    строкой после сбоя и обрезается, иначе новая запись склеилась бы с ней и потерялась.
+    Возвращает новое смещение.
+    """
+    data = ''.join(
+        json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        for entry in entries
+    ).encode('utf-8')
+    with open(path, 'ab') as f:
+        if f.tell() > offset:
+            logger.warning(f"Обрезаем недописанный хвост файла {path} ({f.tell() - offset} байт)")
+            f.truncate(offset)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return offset + len(data)
+
+def _apply_journal_entry(participants, entry):
+    """Применение одной операции журнала к горячим участникам (HotView).
+    
+    Возвращает представление после операции; индекс телефонов обновляется вместе со списком.
+    """
+    op = entry.get('op')
+    if op == 'add':
+        participants.store.append(ParticipantRecord.from_dict(entry['participant']))
+        return participants.extended()
+    elif op == 'delete':
+        index = entry.get('index', -1)
+        if 0 <= index < len(participants):
+            return participants.without([participants.position(index)])
+    elif op == 'tombstone':
+        return _without_tickets(participants, set(entry.get('ticket_numbers', ())))
+    elif op == 'update':
+        updated = entry['participant']
+        positions = participants.ticket_positions([updated.get('ticket_number')])
+        if positions:
+            participants.store.replace(positions[0], ParticipantRecord.from_dict(updated))
+    elif op == 'clear':
+        return HotParticipants.build(())
+    else:
+        logger.warning(f"Неизвестная операция в журнале: {op}")
+    return participants
+
+def _without_tickets(participants, ticket_numbers):
+    """HotView без участников, номера которых есть среди ticket_numbers (вызывается под блокировкой хранилища)"""
+    if not ticket_numbers:
+        return participants
+    return participants.without(participants.ticket_positions(ticket_numbers))
+
+def _max_ticket_number(participants):
+    """Максимальный номер участника в списке (0, если участников нет)"""
+    max_number = 0
+    for participant in participants:
+        ticket_number = participant.get('ticket_number', 0)
+        if isinstance(ticket_number, (int, float)) and ticket_number > max_number:
+            max_number = int(ticket_number)
+    return max_number
+
+
+# Ключи вложенных словарей местоположения, значения которых повторяются у тысяч участников
+_SHARED_LOCATION_KEYS = frozenset(['city', 'region', 'country'])
+# Общая таблица повторяющихся значений (пол, местоположение): запись хранит только номер
+# значения в ней. Таблица своя у каждого процесса - упакованные записи не покидают его память
+_shared_values = []
+_shared_value_numbers = {}
+_shared_values_lock = threading.Lock()
+_SHARED_VALUES_LIMIT = 0x10000
+# Точка отсчёта для упакованного времени регистрации
+_REGISTRATION_EPOCH = datetime(2000, 1, 1)
+_REGISTRATION_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Признак отсутствующего поля (в отличие от поля со значением None)
+_MISSING = object()
+
+# Теги значений в упакованной записи участника: за тегом следуют байты самого значения
+(_RECORD_MISSING, _RECORD_NONE, _RECORD_UINT8, _RECORD_UINT32, _RECORD_INT64, _RECORD_CP1251,
+ _RECORD_UTF8, _RECORD_HEX, _RECORD_SHARED, _RECORD_JSON) = range(10)
+_RECORD_U16 = struct.Struct('<H')
+_RECORD_U32 = struct.Struct('<I')
+_RECORD_I64 = struct.Struct('<q')
+# Длина значения после тега для тегов фиксированной длины (None - длина записана перед значением)
+_RECORD_FIXED_SIZES = (0, 0, 1, _RECORD_U32.size, _RECORD_I64.size, None, None, None, _RECORD_U16.size, None)
+_RECORD_HEX_TEXT = re.compile('(?:[0-9a-f]{2}){1,255}')
+
+def _share_value(value):
+    """Номер значения в общей таблице (None, если значение нельзя или уже некуда добавить)"""
+    try:
+        number = _shared_value_numbers.get(value)
+    except TypeError:
+        return None
+    if number is None:
+        with _shared_values_lock:
+            number = _shared_value_numbers.get(value)
+            if number is None:
+                if len(_shared_values) >= _SHARED_VALUES_LIMIT:
+                    return None
+                # Сначала список, затем словарь: номер, найденный без блокировки, уже есть в списке
+                number = len(_shared_values)
+                _shared_values.append(value)
+                _shared_value_numbers[value] = number
+    return number
+
+def _pack_record_text(out, value):
+    """Строка - байтами hex-строки, в cp1251 или в UTF-8 (False, если строка слишком длинная)"""
+    if _RECORD_HEX_TEXT.fullmatch(value):
+        data = bytes.fromhex(value)
+        out.append(_RECORD_HEX)
+        out.append(len(data))
+        out += data
+        return True
+    try:
+        data = value.encode('cp1251')
+    except UnicodeEncodeError:
+        data = None
+    if data is not None and len(data) < 0x100:
+        out.append(_RECORD_CP1251)
+        out.append(len(data))
+        out += data
+        return True
+    data = value.encode('utf-8')
+    if len(data) < 0x10000:
+        out.append(_RECORD_UTF8)
+        out += _RECORD_U16.pack(len(data))
+        out += data
+        return True
+    return False
+
+def _pack_record_value(out, value, shared=False):
+    """Дописывает в out тег и байты значения; всё, что не упаковывается иначе, хранится JSON"""
+    if value is _MISSING:
+        out.append(_RECORD_MISSING)
+        return
+    if value is None:
+        out.append(_RECORD_NONE)
+        return
+    if shared and isinstance(value, (str, tuple)):
+        number = _share_value(value)
+        if number is not None:
+            out.append(_RECORD_SHARED)
+            out += _RECORD_U16.pack(number)
+            return
+        if isinstance(value, tuple):
+            # Местоположение, не поместившееся в общую таблицу
+            value = dict(value)
+    if type(value) is int:
+        if 0 <= value < 0x100:
+            out.append(_RECORD_UINT8)
+            out.append(value)
+            return
+        if 0 <= value < 0x100000000:
+            out.append(_RECORD_UINT32)
+            out += _RECORD_U32.pack(value)
+            return
+        if -0x8000000000000000 <= value < 0x8000000000000000:
+            out.append(_RECORD_INT64)
+            out += _RECORD_I64.pack(value)
+            return
+    elif type(value) is str and _pack_record_text(out, value):
+        return
+    data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    out.append(_RECORD_JSON)
+    out += _RECORD_U32.pack(len(data))
+    out += data
+
+def _unpack_record_value(packed, offset):
+    """Значение, тег которого стоит в позиции offset, и позиция следующего тега"""
+    tag = packed[offset]
+    offset += 1
+    if tag == _RECORD_CP1251:
+        end = offset + 1 + packed[offset]
+        return packed[offset + 1:end].decode('cp1251'), end
+    if tag == _RECORD_SHARED:
+        return _shared_values[_RECORD_U16.unpack_from(packed, offset)[0]], offset + _RECORD_U16.size
+    if tag == _RECORD_UINT8:
+        return packed[offset], offset + 1
+    if tag == _RECORD_UINT32:
+        return _RECORD_U32.unpack_from(packed, offset)[0], offset + _RECORD_U32.size
+    if tag == _RECORD_MISSING:
+        return _MISSING, offset
+    if tag == _RECORD_HEX:
+        end = offset + 1 + packed[offset]
+        return packed[offset + 1:end].hex(), end
+    if tag == _RECORD_NONE:
+        return None, offset
+    if tag == _RECORD_INT64:
+        return _RECORD_I64.unpack_from(packed, offset)[0], offset + _RECORD_I64.size
+    if tag == _RECORD_UTF8:
+        end = offset + _RECORD_U16.size + _RECORD_U16.unpack_from(packed, offset)[0]
+        return packed[offset + _RECORD_U16.size:end].decode('utf-8'), end
+    end = offset + _RECORD_U32.size + _RECORD_U32.unpack_from(packed, offset)[0]
+    return json.loads(packed[offset + _RECORD_U32.size:end].decode('utf-8')), end
+
+def _skip_record_values(packed, count):
+    """Позиция тега значения с номером count: предыдущие значения пропускаются без разбора"""
+    offset = 0
+    for _ in range(count):
+        tag = packed[offset]
+        size = _RECORD_FIXED_SIZES[tag]
+        if size is None:
+            if tag == _RECORD_UTF8:
+                size = _RECORD_U16.size + _RECORD_U16.unpack_from(packed, offset + 1)[0]
+            elif tag == _RECORD_JSON:
+                size = _RECORD_U32.size + _RECORD_U32.unpack_from(packed, offset + 1)[0]
+            else:
+                size = 1 + packed[offset + 1]
+        offset += 1 + size
+    return offset
+
+def _unpack_record_values(packed, count):
+    """Первые count значений упакованной записи"""
+    values = []
+    offset = 0
+    for _ in range(count):
+        value, offset = _unpack_record_value(packed, offset)
+        values.append(value)
+    return values
+
+def _pack_location(mapping):
+    """Словарь местоположения из city/region/country -> кортеж пар для общей таблицы значений"""
+    if not isinstance(mapping, dict) or not all(key in _SHARED_LOCATION_KEYS for key in mapping):
+        return mapping
+    return tuple(mapping.items())
+
+def _unpack_location(value):
+    return dict(value) if isinstance(value, tuple) else value
+
+def _pack_age(value):
+    """Возраст из формы приходит строкой - храним его целым числом"""
+    if isinstance(value, str) and value.isdigit() and str(int(value)) == value:
+        return int(value)
+    return value
+
+def _pack_registration_time(value):
+    """Время регистрации 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' -> секунды от _REGISTRATION_EPOCH"""
+    if isinstance(value, str):
+        try:
+            return int((datetime.strptime(value, _REGISTRATION_TIME_FORMAT) - _REGISTRATION_EPOCH).total_seconds())
+        except ValueError:
+            pass
+    return value
+
+def _unpack_registration_time(value):
+    if isinstance(value, int):
+        return (_REGISTRATION_EPOCH + timedelta(seconds=value)).strftime(_REGISTRATION_TIME_FORMAT)
+    return value
+
+def _pack_ip(value):
+    """IPv4-адрес в виде строки -> целое число (только если преобразование обратимо)"""
+    if isinstance(value, str):
+        try:
+            packed = int(ipaddress.IPv4Address(value))
+        except ValueError:
+            return value
+        if str(ipaddress.IPv4Address(packed)) == value:
+            return packed
+    return value
+
+def _unpack_ip(value):
+    if isinstance(value, int):
+        return str(ipaddress.IPv4Address(value))
+    return value
+
+
+class ParticipantRecord:
+    """Компактная запись участника в памяти.
+    
+    Все поля упакованы в одну строку байт: за тегом поля следует его значение. Номер и возраст
+    хранятся целыми числами, время регистрации и IPv4 - упакованными в int, текст - в cp1251
+    (байт на символ кириллицы) или байтами hex-строки, пол и местоположение - номером в общей
+    таблице значений, прочие поля - одним JSON в конце записи. Снаружи ведёт себя как словарь
+    (get, [], keys, items, а в шаблонах и доступ через точку), поэтому шаблоны, экспорт в Excel
+    и резервные копии работают с ним без изменений.
+    """
+    
+    __slots__ = ('_packed',)
+    
+    # Порядок полей в записи и в to_dict(); phone_key не хранится и вычисляется из телефона
+    FIELDS = ('ticket_number', 'full_name', 'phone', 'age', 'gender', 'registration_time',
+              'ip_address', 'location', 'coordinates', 'request_key', 'checksum')
+    POSITIONS = {key: position for position, key in enumerate(FIELDS)}
+    KNOWN_KEYS = frozenset(FIELDS + ('phone_key',))
+    
+    # Поля, одинаковые значения которых хранятся один раз в общей таблице
+    SHARED_FIELDS = frozenset(['gender', 'location', 'coordinates'])
+    
+    PACKERS = {
+        'age': _pack_age,
+        'registration_time': _pack_registration_time,
+        'ip_address': _pack_ip,
+        'location': _pack_location,
+        'coordinates': _pack_location,
+    }
+    
+    UNPACKERS = {
+        'registration_time': _unpack_registration_time,
+        'ip_address': _unpack_ip,
+        'location': _unpack_location,
+        'coordinates': _unpack_location,
+    }
+    
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, cls):
+            return data
+        record = cls()
+        record._packed = cls._pack(data)
+        return record
+    
+    @classmethod
+    def from_packed(cls, packed):
+        """Запись поверх уже упакованных байт (см. HotParticipants)"""
+        record = cls()
+        record._packed = packed
+        return record
+    
+    @classmethod
+    def _pack(cls, data):
+        out = bytearray()
+        for key in cls.FIELDS:
+            value = data.get(key, _MISSING)
+            if value is not _MISSING and key in cls.PACKERS:
+                value = cls.PACKERS[key](value)
+            _pack_record_value(out, value, key in cls.SHARED_FIELDS)
+        extra_keys = data.keys() - cls.KNOWN_KEYS
+        _pack_record_value(out, {key: data[key] for key in data if key in extra_keys} if extra_keys else _MISSING)
+        return bytes(out)
+    
+    def _values(self, count=None):
+        """Значения первых count полей; без count - все поля и словарь прочих полей последним"""
+        return _unpack_record_values(self._packed, len(self.FIELDS) + 1 if count is None else count)
+    
+    def _field(self, key, value):
+        if value is not _MISSING and key in self.UNPACKERS:
+            value = self.UNPACKERS[key](value)
+        return value
+    
+    def _value(self, key):
+        if key == 'phone_key':
+            phone = self._value('phone')
+            return canonical_phone_key(phone) if phone is not _MISSING else _MISSING
+        packed = self._packed
+        position = self.POSITIONS.get(key)
+        if position is not None:
+            # Разбирается только нужное поле: предыдущие лишь пропускаются
+            return self._field(key, _unpack_record_value(packed, _skip_record_values(packed, position))[0])
+        extra = _unpack_record_value(packed, _skip_record_values(packed, len(self.FIELDS)))[0]
+        return extra.get(key, _MISSING) if extra is not _MISSING else _MISSING
+    
+    def __getattr__(self, name):
+        # Вызывается только для имён, которых нет среди слотов: participant.full_name и т.п.
+        # Отсутствующее поле даёт AttributeError, как и у словаря в шаблонах Jinja
+        value = self._value(name) if not name.startswith('_') else _MISSING
+        if value is _MISSING:
+            raise AttributeError(name)
+        return value
+    
+    def get(self, key, default=None):
+        value = self._value(key)
+        return default if value is _MISSING else value
+    
+    def __getitem__(self, key):
+        value = self._value(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        if key == 'phone_key':
+            # Ключ всегда вычисляется из телефона
+            return
+        data = self.to_dict()
+        data[key] = value
+        self._packed = self._pack(data)
+    
+    def __contains__(self, key):
+        return self._value(key) is not _MISSING
+    
+    def __reduce__(self):
+        # Номера в общей таблице значений действительны только в своём процессе
+        return (ParticipantRecord.from_dict, (self.to_dict(),))
+    
+    def items(self):
+        values = self._values()
+        items = [(key, self._field(key, value)) for key, value in zip(self.FIELDS, values) if value is not _MISSING]
+        phone = values[self.POSITIONS['phone']]
+        if phone is not _MISSING:
+            items.append(('phone_key', canonical_phone_key(phone)))
+        if values[-1] is not _MISSING:
+            items.extend(values[-1].items())
+        return items
+    
+    def keys(self):
+        return [key for key, _ in self.items()]
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.items())
+    
+    def to_dict(self):
+        return dict(self.items())
+    
+    def __repr__(self):
+        return f"ParticipantRecord({self.to_dict()!r})"
+
+def _participant_json_default(obj):
+    """Сериализация ParticipantRecord в json.dump/json.dumps"""
+    if isinstance(obj, ParticipantRecord):
+        return obj.to_dict()
+    if isinstance(obj, (TieredParticipants, HotView)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# Поля, не входящие в контрольную сумму: сама сумма и ключ, вычисляемый из телефона
+_CHECKSUM_EXCLUDED_KEYS = frozenset(['checksum', 'phone_key'])
+# Размер пачки записей, которую проверяет один процесс
+VERIFY_CHUNK_RECORDS = 2000
+
+def participant_checksum(participant):
+    """Контрольная сумма записи участника (CRC32, 8 шестнадцатеричных цифр).
+    
+    Считается по каноническому JSON записи в том виде, в каком её хранит ParticipantRecord,
+    поэтому не зависит от формата файла, порядка ключей и упаковки полей в памяти.
+    """
+    record = ParticipantRecord.from_dict(participant)
+    payload = {key: value for key, value in record.items() if key not in _CHECKSUM_EXCLUDED_KEYS}
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return f"{zlib.crc32(data.encode('utf-8')):08x}"
+
+def _updated_participant(participant, changes):
+    """Копия участника (словарь) с изменёнными полями и новой контрольной суммой"""
+    updated = dict(participant.items())
+    updated.update(changes)
+    updated['checksum'] = participant_checksum(updated)
+    return updated
+
+def _verify_chunk(records):
+    """Проверка пачки записей (выполняется в отдельном процессе).
+    
+    Запись - словарь или строка JSON (из SQLite). Для каждой возвращает
+    (состояние, номер, ключ телефона, описание ошибки); состояние 'ok', 'unchecked'
+    (запись сделана до появления контрольных сумм) или 'corrupt'.
+    """
+    results = []
+    for record in records:
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)
+            if not isinstance(record, dict):
+                raise ValueError("запись не является объектом")
+            phone_key = canonical_phone_key(record.get('phone'))
+            checksum = participant_checksum(record)
+        except Exception as e:
+            results.append(('corrupt', None, None, f"запись не разбирается: {e}"))
+            continue
+        ticket_number = record.get('ticket_number')
+        stored_checksum = record.get('checksum')
+        if stored_checksum is not None and stored_checksum != checksum:
+            results.append(('corrupt', ticket_number, phone_key, "контрольная сумма не совпадает"))
+        elif record.get('phone_key', phone_key) != phone_key:
+            results.append(('corrupt', ticket_number, phone_key, "phone_key не соответствует телефону"))
+        else:
+            results.append(('ok' if stored_checksum is not None else 'unchecked', ticket_number, phone_key, None))
+    return results
+
+def _iter_record_chunks(records, size):
+    chunk = []
+    for record in records:
+        # Компактные записи передаются в процессы проверки словарями
+        chunk.append(record.to_dict() if isinstance(record, ParticipantRecord) else record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def verify_participant_records(records, workers=0):
+    """Проверка целостности участников за один потоковый проход.
+    
+    Записи читаются пачками по VERIFY_CHUNK_RECORDS и проверяются параллельно в workers
+    процессах (0 - по числу ядер); в обработке одновременно не больше двух пачек на процесс.
+    Находит повреждённые записи и повторы телефона и номера участника.
+    Возвращает отчёт и список (номер, ключ телефона) для каждой записи по порядку -
+    из него хранилища перестраивают индексы поиска.
+    """
+    started = time.monotonic()
+    workers = workers or os.cpu_count() or 1
+    report = {'records': 0, 'verified': 0, 'without_checksum': 0, 'corrupt': [],
+              'duplicate_phones': [], 'duplicate_tickets': [], 'error': None, 'workers': workers}
+    keys = []
+    phone_tickets = collections.defaultdict(list)
+    ticket_counts = collections.Counter()
+    
+    def merge(results):
+        for state, ticket_number, phone_key, message in results:
+            if state == 'ok':
+                report['verified'] += 1
+            elif state == 'unchecked':
+                report['without_checksum'] += 1
+            else:
+                report['corrupt'].append({'position': len(keys), 'ticket_number': ticket_number, 'error': message})
+            keys.append((ticket_number, phone_key))
+            if phone_key:
+                phone_tickets[phone_key].append(ticket_number)
+            if ticket_number is not None:
+                ticket_counts[ticket_number] += 1
+    
+    def readable():
+        try:
+            yield from records
+        except (ValueError, OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+            # Файл не читается дальше этого места (например, обрезан): проверенная часть остаётся в отчёте
+            report['error'] = str(e)
+    
+    chunks = _iter_record_chunks(readable(), VERIFY_CHUNK_RECORDS)
+    if workers == 1:
+        for chunk in chunks:
+            merge(_verify_chunk(chunk))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_verify_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    merge(pending.popleft().result())
+            while pending:
+                merge(pending.popleft().result())
+    
+    report['records'] = len(keys)
+    report['duplicate_phones'] = [{'phone_key': phone_key, 'ticket_numbers': tickets}
+                                  for phone_key, tickets in phone_tickets.items() if len(tickets) > 1]
+    report['duplicate_tickets'] = [{'ticket_number': ticket_number, 'count': count}
+                                   for ticket_number, count in ticket_counts.items() if count > 1]
+    report['elapsed'] = round(time.monotonic() - started, 3)
+    return report, keys
+
+def _verification_problems(report):
+    """Число найденных проблем в отчёте проверки"""
+    return (len(report['corrupt']) + len(report['duplicate_phones']) + len(report['duplicate_tickets'])
+            + (1 if report['error'] else 0))
+
+
+class InterProcessLock:
+    """Блокировка, общая для потоков и процессов gunicorn (flock на отдельном файле).
+    
+    Повторный захват тем же потоком допускается.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+        self.pid = None
+    
+    def _lock_fd(self):
+        # После fork дескриптор родителя разделяет с ним блокировку, поэтому открываем свой
+        if self.fd is None or self.pid != os.getpid():
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        return self.fd
+    
+    def acquire(self, blocking=True):
+        if not self.thread_lock.acquire(blocking):
+            return False
+        self.depth += 1
+        if self.depth == 1 and fcntl is not None:
+            try:
+                fcntl.flock(self._lock_fd(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.depth -= 1
+                self.thread_lock.release()
+                return False
+            except:
+                self.depth -= 1
+                self.thread_lock.release()
+                raise
+        return True
+    
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and fcntl is not None:
+            fcntl.flock(self._lock_fd(), fcntl.LOCK_UN)
+        self.thread_lock.release()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class SharedCounter:
+    """Целое число в файле (8 байт), общее для всех процессов.
+    
+    Изменяется только под InterProcessLock; запись 8 байт по нулевому смещению атомарна.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.pid = None
+    
+    def _fd(self):
+        if self.fd is None or self.pid != os.getpid():
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        return self.fd
+    
+    def get(self):
+        data = os.pread(self._fd(), 8, 0)
+        return int.from_bytes(data, 'little') if len(data) == 8 else 0
+    
+    def set(self, value):
+        os.pwrite(self._fd(), int(value).to_bytes(8, 'little'), 0)
+
+
+class PhoneAlreadyRegistered(Exception):
+    """Телефон уже зарегистрирован; participant - ранее сохранённый участник с этим телефоном"""
+    
+    def __init__(self, participant):
+        super().__init__("Этот номер телефона уже зарегистрирован")
+        self.participant = participant
+
+
+class RegistrationStateUnknown(Exception):
+    """Не дождались записи пачки с регистрацией: она не отменена и может быть сохранена позже"""
+
+
+class ParticipantStorage:
+    """Базовый интерфейс хранилища участников.
+    
+    Конкретная реализация выбирается переменной окружения STORAGE_BACKEND.
+    """
+    name = None
+    
+    def load_all(self):
+        """Полный список участников в порядке регистрации"""
+        raise NotImplementedError
+    
+    def count(self):
+        """Количество участников"""
+        return len(self.load_all())
+    
+    def add(self, participant):
+        """Добавление участника с выделением следующего номера. Возвращает номер участника.
+        
+        Если телефон уже зарегистрирован, выбрасывает PhoneAlreadyRegistered.
+        """
+        result = self.add_many([participant])[0]
+        if isinstance(result, PhoneAlreadyRegistered):
+            raise result
+        return result
+    
+    def add_many(self, participants):
+        """Добавление нескольких участников одной записью.
+        
+        Проверка телефона выполняется в той же блокировке, что и запись, поэтому два
+        одновременных запроса не могут зарегистрировать один номер дважды. Возвращает
+        список, в котором для каждого участника номер или PhoneAlreadyRegistered.
+        """
+        raise NotImplementedError
+    
+    def delete_tickets(self, ticket_numbers):
+        """Удаление участников по номерам. Возвращает список номеров, которые были удалены"""
+        raise NotImplementedError
+    
+    def update(self, ticket_number, changes):
+        """Изменение полей участника с пересчётом контрольной суммы. Возвращает False, если участника нет"""
+        return bool(self.update_many({ticket_number: changes}))
+    
+    def update_many(self, updates):
+        """Изменение полей нескольких участников ({номер: изменения}) одной записью.
+        Возвращает список номеров, которые были найдены и изменены"""
+        raise NotImplementedError
+    
+    def clear(self):
+        """Удаление всех участников"""
+        raise NotImplementedError
+    
+    def pending_verification(self):
+        """Участники, местоположение которых ещё не проверено (DEFERRED_VERIFICATION)"""
+        return [participant for participant in self.load_all() if participant.get('verification') == 'pending']
+    
+    def is_phone_registered(self, phone):
+        """Проверка, зарегистрирован ли уже номер с таким же каноническим ключом"""
+        return self.find_by_phone(phone) is not None
+    
+    def find_by_phone(self, phone):
+        """Поиск участника по каноническому ключу телефона"""
+        phone_key = canonical_phone_key(phone)
+        if not phone_key:
+            return None
+        for participant in self.load_all():
+            if participant_phone_key(participant) == phone_key:
+                return participant
+        return None
+    
+    def max_ticket_number(self):
+        """Максимальный номер среди текущих участников (0, если участников нет)"""
+        return _max_ticket_number(self.load_all())
+    
+    def verify(self, workers=0):
+        """Проверка контрольных сумм и повторов во всех записях за один проход
+        с перестроением индексов поиска. Возвращает отчёт verify_participant_records"""
+        raise NotImplementedError
+
+
+# Холодное хранение: в каталоге манифест и сегменты NNNNNN.pack (формат 'packed') с индексами
+# NNNNNN.idx - номерами участников и ключами телефонов (int64) в порядке записей сегмента
+COLD_MANIFEST_NAME = 'manifest.json'
+# Сегменты, выведенные из манифеста; их файлы удаляются через COLD_RETIRED_GRACE секунд,
+# так как другие процессы могут ещё читать их
+COLD_RETIRED_NAME = 'retired.json'
+COLD_RETIRED_GRACE = 3600
+
+def _cold_phone_number(phone_key):
+    """Ключ телефона -> int64 для индекса (ведущая 1 сохраняет ведущие нули; 0 - телефона нет)"""
+    return int('1' + phone_key) if phone_key and phone_key.isdigit() else 0
+
+def _cold_ticket_number(ticket_number):
+    return ticket_number if isinstance(ticket_number, int) and not isinstance(ticket_number, bool) else 0
+
+def _read_cold_file(directory, name, default):
+    try:
+        with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+def _write_cold_file(directory, name, data):
+    _write_file_atomically(os.path.join(directory, name), lambda f: json.dump(data, f, indent=1))
+
+def _read_cold_manifest(directory):
+    return _read_cold_file(directory, COLD_MANIFEST_NAME, {'next_segment': 1, 'segments': []})
+
+def _write_cold_segment(directory, number, participants):
+    """Запись сегмента холодного хранения и его индекса; возвращает запись манифеста"""
+    name = f"{number:06d}"
+    tickets = array.array('q', (_cold_ticket_number(participant.get('ticket_number')) for participant in participants))
+    phones = array.array('q', (_cold_phone_number(participant_phone_key(participant)) for participant in participants))
+    _write_participants_file(os.path.join(directory, name + '.pack'), participants, 'packed', COLD_COMPRESSION)
+    _write_file_atomically(os.path.join(directory, name + '.idx'),
+                           lambda f: f.write(tickets.tobytes() + phones.tobytes()), binary=True)
+    return {'file': name, 'count': len(participants)}
+
+
+class ColdSegments:
+    """Холодные участники: неизменяемые сжатые сегменты в каталоге directory.
+    
+    В памяти хранится только индекс - отсортированные массивы номеров и ключей телефонов
+    с позициями записей (32 байта на участника). Сами записи распаковываются по требованию,
+    последние распакованные сегменты кэшируются. Удалённые, но ещё не вычищенные
+    уплотнением участники перечислены в deleted_positions.
+    """
+    
+    CACHED_SEGMENTS = 2
+    
+    def __init__(self, directory=None, segments=(), tickets=(), phones=()):
+        self.directory = directory
+        self.segments = tuple(segments)
+        # Позиция первой записи каждого сегмента
+        self.starts = []
+        self.total = 0
+        for segment in self.segments:
+            self.starts.append(self.total)
+            self.total += segment['count']
+        self.ticket_keys, self.ticket_positions = self._sorted_index(tickets)
+        self.phone_keys, self.phone_positions = self._sorted_index(phones)
+        self.max_ticket = self.ticket_keys[-1] if self.ticket_keys else 0
+        self.deleted_positions = ()
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+    
+    @staticmethod
+    def _sorted_index(values):
+        pairs = sorted((value, position) for position, value in enumerate(values) if value > 0)
+        return array.array('q', (value for value, _ in pairs)), array.array('q', (position for _, position in pairs))
+    
+    @classmethod
+    def load(cls, directory):
+        """Загрузка индекса сегментов из манифеста; сами записи не читаются"""
+        manifest = _read_cold_manifest(directory)
+        tickets = array.array('q')
+        phones = array.array('q')
+        for segment in manifest['segments']:
+            path = os.path.join(directory, segment['file'] + '.idx')
+            with open(path, 'rb') as f:
+                data = f.read()
+            size = segment['count'] * tickets.itemsize
+            if len(data) != 2 * size:
+                raise ValueError(f"Повреждён индекс холодного сегмента {path}")
+            tickets.frombytes(data[:size])
+            phones.frombytes(data[size:])
+        return cls(directory, manifest['segments'], tickets, phones)
+    
+    def __len__(self):
+        return self.total - len(self.deleted_positions)
+    
+    def _is_deleted(self, position):
+        index = bisect.bisect_left(self.deleted_positions, position)
+        return index < len(self.deleted_positions) and self.deleted_positions[index] == position
+    
+    def _lookup(self, keys, positions, value):
+        """Позиция первой неудалённой записи с данным значением ключа (None, если такой нет)"""
+        index = bisect.bisect_left(keys, value)
+        while index < len(keys) and keys[index] == value:
+            if not self._is_deleted(positions[index]):
+                return positions[index]
+            index += 1
+        return None
+    
+    def position_of_ticket(self, ticket_number):
+        ticket_number = _cold_ticket_number(ticket_number)
+        return self._lookup(self.ticket_keys, self.ticket_positions, ticket_number) if ticket_number else None
+    
+    def has_ticket(self, ticket_number):
+        return self.position_of_ticket(ticket_number) is not None
+    
+    def has_phone(self, phone_key):
+        phone_number = _cold_phone_number(phone_key)
+        return bool(phone_number) and self._lookup(self.phone_keys, self.phone_positions, phone_number) is not None
+    
+    def find_by_phone(self, phone_key):
+        """Первый зарегистрированный участник с этим ключом телефона; распаковывает один сегмент"""
+        phone_number = _cold_phone_number(phone_key)
+        position = self._lookup(self.phone_keys, self.phone_positions, phone_number) if phone_number else None
+        return self._record_at_position(position) if position is not None else None
+    
+    def with_deleted(self, ticket_numbers):
+        """Копия с дополнительно удалёнными участниками (индекс и кэш сегментов общие)"""
+        positions = {self.position_of_ticket(ticket_number) for ticket_number in ticket_numbers}
+        positions.discard(None)
+        if not positions:
+            return self
+        cold = copy.copy(self)
+        cold.deleted_positions = tuple(sorted(positions.union(self.deleted_positions)))
+        return cold
+    
+    def _segment_path(self, index):
+        return os.path.join(self.directory, self.segments[index]['file'] + '.pack')
+    
+    def _segment_records(self, index):
+        with self.cache_lock:
+            records = self.cache.get(index)
+            if records is not None:
+                self.cache.move_to_end(index)
+                return records
+        records = tuple(ParticipantRecord.from_dict(record) for record in _iter_packed_records(self._segment_path(index)))
+        with self.cache_lock:
+            self.cache[index] = records
+            while len(self.cache) > self.CACHED_SEGMENTS:
+                self.cache.popitem(last=False)
+        return records
+    
+    def _record_at_position(self, position):
+        index = bisect.bisect_right(self.starts, position) - 1
+        return self._segment_records(index)[position - self.starts[index]]
+    
+    def record_at(self, index):
+        """Запись по номеру среди неудалённых"""
+        position = index
+        for deleted in self.deleted_positions:
+            if deleted > position:
+                break
+            position += 1
+        return self._record_at_position(position)
+    
+    def deleted_in(self, index):
+        """Удалённые позиции внутри сегмента index"""
+        start = self.starts[index]
+        return self.deleted_positions[bisect.bisect_left(self.deleted_positions, start):
+                                      bisect.bisect_left(self.deleted_positions, start + self.segments[index]['count'])]
+    
+    def live_records(self, index, raw=False):
+        """Неудалённые записи сегмента; распакованный сегмент не попадает в кэш.
+        
+        raw=True - разобранные словари в том виде, в каком они лежат в файле.
+        """
+        deleted = set(self.deleted_in(index))
+        return [record if raw else ParticipantRecord.from_dict(record)
+                for position, record in enumerate(_iter_packed_records(self._segment_path(index)), self.starts[index])
+                if position not in deleted]
+    
+    def iter_records(self, raw=False):
+        """Неудалённые записи всех сегментов по порядку; в памяти одновременно один сегмент"""
+        for index in range(len(self.segments)):
+            yield from self.live_records(index, raw)
+
+_EMPTY_COLD = ColdSegments()
+
+
+class TieredParticipants(collections.abc.Sequence):
+    """Участники холодных сегментов и горячие записи в памяти одной последовательностью.
+    
+    Ведёт себя как кортеж (len, индексы, срезы, итерация), поэтому панель администратора,
+    экспорт и резервные копии работают с ней без изменений; холодные записи
+    распаковываются только при обращении к ним.
+    """
+    
+    def __init__(self, cold, hot):
+        self.cold = cold
+        self.hot = hot
+    
+    def __len__(self):
+        return len(self.cold) + len(self.hot)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Индекс участника вне диапазона')
+        cold_count = len(self.cold)
+        return self.cold.record_at(index) if index < cold_count else self.hot[index - cold_count]
+    
+    def __iter__(self):
+        yield from self.cold.iter_records()
+        yield from self.hot
+
+
+class _KeyPositions:
+    """Индекс ключ -> позиции в списке горячих участников.
+    
+    Первая (наименьшая) позиция ключа хранится в словаре first, остальные - в more:
+    повторы ключа бывают только в данных, записанных в обход приложения.
+    """
+    
+    __slots__ = ('first', 'more')
+    
+    def __init__(self):
+        self.first = {}
+        self.more = {}
+    
+    def get(self, key):
+        return self.first.get(key)
+    
+    def all(self, key):
+        position = self.first.get(key)
+        if position is None:
+            return []
+        return [position] + self.more.get(key, [])
+    
+    def add(self, key, position):
+        if key in self.first:
+            self.more.setdefault(key, []).append(position)
+        else:
+            self.first[key] = position
+    
+    def remove(self, key, position):
+        later = self.more.get(key)
+        if self.first.get(key) == position:
+            if later:
+                # Ключ переходит к следующей позиции одним присваиванием: читатели без блокировки его не теряют
+                self.first[key] = later.pop(0)
+            else:
+                del self.first[key]
+        elif later and position in later:
+            later.remove(position)
+        if later is not None and not later:
+            del self.more[key]
+
+
+def _stored_participant(participant):
+    """Участник в виде, в котором он лежит в списке HotParticipants"""
+    return participant._packed if isinstance(participant, ParticipantRecord) else participant
+
+
+class HotParticipants:
+    """Горячие участники в памяти: список, который только дописывается, и индексы номеров и телефонов над ним.
+    
+    Изменяется только под блокировкой хранилища. Снимки ссылаются на него через HotView -
+    длину списка и удалённые позиции на момент публикации, поэтому запись не копирует
+    уже опубликованных участников: новый дописывается в конец, удалённый остаётся в списке
+    до уплотнения и только исключается из индекса. Изменённый участник заменяется на месте.
+    
+    ParticipantRecord хранится в списке одними упакованными байтами, а объект записи
+    создаётся при чтении (get): так на участника не тратится ещё и объект-обёртка.
+    """
+    
+    __slots__ = ('items', 'tickets', 'phones')
+    
+    def __init__(self):
+        self.items = []
+        # Номер участника -> позиции участников с ним (удаление и изменение не просматривают весь список)
+        self.tickets = _KeyPositions()
+        # Канонический ключ телефона -> позиции участников с ним
+        self.phones = _KeyPositions()
+    
+    @classmethod
+    def build(cls, participants):
+        """Представление нового списка с участниками participants"""
+        store = cls()
+        for participant in participants:
+            store.append(participant)
+        return HotView(store)
+    
+    def get(self, position):
+        item = self.items[position]
+        return ParticipantRecord.from_packed(item) if isinstance(item, bytes) else item
+    
+    def _index(self, position, participant):
+        ticket_number = participant.get('ticket_number')
+        if ticket_number is not None:
+            self.tickets.add(ticket_number, position)
+        phone_key = participant_phone_key(participant)
+        if phone_key:
+            self.phones.add(phone_key, position)
+    
+    def _unindex(self, position, participant):
+        ticket_number = participant.get('ticket_number')
+        if ticket_number is not None:
+            self.tickets.remove(ticket_number, position)
+        phone_key = participant_phone_key(participant)
+        if phone_key:
+            self.phones.remove(phone_key, position)
+    
+    def append(self, participant):
+        position = len(self.items)
+        # Сначала запись, затем индекс: читатель, нашедший позицию в индексе, найдёт и участника
+        self.items.append(_stored_participant(participant))
+        self._index(position, participant)
+        return position
+    
+    def replace(self, position, participant):
+        previous = self.get(position)
+        self.items[position] = _stored_participant(participant)
+        if (participant.get('ticket_number') != previous.get('ticket_number')
+                or participant_phone_key(participant) != participant_phone_key(previous)):
+            self._unindex(position, previous)
+            self._index(position, participant)
+    
+    def remove(self, position):
+        self._unindex(position, self.get(position))
+    
+    def materialize(self, position):
+        """Замена разобранного словаря в позиции на компактную запись: номер и телефон те же, индексы не меняются"""
+        item = self.items[position]
+        if isinstance(item, dict):
+            self.items[position] = _stored_participant(ParticipantRecord.from_dict(item))
+
+
+class HotView(collections.abc.Sequence):
+    """Горячие участники снимка: первые length позиций HotParticipants без удалённых (holes).
+    
+    Ведёт себя как кортеж в порядке регистрации. Участников, дописанных после публикации,
+    представление не видит; участника, изменённого после публикации, видит уже изменённым.
+    """
+    
+    __slots__ = ('store', 'length', 'holes')
+    
+    def __init__(self, store, length=None, holes=()):
+        self.store = store
+        self.length = len(store.items) if length is None else length
+        # Отсортированные позиции удалённых участников
+        self.holes = holes
+    
+    def __len__(self):
+        return self.length - len(self.holes)
+    
+    def position(self, index):
+        """Позиция в списке для индекса среди неудалённых"""
+        position = index
+        while True:
+            shifted = index + bisect.bisect_right(self.holes, position)
+            if shifted == position:
+                return position
+            position = shifted
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Индекс участника вне диапазона')
+        return self.store.get(self.position(index))
+    
+    def positions(self):
+        """Позиции неудалённых участников по порядку"""
+        holes = iter(self.holes)
+        next_hole = next(holes, None)
+        for position in range(self.length):
+            if position == next_hole:
+                next_hole = next(holes, None)
+                continue
+            yield position
+    
+    def __iter__(self):
+        get = self.store.get
+        for position in self.positions():
+            yield get(position)
+    
+    def ticket_positions(self, ticket_numbers):
+        """Позиции неудалённых участников с номерами из ticket_numbers, по порядку"""
+        tickets = self.store.tickets
+        return sorted(position for ticket_number in ticket_numbers for position in tickets.all(ticket_number)
+                      if position < self.length)
+    
+    def find_by_phone(self, phone_key):
+        """Первый зарегистрированный участник с этим ключом телефона"""
+        position = self.store.phones.get(phone_key)
+        return self.store.get(position) if position is not None else None
+    
+    def extended(self):
+        """Представление с участниками, дописанными в список после этого"""
+        return HotView(self.store, None, self.holes)
+    
+    def without(self, positions):
+        """Представление без участников в позициях positions (вызывается под блокировкой хранилища)"""
+        positions = set(positions).difference(self.holes)
+        if not positions:
+            return self
+        for position in positions:
+            self.store.remove(position)
+        return HotView(self.store, self.length, tuple(sorted(positions.union(self.holes))))
+    
+    def compacted(self):
+        """Представление нового списка без удалённых участников"""
+        return HotParticipants.build(self) if self.holes else self
+
+
+class ParticipantSnapshot:
+    """Снимок участников в памяти.
+    
+    Писатели не меняют опубликованный снимок, а публикуют новый, подменяя ссылку на него
+    одним присваиванием; горячие участники при этом не копируются (см. HotParticipants).
+    Читатели берут ссылку без блокировки и видят согласованные список, индекс телефонов
+    и версию, даже если в это время идёт запись.
+    """
+    
+    __slots__ = ('participants', 'version', 'identity', 'materialized', 'cold')
+    
+    def __init__(self, participants, version, identity, materialized, cold=_EMPTY_COLD):
+        # Горячие участники в порядке регистрации (HotView; у SQLite - кортеж)
+        self.participants = participants
+        # Версия данных и идентичность файлов, из которых построен снимок
+        self.version = version
+        self.identity = identity
+        # False, пока в снимке разобранные словари, а не компактные записи ParticipantRecord
+        self.materialized = materialized
+        # Более ранние участники в холодных сегментах (ColdSegments)
+        self.cold = cold
+    
+    def all_participants(self):
+        """Все участники: горячий кортеж или последовательность с холодными сегментами"""
+        return TieredParticipants(self.cold, self.participants) if self.cold else self.participants
+
+
+class JsonParticipantStorage(ParticipantStorage):
+    """Весь список участников хранится в одном JSON-файле и перезаписывается при каждом изменении"""
+    name = 'json'
+    
+    def __init__(self, data_file):
+        self.data_file = data_file
+        base_path = os.path.splitext(data_file)[0]
+        # Блокировка для безопасной работы с файлом данных при конкурентном доступе
+        # (между потоками и между процессами gunicorn)
+        self.lock = InterProcessLock(base_path + '.lock')
+        # Последний выданный номер участника; номера не переиспользуются после удаления
+        self.ticket_counter = SharedCounter(base_path + '.ticket')
+        self.ticket_counter_restored = False
+        # Последний номер, выданный в хранилище, из которого импортированы участники
+        self.imported_last_ticket = 0
+        # Версия данных, общая для всех процессов: увеличивается после каждой записи
+        self.version_counter = SharedCounter(base_path + '.version')
+        # Номера удалённых участников (по одному JSON-числу в строке); физически участники
+        # удаляются из файла данных фоновым уплотнением, а до того отфильтровываются при чтении
+        self.tombstone_file = base_path + '.tombstones'
+        self.tombstone_offset = 0
+        # Холодные сегменты давно зарегистрированных участников (см. COLD_AFTER_DAYS);
+        # loaded_cold - прочитанные последним _read_from_disk
+        self.cold_dir = base_path + '.cold'
+        self.loaded_cold = _EMPTY_COLD
+        # Последний опубликованный снимок участников (ParticipantSnapshot)
+        self.snapshot = None
+        # Фоновое уплотнение; одновременно его выполняет только один процесс
+        self.compaction_lock = InterProcessLock(base_path + '.compact.lock')
+        self.compaction_event = threading.Event()
+        self.compaction_thread = None
+        self.compaction_pid = None
+        self.compaction_start_lock = threading.Lock()
+    
+    def _read_from_disk(self):
+        # Записи ParticipantRecord создаются позже: проверке телефона достаточно словарей и индекса
+        tombstones, self.tombstone_offset = _read_journal_entries(self.tombstone_file)
+        tombstones = set(tombstones)
+        cold = ColdSegments.load(self.cold_dir)
+        # Индексы номеров и телефонов строятся по ходу потокового чтения, без промежуточного списка
+        store = HotParticipants()
+        for participant in _iter_participants_file(self.data_file):
+            ticket_number = participant.get('ticket_number')
+            # После сбоя при переносе в холодные сегменты участники могли остаться и в файле данных
+            if ticket_number in tombstones or (cold and cold.has_ticket(ticket_number)):
+                continue
+            store.append(participant)
+        self.loaded_cold = cold.with_deleted(tombstones)
+        return HotView(store)
+    
+    def _write_all(self, participants):
+        # Сбой во время записи не может обрезать файл: новая версия подменяет старую целиком
+        _write_participants_file(self.data_file, participants, DATA_FORMAT, DATA_COMPRESSION)
+    
+    def _persist_add(self, participants, new_participants):
+        self._write_all(list(participants) + new_participants)
+    
+    def _persist_update(self, participants, updated):
+        by_ticket = {record['ticket_number']: record for record in updated}
+        self._write_all([by_ticket.get(participant.get('ticket_number'), participant) for participant in participants])
+    
+    def _persist_tombstones(self, ticket_numbers):
+        # Удаление - одна короткая строка в конце файла меток вместо перезаписи всех участников
+        self.tombstone_offset = _append_json_lines(self.tombstone_file, self.tombstone_offset, ticket_numbers)
+    
+    def _persist_clear(self):
+        # Метки удаляются первыми: иначе после сбоя они скрыли бы новых участников с теми же номерами
+        self._reset_tombstones()
+        if os.path.exists(os.path.join(self.cold_dir, COLD_MANIFEST_NAME)):
+            self._write_cold_locked(_EMPTY_COLD, ())
+        self._write_all([])
+    
+    def _reset_tombstones(self):
+        if os.path.exists(self.tombstone_file):
+            _write_file_atomically(self.tombstone_file, lambda f: None)
+        self.tombstone_offset = 0
+    
+    def _disk_identity(self):
+        """Идентичность файлов хранилища; меняется при любой записи, в том числе в обход приложения"""
+        return (_file_identity(self.data_file), _file_identity(self.tombstone_file),
+                _file_identity(os.path.join(self.cold_dir, COLD_MANIFEST_NAME)))
+    
+    def _publish_locked(self, participants, version, identity=None, materialized=True, cold=None):
+        """Публикация нового снимка (вызывается под self.lock).
+        
+        participants - HotView горячих участников; cold=None - холодные сегменты прежние.
+        """
+        if cold is None:
+            cold = self.snapshot.cold if self.snapshot is not None else _EMPTY_COLD
+        snapshot = ParticipantSnapshot(
+            participants, version,
+            identity if identity is not None else self._disk_identity(),
+            materialized, cold
+        )
+        self.snapshot = snapshot
+        # Общая версия увеличивается только после публикации: читатель, увидевший новую версию,
+        # уже найдёт соответствующий ей снимок
+        if version > self.version_counter.get():
+            self.version_counter.set(version)
+        return snapshot
+    
+    def _next_version_locked(self):
+        """Версия для снимка после новой записи; другие процессы узнают о ней при публикации"""
+        return self.version_counter.get() + 1
+    
+    def _load_locked(self):
+        """Загрузка участников с диска (вызывается под self.lock).
+        
+        Строит только индекс телефонов над разобранными словарями; компактные записи
+        создаются в _materialize_locked, когда понадобится весь список.
+        """
+        version = self.version_counter.get()
+        # Идентичность берётся до чтения: если файл изменят во время чтения, следующая проверка это заметит
+        identity = self._disk_identity()
+        participants = self._read_from_disk()
+        return self._publish_locked(participants, version, identity, materialized=False, cold=self.loaded_cold)
+    
+    def _materialize_locked(self, snapshot):
+        """Снимок с компактными записями вместо разобранных словарей (вызывается под self.lock).
+        
+        Записи заменяются на месте, без копирования списка.
+        """
+        store = snapshot.participants.store
+        for position in range(len(store.items)):
+            store.materialize(position)
+        return self._publish_locked(snapshot.participants, snapshot.version, snapshot.identity, cold=snapshot.cold)
+    
+    def _catch_up_locked(self, snapshot, version, identity):
+        """Применение изменений, сделанных другими процессами или в обход приложения (вызывается под self.lock).
+        
+        Если изменился только файл меток удаления, дочитываем новые метки; иначе файл данных
+        перезаписан целиком, и перечитываем его полностью.
+        """
+        data_identity, tombstone_identity, cold_identity = identity
+        cached_data_identity, cached_tombstone_identity, cached_cold_identity = snapshot.identity
+        if (data_identity != cached_data_identity or cold_identity != cached_cold_identity or tombstone_identity is None
+                or tombstone_identity[1] < self.tombstone_offset
+                or (cached_tombstone_identity is not None and tombstone_identity[0] != cached_tombstone_identity[0])):
+            return self._load_locked()
+        tombstones, self.tombstone_offset = _read_journal_entries(self.tombstone_file, self.tombstone_offset)
+        return self._publish_without_locked(snapshot, set(tombstones), version)
+    
+    def _publish_without_locked(self, snapshot, ticket_numbers, version):
+        """Публикация снимка без участников с указанными номерами (вызывается под self.lock)"""
+        participants = _without_tickets(snapshot.participants, ticket_numbers)
+        return self._publish_locked(participants, version, materialized=snapshot.materialized,
+                                    cold=snapshot.cold.with_deleted(ticket_numbers))
+    
+    def _get_locked(self, materialize=True):
+        """Актуальный снимок участников (вызывается под self.lock).
+        
+        Перед любым изменением догоняем записи других процессов, чтобы не затереть их.
+        С materialize=False достаточно актуального индекса телефонов.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self._load_locked()
+        else:
+            version = self.version_counter.get()
+            identity = self._disk_identity()
+            if snapshot.version != version or snapshot.identity != identity:
+                snapshot = self._catch_up_locked(snapshot, version, identity)
+        if materialize and not snapshot.materialized:
+            snapshot = self._materialize_locked(snapshot)
+        return snapshot
+    
+    def _current_snapshot(self, materialize):
+        """Снимок для чтения без ожидания писателей.
+        
+        Пока другой поток или процесс держит блокировку записи, читатель получает последний
+        опубликованный снимок: незавершённая запись в нём ещё не видна, но ждать её не нужно.
+        Если же с момента снимка уже завершилась чужая запись (общая версия выросла), читатель
+        дожидается блокировки, чтобы не потерять её: например, только что выданный номер.
+        """
+        # Версия читается раньше ссылки на снимок: писатель этого процесса публикует снимок
+        # до увеличения версии, поэтому его запись не будет принята за чужую
+        version = self.version_counter.get()
+        snapshot = self.snapshot
+        usable = snapshot is not None and (snapshot.materialized or not materialize)
+        if usable and snapshot.version >= version:
+            if snapshot.identity == self._disk_identity():
+                return snapshot
+            if not self.lock.acquire(blocking=False):
+                return snapshot
+        else:
+            self.lock.acquire()
+        
+        # Иначе загружаем из файла. Ошибку чтения не подменяем пустым списком:
+        # иначе повреждённый файл выглядел бы как розыгрыш без участников
+        try:
+            return self._get_locked(materialize)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке участников: {e}")
+            raise
+        finally:
+            self.lock.release()
+    
+    def load_all(self):
+        self._ensure_compactor()
+        # Неизменившиеся данные никогда не разбираются повторно; возвращается кортеж из снимка
+        # (с холодными сегментами - последовательность, распаковывающая их по требованию)
+        return self._current_snapshot(materialize=True).all_participants()
+    
+    def count(self):
+        # Длина снимка: после холодного старта записи не разбираются в ParticipantRecord
+        snapshot = self._current_snapshot(materialize=False)
+        return len(snapshot.cold) + len(snapshot.participants)
+    
+    def max_ticket_number(self):
+        snapshot = self._current_snapshot(materialize=False)
+        return max(_max_ticket_number(snapshot.participants), snapshot.cold.max_ticket)
+    
+    def _next_ticket_locked(self, snapshot):
+        """Выделение следующего номера участника (вызывается под self.lock)"""
+        last_ticket = self.ticket_counter.get()
+        if not self.ticket_counter_restored:
+            # Счётчик мог отстать от данных (первый запуск или сбой между записями),
+            # поэтому при первом выделении в процессе сверяем его с максимальным номером
+            last_ticket = max(last_ticket, _max_ticket_number(snapshot.participants), snapshot.cold.max_ticket,
+                              self.imported_last_ticket)
+            self.ticket_counter_restored = True
+        
+        ticket_number = last_ticket + 1
+        # Счётчик сохраняется раньше записи участника: сбой между ними даёт пропуск номера, но не повтор
+        self.ticket_counter.set(ticket_number)
+        return ticket_number
+    
+    def add_many(self, new_participants):
+        for participant in new_participants:
+            participant['phone_key'] = canonical_phone_key(participant.get('phone'))
+        with self.lock:
+            snapshot = self._get_locked(materialize=False)
+            results = []
+            accepted = []
+            batch_index = {}
+            for participant in new_participants:
+                phone_key = participant['phone_key']
+                existing = (snapshot.participants.find_by_phone(phone_key) or batch_index.get(phone_key)
+                            or snapshot.cold.find_by_phone(phone_key)) if phone_key else None
+                if existing is not None:
+                    results.append(PhoneAlreadyRegistered(existing))
+                    continue
+                participant['ticket_number'] = self._next_ticket_locked(snapshot)
+                participant['checksum'] = participant_checksum(participant)
+                results.append(participant['ticket_number'])
+                accepted.append(participant)
+                if phone_key:
+                    batch_index[phone_key] = participant
+            if not accepted:
+                return results
+            # Сначала сохраняем на диск, затем дописываем в список и публикуем новый снимок
+            self._persist_add(snapshot.participants, accepted)
+            for participant in accepted:
+                snapshot.participants.store.append(ParticipantRecord.from_dict(participant))
+            self._publish_locked(snapshot.participants.extended(), self._next_version_locked(),
+                                 materialized=snapshot.materialized)
+            return results
+    
+    def delete_tickets(self, ticket_numbers):
+        ticket_numbers = set(ticket_numbers)
+        with self.lock:
+            snapshot = self._get_locked(materialize=False)
+            removed = [ticket_number for ticket_number in sorted(number for number in ticket_numbers if isinstance(number, int))
+                       if snapshot.cold.has_ticket(ticket_number)]
+            # Горячие участники находятся по индексу номеров, без просмотра всего списка
+            store = snapshot.participants.store
+            removed.extend(store.get(position).get('ticket_number')
+                           for position in snapshot.participants.ticket_positions(ticket_numbers))
+            if not removed:
+                return []
+            self._persist_tombstones(removed)
+            self._publish_without_locked(snapshot, set(removed), self._next_version_locked())
+        self._ensure_compactor()
+        return removed
+    
+    def update_many(self, updates):
+        with self.lock:
+            snapshot = self._get_locked(materialize=False)
+            participants = snapshot.participants
+            changed = []
+            # Холодные сегменты неизменяемы; в них попадают только давно зарегистрированные участники
+            for position in participants.ticket_positions(updates):
+                participant = participants.store.get(position)
+                changed.append((position, _updated_participant(participant, updates[participant.get('ticket_number')])))
+            if not changed:
+                return []
+            updated = [record for _, record in changed]
+            # Вся пачка изменений сохраняется одной записью
+            self._persist_update(participants, updated)
+            for position, record in changed:
+                participants.store.replace(position, ParticipantRecord.from_dict(record))
+            self._publish_locked(participants, self._next_version_locked(), materialized=snapshot.materialized)
+        return [record['ticket_number'] for record in updated]
+    
+    def pending_verification(self):
+        # Холодные сегменты не распаковываются: проверки ждут только недавно зарегистрированные
+        snapshot = self._current_snapshot(materialize=False)
+        return [participant for participant in snapshot.participants if participant.get('verification') == 'pending']
+    
+    def clear(self):
+        with self.lock:
+            self._persist_clear()
+            # После удаления всех участников нумерация начинается заново
+            self.ticket_counter.set(0)
+            self.ticket_counter_restored = True
+            self._publish_locked(HotParticipants.build(()), self._next_version_locked(), cold=_EMPTY_COLD)
+    
+    def find_by_phone(self, phone):
+        phone_key = canonical_phone_key(phone)
+        if not phone_key:
+            return None
+        # После холодного старта отвечаем сразу по индексу, не дожидаясь создания
+        # компактных записей для всего списка; холодные участники зарегистрированы раньше
+        snapshot = self._current_snapshot(materialize=False)
+        return snapshot.cold.find_by_phone(phone_key) or snapshot.participants.find_by_phone(phone_key)
+    
+    def is_phone_registered(self, phone):
+        phone_key = canonical_phone_key(phone)
+        if not phone_key:
+            return False
+        # Проверка по индексу, без распаковки холодного сегмента
+        snapshot = self._current_snapshot(materialize=False)
+        return snapshot.participants.find_by_phone(phone_key) is not None or snapshot.cold.has_phone(phone_key)
+
+
+    def last_issued_ticket(self):
+        """Последний выданный номер с учётом удалённых участников (для импорта в другое хранилище)"""
+        tombstones = _read_journal_entries(self.tombstone_file)[0]
+        return max([self.ticket_counter.get()] + [number for number in tombstones if isinstance(number, int)])
+    
+    def iter_stored_records(self):
+        """Потоковое чтение записей в том виде, в каком они лежат на диске: сначала холодные сегменты"""
+        # Метки читаются раньше файла данных: уплотнение сбрасывает их только после перезаписи файла
+        tombstones = set(_read_journal_entries(self.tombstone_file)[0])
+        cold = ColdSegments.load(self.cold_dir)
+        for participant in cold.iter_records(raw=True):
+            if participant.get('ticket_number') not in tombstones:
+                yield participant
+        for participant in _iter_participants_file(self.data_file):
+            if not isinstance(participant, dict):
+                yield participant
+            elif participant.get('ticket_number') not in tombstones and not cold.has_ticket(participant.get('ticket_number')):
+                # Участники, уже перенесённые в холодные сегменты (остались после сбоя), пропускаются, как при загрузке
+                yield participant
+    
+    def verify(self, workers=0):
+        # Уплотнение на время проверки откладывается, чтобы не заменить читаемые файлы
+        with self.compaction_lock:
+            with self.lock:
+                snapshot = self._get_locked(materialize=False)
+            report, keys = verify_participant_records(self.iter_stored_records(), workers)
+            with self.lock:
+                current = self._get_locked(materialize=False)
+                # Индекс перестраивается, только если за время проверки данные не изменились
+                cold_count = len(current.cold)
+                report['index_rebuilt'] = (current.version == snapshot.version and current.identity == snapshot.identity
+                                           and len(keys) == cold_count + len(current.participants)
+                                           and not report['error'])
+                if report['index_rebuilt']:
+                    # Компактные записи вычисляют ключ телефона из самого телефона, как и проверка
+                    current = self._get_locked()
+                    self._publish_locked(HotParticipants.build(current.participants), current.version, current.identity)
+        return report
+    
+    def compact(self):
+        """Уплотнение: физическое удаление помеченных участников и перенос давно
+        зарегистрированных в холодные сегменты. Файл данных перезаписывается один раз
+        для всех меток, накопившихся с прошлого уплотнения"""
+        if not self.compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            with self.lock:
+                self._collect_cold_garbage_locked()
+                tombstone_identity = _file_identity(self.tombstone_file)
+                has_tombstones = tombstone_identity is not None and tombstone_identity[1] > 0
+                snapshot = self._get_locked(materialize=False)
+                moving = self._cold_prefix_length(snapshot.participants)
+                if not has_tombstones and not moving:
+                    return False
+                participants = snapshot.participants
+                cold = snapshot.cold
+                if moving or cold.deleted_positions:
+                    # Сначала холодные сегменты: после сбоя до перезаписи файла данных
+                    # перенесённые участники отбрасываются из него при загрузке по номерам
+                    cold = self._write_cold_locked(cold, participants[:moving])
+                    participants = HotParticipants.build(participants[moving:])
+                self._write_all(participants)
+                # Метки после перезаписи файлов больше не нужны; сбой между этими шагами безопасен:
+                # метки ссылаются на номера, которых в файлах уже нет
+                self._reset_tombstones()
+                # Удалённые участники физически убираются и из списка в памяти
+                self._publish_locked(participants.compacted(), self._next_version_locked(),
+                                     materialized=snapshot.materialized, cold=cold)
+            if moving:
+                logger.info(f"В холодные сегменты перенесено участников: {moving}, в памяти осталось: {len(participants)}")
+            if has_tombstones:
+                logger.info(f"Уплотнение файла участников: удалённые участники убраны из {self.data_file}")
+            return True
+        finally:
+            self.compaction_lock.release()
+    
+    def _cold_prefix_length(self, participants):
+        """Сколько первых горячих участников пора перенести в холодные сегменты (целыми сегментами)"""
+        if COLD_AFTER_DAYS <= 0:
+            return 0
+        cutoff = (datetime.now() - timedelta(days=COLD_AFTER_DAYS)).strftime(_REGISTRATION_TIME_FORMAT)
+        count = 0
+        for participant in participants:
+            registration_time = participant.get('registration_time')
+            # Время 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' сравнивается строкой; запись без времени считается старой
+            if isinstance(registration_time, str) and registration_time >= cutoff:
+                break
+            count += 1
+        return count - count % COLD_SEGMENT_RECORDS
+    
+    def _write_cold_locked(self, cold, moved):
+        """Запись нового состояния холодных сегментов (вызывается под self.lock).
+        
+        Сегменты с удалёнными участниками переписываются без них, moved дописываются новыми
+        сегментами по COLD_SEGMENT_RECORDS записей. Файлы не изменяются: манифест атомарно
+        заменяется новым, а выведенные из него сегменты удаляются позже. Возвращает ColdSegments.
+        """
+        os.makedirs(self.cold_dir, exist_ok=True)
+        manifest = _read_cold_manifest(self.cold_dir)
+        next_segment = manifest['next_segment']
+        segments = []
+        for index, segment in enumerate(cold.segments):
+            if not cold.deleted_in(index):
+                segments.append(segment)
+                continue
+            records = cold.live_records(index, raw=True)
+            if records:
+                segments.append(_write_cold_segment(self.cold_dir, next_segment, records))
+                next_segment += 1
+        for start in range(0, len(moved), COLD_SEGMENT_RECORDS):
+            segments.append(_write_cold_segment(self.cold_dir, next_segment, moved[start:start + COLD_SEGMENT_RECORDS]))
+            next_segment += 1
+        _write_cold_file(self.cold_dir, COLD_MANIFEST_NAME, {'next_segment': next_segment, 'segments': segments})
+        
+        files = {segment['file'] for segment in segments}
+        retired = _read_cold_file(self.cold_dir, COLD_RETIRED_NAME, [])
+        retired.extend({'file': segment['file'], 'retired_at': time.time()}
+                       for segment in manifest['segments'] if segment['file'] not in files)
+        _write_cold_file(self.cold_dir, COLD_RETIRED_NAME, retired)
+        return ColdSegments.load(self.cold_dir)
+    
+    def _collect_cold_garbage_locked(self):
+        """Удаление файлов сегментов, выведенных из манифеста больше COLD_RETIRED_GRACE секунд назад"""
+        retired = _read_cold_file(self.cold_dir, COLD_RETIRED_NAME, [])
+        now = time.time()
+        expired = [entry for entry in retired if now - entry['retired_at'] >= COLD_RETIRED_GRACE]
+        if not expired:
+            return
+        # Файлы, снова попавшие в манифест, не удаляются ни при каких условиях
+        files = {segment['file'] for segment in _read_cold_manifest(self.cold_dir)['segments']}
+        for entry in expired:
+            if entry['file'] in files:
+                continue
+            for extension in ('.pack', '.idx'):
+                try:
+                    os.remove(os.path.join(self.cold_dir, entry['file'] + extension))
+                except FileNotFoundError:
+                    pass
+        _write_cold_file(self.cold_dir, COLD_RETIRED_NAME, [entry for entry in retired if entry not in expired])
+    
+    def _ensure_compactor(self):
+        # Поток уплотнения запускается в каждом процессе gunicorn; одновременно работает только один
+        if self.compaction_thread is not None and self.compaction_thread.is_alive() and self.compaction_pid == os.getpid():
+            return
+        with self.compaction_start_lock:
+            if self.compaction_thread is not None and self.compaction_thread.is_alive() and self.compaction_pid == os.getpid():
+                return
+            self.compaction_pid = os.getpid()
+            self.compaction_thread = threading.Thread(target=self._compaction_loop, daemon=True)
+            self.compaction_thread.start()
+    
+    def _compaction_loop(self):
+        while True:
+            self.compaction_event.wait(SNAPSHOT_INTERVAL)
+            self.compaction_event.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Ошибка при уплотнении хранилища участников: {e}")
+
+
+class JournalParticipantStorage(JsonParticipantStorage):
+    """Снимок + журнал изменений: каждое изменение дописывается одной строкой в журнал.
+    
+    Журнал делится на поколения: JOURNAL_FILE (поколение 0), JOURNAL_FILE.1, JOURNAL_FILE.2 и т.д.
+    Фоновое уплотнение начинает новое поколение, записывает снимок всех участников
+    (SNAPSHOT_FILE, через временный файл и атомарное переименование) и удаляет журналы,
+    вошедшие в снимок. При запуске загружается последний снимок и применяется только хвост
+    журнала после него. Пока снимка нет, исходным импортом служит DATA_FILE.
+    """
+    name = 'journal'
+    
+    def __init__(self, data_file, journal_file, snapshot_file):
+        super().__init__(data_file)
+        self.journal_file = journal_file
+        self.snapshot_file = snapshot_file
+        # Предыдущий снимок хранится на случай, если последний окажется повреждён
+        self.previous_snapshot_file = snapshot_file + '.prev'
+        # Поколение журнала и байтовое смещение в нём, до которых операции применены к кэшу
+        self.journal_generation = 0
+        self.journal_offset = 0
+        # Поколение, с которого начинается журнал после загруженного снимка (None - снимка нет)
+        self.snapshot_generation = None
+    
+    def _log_path(self, generation):
+        return self.journal_file if generation == 0 else f"{self.journal_file}.{generation}"
+    
+    def _read_snapshot(self):
+        """Последний читаемый снимок: (участники, поколение журнала после снимка)"""
+        for path in (self.snapshot_file, self.previous_snapshot_file):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except FileNotFoundError:
+                continue
+            except ValueError as e:
+                logger.error(f"Снимок участников {path} повреждён, пробуем предыдущий: {e}")
+                continue
+            return snapshot['participants'], snapshot['log_generation']
+        
+        if os.path.exists(self.snapshot_file):
+            raise ValueError(f"Не удалось прочитать ни один снимок участников ({self.snapshot_file})")
+        return None, 0
+    
+    def _read_logs(self, participants, generation, offset):
+        """Применение журналов начиная с (generation, offset) до конца последнего поколения"""
+        while True:
+            entries, offset = _read_journal_entries(self._log_path(generation), offset)
+            for entry in entries:
+                participants = _apply_journal_entry(participants, entry)
+            if not os.path.exists(self._log_path(generation + 1)):
+                break
+            generation += 1
+            offset = 0
+        self.journal_generation = generation
+        self.journal_offset = offset
+        return participants
+    
+    def _read_from_disk(self):
+        # Снимок, запись которого прервалась вместе с процессом, остаётся временным файлом
+        _remove_stale_temp_files(self.snapshot_file)
+        _remove_stale_temp_files(self.previous_snapshot_file)
+        participants, generation = self._read_snapshot()
+        self.snapshot_generation = generation if participants is not None else None
+        if participants is None:
+            # Снимка ещё нет: исходным импортом служит хранилище режима 'json' - DATA_FILE
+            # вместе с холодными сегментами и без участников, помеченных удалёнными
+            source = JsonParticipantStorage(self.data_file)
+            participants = source.iter_stored_records()
+            self.imported_last_ticket = source.last_issued_ticket()
+        return self._read_logs(HotParticipants.build(participants), generation, 0)
+    
+    def _disk_identity(self):
+        # Пока снимка нет, отслеживаем исходный файл; снимки публикует только само приложение
+        base_identity = _file_identity(self.data_file) if self.snapshot_generation is None else None
+        return (base_identity, _file_identity(self._log_path(self.journal_generation)))
+    
+    def _catch_up_locked(self, snapshot, version, identity):
+        base_identity, log_identity = identity
+        cached_base_identity, cached_log_identity = snapshot.identity
+        log_missing = log_identity is None
+        # Дочитать хвост нельзя, если заменили исходный файл, если журнал текущего поколения
+        # заменили или обрезали, или если его уже удалило уплотнение в другом процессе
+        if (base_identity != cached_base_identity
+                or (log_missing and (self.journal_offset > 0
+                                     or os.path.exists(self._log_path(self.journal_generation + 1))))
+                or (not log_missing and cached_log_identity is not None
+                    and log_identity[0] != cached_log_identity[0])
+                or (not log_missing and log_identity[1] < self.journal_offset)
+                # Прошлое дочитывание прервалось ошибкой, успев дописать участников в список
+                or len(snapshot.participants.store.items) != snapshot.participants.length):
+            return self._load_locked()
+        
+        # Дочитываем только хвост журнала, записанный другими процессами: участники дописываются
+        # в общий список, опубликованный снимок их не видит до публикации нового
+        participants = self._read_logs(snapshot.participants, self.journal_generation, self.journal_offset)
+        return self._publish_locked(participants, version, materialized=snapshot.materialized)
+    
+    def _append(self, *entries):
+        """Дозапись операций в журнал одной записью с принудительным сбросом на диск"""
+        # Собственная запись уже применена к кэшу, поэтому сдвигаем смещение за неё
+        self.journal_offset = _append_json_lines(self._log_path(self.journal_generation), self.journal_offset, entries)
+        if self.journal_offset >= SNAPSHOT_MIN_LOG_BYTES:
+            self._ensure_compactor()
+            self.compaction_event.set()
+    
+    def _persist_add(self, participants, new_participants):
+        self._append(*({'op': 'add', 'participant': participant} for participant in new_participants))
+    
+    def _persist_update(self, participants, updated):
+        self._append(*({'op': 'update', 'participant': participant} for participant in updated))
+    
+    def _persist_tombstones(self, ticket_numbers):
+        self._append({'op': 'tombstone', 'ticket_numbers': ticket_numbers})
+    
+    def _persist_clear(self):
+        self._append({'op': 'clear'})
+    
+    def _log_bytes_since_snapshot(self):
+        # Поколение меняется только при уплотнении, поэтому всё после снимка лежит в текущем журнале
+        identity = _file_identity(self._log_path(self.journal_generation))
+        return identity[1] if identity is not None else 0
+    
+    def compact(self):
+        """Уплотнение: новый снимок всех участников и удаление вошедших в него журналов.
+        
+        Запись снимка идёт без блокировки хранилища, поэтому регистрации в это время не ждут.
+        """
+        if not self.compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            with self.lock:
+                current = self._get_locked(materialize=False)
+                if self._log_bytes_since_snapshot() < SNAPSHOT_MIN_LOG_BYTES:
+                    return False
+                # Новые изменения пойдут в следующее поколение журнала, а снимок
+                # будет точно соответствовать всем предыдущим поколениям
+                generation = self.journal_generation + 1
+                open(self._log_path(generation), 'ab').close()
+                self.journal_generation = generation
+                self.journal_offset = 0
+                # Дописанных после публикации участников снимок не видит, поэтому его можно записывать
+                # без копирования; участники, изменённые за это время, попадут в него уже изменёнными -
+                # повторное применение тех же изменений из журнала ничего не меняет. Удалённые
+                # участники убираются из списка, когда их накопилось много
+                state = current.participants
+                if len(state.holes) * 8 > state.length:
+                    state = state.compacted()
+                self._publish_locked(state, self._next_version_locked(), materialized=current.materialized)
+            
+            started = time.monotonic()
+            snapshot = {'log_generation': generation, 'participants': state}
+            if os.path.exists(self.snapshot_file):
+                # Текущий снимок становится предыдущим; SNAPSHOT_FILE при этом не исчезает ни на миг
+                previous_tmp = f"{self.previous_snapshot_file}.tmp.{os.getpid()}"
+                if os.path.exists(previous_tmp):
+                    os.remove(previous_tmp)
+                os.link(self.snapshot_file, previous_tmp)
+                os.replace(previous_tmp, self.previous_snapshot_file)
+            _write_file_atomically(self.snapshot_file, lambda f: json.dump(
+                snapshot, f, ensure_ascii=False, separators=(',', ':'), default=_participant_json_default))
+            
+            # Журналы нужны начиная с поколения предыдущего снимка (на случай отката к нему)
+            keep_from = self._previous_snapshot_generation()
+            with self.lock:
+                for old_generation in range(0, keep_from):
+                    try:
+                        os.remove(self._log_path(old_generation))
+                    except FileNotFoundError:
+                        pass
+            logger.info(f"Снимок участников записан: {len(state)} участников, поколение журнала {generation}, "
+                        f"{time.monotonic() - started:.2f} сек.")
+            return True
+        finally:
+            self.compaction_lock.release()
+    
+    def iter_stored_records(self):
+        # Отдельный экземпляр, чтобы чтение не сдвигало поколение и смещение журнала этого хранилища
+        reader = JournalParticipantStorage(self.data_file, self.journal_file, self.snapshot_file)
+        return iter(reader._read_from_disk())
+    
+    def _previous_snapshot_generation(self):
+        try:
+            with open(self.previous_snapshot_file, 'r', encoding='utf-8') as f:
+                return json.load(f)['log_generation']
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0
+    
+class SqliteParticipantStorage(ParticipantStorage):
+    """Участники хранятся в SQLite (режим WAL) с индексами по телефону и номеру участника.
+    
+    Одну базу могут безопасно использовать несколько процессов gunicorn.
+    """
+    name = 'sqlite'
+    
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS participants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_number INTEGER,
+            phone_digits TEXT NOT NULL,
+            phone_key TEXT,
+            data TEXT NOT NULL
+        )''',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    ]
+    
+    INDEXES = [
+        'CREATE INDEX IF NOT EXISTS idx_participants_phone_key ON participants(phone_key)',
+        'CREATE INDEX IF NOT EXISTS idx_participants_ticket_number ON participants(ticket_number)',
+    ]
+    
+    def __init__(self, db_file, import_file=None, import_journal_file=None, import_snapshot_file=None):
+        self.db_file = db_file
+        # Соединение открывается отдельно для каждого потока (и заново после fork)
+        self.local = threading.local()
+        # Снимок полного списка (ParticipantSnapshot), действителен пока не изменилась версия в таблице meta
+        self.snapshot = None
+        self.cache_lock = threading.Lock()
+        self._init_db(import_file, import_journal_file, import_snapshot_file or SNAPSHOT_FILE)
+    
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        # Соединение, открытое до fork (например, импортом в мастер-процессе gunicorn с --preload),
+        # в рабочем процессе не используется: SQLite не допускает общих соединений между процессами
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # FULL: каждая транзакция сбрасывается на диск до COMMIT, поэтому сохранённая регистрация
+            # (в том числе пачка GROUP_COMMIT) переживает и отключение питания, а не только сбой процесса
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+    
+    def _init_db(self, import_file, import_journal_file, import_snapshot_file):
+        conn = self._connect()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        self._migrate_phone_key(conn)
+        for statement in self.INDEXES:
+            conn.execute(statement)
+        
+        # Миграция из JSON выполняется один раз; BEGIN IMMEDIATE не даёт
+        # двум процессам импортировать данные одновременно
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            migrated = conn.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone()
+            if migrated is None:
+                participants = []
+                source = None
+                if import_journal_file:
+                    # Текущее состояние режима 'journal': снимок (или хранилище режима 'json') и хвост журнала
+                    source = JournalParticipantStorage(import_file, import_journal_file, import_snapshot_file)
+                    participants = source._read_from_disk()
+                elif import_file:
+                    # Хранилище режима 'json': DATA_FILE, холодные сегменты, без помеченных удалёнными
+                    source = JsonParticipantStorage(import_file)
+                    participants = source.iter_stored_records()
+                imported = 0
+                for participant in participants:
+                    self._insert(conn, participant)
+                    imported += 1
+                if source is not None:
+                    # Номера, выданные до перехода (в том числе уже удалённым участникам), не выдаются повторно
+                    issued = max(source.ticket_counter.get(), source.imported_last_ticket)
+                    if not import_journal_file:
+                        issued = max(issued, source.last_issued_ticket())
+                    self._set_last_ticket(conn, max(self._last_ticket(conn), issued))
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)",
+                             (import_file or '',))
+                self._bump_version(conn)
+                logger.info(f"Импортировано участников в SQLite из {import_file}: {imported}")
+            # Счётчик номеров не может быть меньше уже выданных номеров
+            self._set_last_ticket(conn, max(self._last_ticket(conn), self._max_stored_ticket(conn)))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def _migrate_phone_key(self, conn):
+        """Добавление столбца phone_key в базы, созданные до появления канонического ключа"""
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(participants)')]
+        if 'phone_key' in columns:
+            return
+        
+        logger.info("Добавляем столбец phone_key в таблицу participants")
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('ALTER TABLE participants ADD COLUMN phone_key TEXT')
+            rows = conn.execute('SELECT id, data FROM participants').fetchall()
+            conn.executemany(
+                'UPDATE participants SET phone_key = ? WHERE id = ?',
+                [(participant_phone_key(json.loads(data)), row_id) for row_id, data in rows]
+            )
+            self._bump_version(conn)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def _insert(self, conn, participant):
+        participant['phone_key'] = participant_phone_key(participant)
+        ticket_number = participant.get('ticket_number')
+        conn.execute(
+            'INSERT INTO participants (ticket_number, phone_digits, phone_key, data) VALUES (?, ?, ?, ?)',
+            (ticket_number if isinstance(ticket_number, int) else None,
+             normalize_phone(participant.get('phone')),
+             participant['phone_key'],
+             json.dumps(participant, ensure_ascii=False, default=_participant_json_default))
+        )
+    
+    def _bump_version(self, conn):
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+    
+    def _last_ticket(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'last_ticket'").fetchone()
+        return int(row[0]) if row else 0
+    
+    def _set_last_ticket(self, conn, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_ticket', ?)", (str(value),))
+    
+    def _max_stored_ticket(self, conn):
+        row = conn.execute('SELECT MAX(ticket_number) FROM participants').fetchone()
+        return row[0] or 0
+    
+    def _version(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
+    
+    def load_all(self):
+        conn = self._connect()
+        version = self._version(conn)
+        
+        # Список перечитывается только если данные изменились (в т.ч. другим процессом)
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot.participants
+        
+        with self.cache_lock:
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.version == version:
+                return snapshot.participants
+            # Версия и список читаются в одной транзакции чтения (WAL не блокирует её писателями)
+            conn.execute('BEGIN')
+            try:
+                version = self._version(conn)
+                participants = tuple(
+                    ParticipantRecord.from_dict(json.loads(row[0]))
+                    for row in conn.execute('SELECT data FROM participants ORDER BY id')
+                )
+            finally:
+                conn.execute('COMMIT')
+            self.snapshot = ParticipantSnapshot(participants, version, None, True)
+            return participants
+    
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM participants').fetchone()[0]
+    
+    def add_many(self, participants):
+        conn = self._connect()
+        # BEGIN IMMEDIATE берёт блокировку записи сразу, поэтому номера выделяются
+        # и сохраняются одной транзакцией без гонок между потоками и процессами
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ticket_number = self._last_ticket(conn)
+            results = []
+            batch_index = {}
+            for participant in participants:
+                phone_key = participant_phone_key(participant)
+                existing = batch_index.get(phone_key) if phone_key else None
+                if phone_key and existing is None:
+                    row = conn.execute(
+                        'SELECT data FROM participants WHERE phone_key = ? ORDER BY id LIMIT 1',
+                        (phone_key,)
+                    ).fetchone()
+                    existing = json.loads(row[0]) if row else None
+                if existing is not None:
+                    results.append(PhoneAlreadyRegistered(existing))
+                    continue
+                ticket_number += 1
+                participant['ticket_number'] = ticket_number
+                participant['checksum'] = participant_checksum(participant)
+                self._insert(conn, participant)
+                results.append(ticket_number)
+                if phone_key:
+                    batch_index[phone_key] = participant
+            self._set_last_ticket(conn, ticket_number)
+            self._bump_version(conn)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return results
+    
+    def delete_tickets(self, ticket_numbers):
+        # Удаление по индексу ticket_number не перезаписывает таблицу, поэтому меток здесь не нужно
+        ticket_numbers = list(set(ticket_numbers))
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            removed = []
+            # Номера передаются пачками, чтобы не превысить лимит параметров SQLite
+            for start in range(0, len(ticket_numbers), 500):
+                chunk = ticket_numbers[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                removed.extend(row[0] for row in conn.execute(
+                    f'SELECT ticket_number FROM participants WHERE ticket_number IN ({placeholders}) ORDER BY id', chunk))
+                conn.execute(f'DELETE FROM participants WHERE ticket_number IN ({placeholders})', chunk)
+            if removed:
+                self._bump_version(conn)
+            conn.execute('COMMIT')
+            return removed
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def update_many(self, updates):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            updated = []
+            for ticket_number, changes in updates.items():
+                row = conn.execute('SELECT id, data FROM participants WHERE ticket_number = ? ORDER BY id LIMIT 1',
+                                   (ticket_number,)).fetchone()
+                if row is None:
+                    continue
+                participant = _updated_participant(json.loads(row[1]), changes)
+                conn.execute('UPDATE participants SET data = ? WHERE id = ?',
+                             (json.dumps(participant, ensure_ascii=False, default=_participant_json_default), row[0]))
+                updated.append(ticket_number)
+            if updated:
+                self._bump_version(conn)
+            conn.execute('COMMIT')
+            return updated
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def pending_verification(self):
+        # Отбор средствами SQLite, без разбора JSON всех участников
+        return [json.loads(row[0]) for row in self._connect().execute(
+            "SELECT data FROM participants WHERE json_extract(data, '$.verification') = 'pending' ORDER BY id")]
+    
+    def clear(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM participants')
+            # После удаления всех участников нумерация начинается заново
+            self._set_last_ticket(conn, 0)
+            self._bump_version(conn)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def is_phone_registered(self, phone):
+        phone_key = canonical_phone_key(phone)
+        if not phone_key:
+            return False
+        row = self._connect().execute(
+            'SELECT 1 FROM participants WHERE phone_key = ? LIMIT 1',
+            (phone_key,)
+        ).fetchone()
+        return row is not None
+    
+    def find_by_phone(self, phone):
+        phone_key = canonical_phone_key(phone)
+        if not phone_key:
+            return None
+        row = self._connect().execute(
+            'SELECT data FROM participants WHERE phone_key = ? ORDER BY id LIMIT 1',
+            (phone_key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def max_ticket_number(self):
+        return self._max_stored_ticket(self._connect())
+    
+    def verify(self, workers=0):
+        conn = self._connect()
+        # Версия и все строки читаются в одной транзакции чтения; JSON разбирается уже в процессах проверки
+        conn.execute('BEGIN')
+        try:
+            version = self._version(conn)
+            report, keys = verify_participant_records(
+                (row[0] for row in conn.execute('SELECT data FROM participants ORDER BY id')), workers)
+        finally:
+            conn.execute('COMMIT')
+        
+        # Перестроение: столбцы ticket_number и phone_key приводятся к данным записей, затем REINDEX
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT id, ticket_number, phone_key FROM participants ORDER BY id').fetchall()
+            report['index_rebuilt'] = self._version(conn) == version and len(rows) == len(keys)
+            if report['index_rebuilt']:
+                updates = []
+                for (row_id, stored_ticket, stored_phone_key), (ticket_number, phone_key) in zip(rows, keys):
+                    if phone_key is None:
+                        continue
+                    ticket_number = ticket_number if isinstance(ticket_number, int) else None
+                    if (stored_ticket, stored_phone_key) != (ticket_number, phone_key):
+                        updates.append((ticket_number, phone_key, row_id))
+                if updates:
+                    conn.executemany('UPDATE participants SET ticket_number = ?, phone_key = ? WHERE id = ?', updates)
+                    self._bump_version(conn)
+                    logger.warning(f"Исправлены столбцы индексов у {len(updates)} участников")
+                conn.execute('REINDEX participants')
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return report
+
+
+def create_participant_storage(backend, data_file=DATA_FILE, journal_file=JOURNAL_FILE,
+                               snapshot_file=SNAPSHOT_FILE, sqlite_file=SQLITE_FILE):
+    """Создание хранилища участников по имени из STORAGE_BACKEND"""
+    if DATA_FORMAT not in ('json', 'packed'):
+        raise ValueError(f"Неизвестное значение DATA_FORMAT: {DATA_FORMAT}")
+    if DATA_COMPRESSION not in PACKED_COMPRESSIONS:
+        raise ValueError(f"Неизвестное значение DATA_COMPRESSION: {DATA_COMPRESSION}")
+    if COLD_COMPRESSION not in PACKED_COMPRESSIONS:
+        raise ValueError(f"Неизвестное значение COLD_COMPRESSION: {COLD_COMPRESSION}")
+    if COLD_SEGMENT_RECORDS <= 0:
+        raise ValueError("COLD_SEGMENT_RECORDS должно быть больше нуля")
+    if backend == 'json':
+        return JsonParticipantStorage(data_file)
+    if backend == 'journal':
+        return JournalParticipantStorage(data_file, journal_file, snapshot_file)
+    if backend == 'sqlite':
+        return SqliteParticipantStorage(
+            sqlite_file,
+            import_file=data_file,
+            import_journal_file=journal_file,
+            import_snapshot_file=snapshot_file
+        )
+    raise ValueError(f"Неизвестное значение STORAGE_BACKEND: {backend}")
+
+
+class GroupCommitter:
+    """Групповая запись регистраций.
+    
+    Запросы ставятся в очередь, фоновый поток собирает их в пачку (до max_batch штук
+    или max_latency секунд с момента первого запроса) и сохраняет одной записью.
+    Каждый запрос ждёт, пока его пачка не будет сохранена на диск.
+    """
+    
+    # Сколько запрос ждёт сохранения своей пачки, прежде чем сообщить, что её судьба неизвестна
+    WAIT_TIMEOUT = 30
+    
+    def __init__(self, storage, max_latency, max_batch):
+        self.storage = storage
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+    
+    def _ensure_started(self):
+        # Поток запускается в каждом процессе gunicorn при первой регистрации
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            logger.info(f"Запущен поток групповой записи (пачка до {self.max_batch}, задержка до {self.max_latency * 1000:.0f} мс)")
+    
+    def submit(self, participant):
+        """Сохранение участника в составе ближайшей пачки. Возвращает номер участника
+        или выбрасывает PhoneAlreadyRegistered, как ParticipantStorage.add.
+        
+        Если пачка не записана за WAIT_TIMEOUT секунд, выбрасывает RegistrationStateUnknown:
+        участник остаётся в очереди и может быть сохранён позже, поэтому это не отказ.
+        """
+        self._ensure_started()
+        pending = {
+            'participant': participant,
+            'done': threading.Event(),
+            'ticket_number': None,
+            'error': None
         }
+        self.queue.put(pending)
+        if not pending['done'].wait(self.WAIT_TIMEOUT):
+            raise RegistrationStateUnknown("Не дождались сохранения регистрации: она может быть сохранена позже")
+        if pending['error'] is not None:
+            raise pending['error']
+        return pending['ticket_number']
+    
+    def _collect_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    # Задержка истекла, забираем только то, что уже стоит в очереди
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                results = self.storage.add_many([pending['participant'] for pending in batch])
+                for pending, result in zip(batch, results):
+                    if isinstance(result, PhoneAlreadyRegistered):
+                        pending['error'] = result
+                    else:
+                        pending['ticket_number'] = result
+            except Exception as e:
+                logger.error(f"Ошибка при групповой записи {len(batch)} регистраций: {e}")
+                for pending in batch:
+                    pending['error'] = e
+            finally:
+                for pending in batch:
+                    pending['done'].set()
 
-@lru_cache(maxsize=128)
-def get_location_from_coordinates(lat, lng):
-    """Получение информации о местоположении по координатам с использованием нескольких методов"""
-    try:
-        logger.info(f"Определение местоположения по координатам: {lat}, {lng}")
-        
-        # Прямой запрос к OpenStreetMap Nominatim API
-        try:
-            logger.info(f"Пробуем определить через прямой запрос к OSM API")
-            response = requests.get(
-                f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lng}&zoom=18&addressdetails=1",
-                headers={'User-Agent': 'CarRaffle/1.0'},
-                timeout=5
+
+class IdempotencyTable:
+    """Ограниченная таблица ключей идемпотентности с временем жизни.
+    
+    Первый запрос с ключом выполняется, остальные с тем же ключом ждут его завершения
+    и получают тот же результат. Неуспешный результат не запоминается, чтобы повтор
+    мог выполниться заново. Таблица своя в каждом процессе; повтор, попавший в другой
+    процесс gunicorn, распознаётся по ключу, сохранённому вместе с участником.
+    """
+    
+    # Сколько повтор ждёт завершения первого запроса с тем же ключом
+    WAIT_TIMEOUT = 30
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Ключ -> запись; время жизни у всех одинаковое, поэтому порядок вставки совпадает с порядком истечения
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def _purge_locked(self, now):
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry['expires'] > now and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+    
+    def begin(self, key):
+        """Начало запроса с ключом. Возвращает (запись, True), если запрос нужно выполнить"""
+        now = time.monotonic()
+        with self.lock:
+            self._purge_locked(now)
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry, False
+            entry = {'expires': now + self.ttl, 'done': threading.Event(), 'result': None}
+            self.entries[key] = entry
+            self._purge_locked(now)
+            return entry, True
+    
+    def wait(self, entry):
+        """Результат первого запроса с тем же ключом (None, если он завершился неуспешно)"""
+        entry['done'].wait(self.WAIT_TIMEOUT)
+        return entry['result']
+    
+    def finish(self, key, entry, result):
+        entry['result'] = result
+        if result is None:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+        entry['done'].set()
+
+
+RAFFLE_ID_PATTERN = re.compile(r'^[a-z0-9_-]{1,32}$')
+
+class Raffle:
+    """Раздел одного розыгрыша: хранилище участников (со своим счётчиком номеров),
+    настройки, разрешённые города, групповая запись и ключи идемпотентности.
+    
+    У каждого раздела свои блокировки и кэши, поэтому нагрузка на один розыгрыш
+    не задерживает остальные.
+    """
+    
+    def __init__(self, raffle_id, storage, settings_file):
+        self.id = raffle_id
+        self.storage = storage
+        self.settings_file = settings_file
+        self.settings_lock = threading.Lock()
+        # Кэш для настроек с временем жизни
+        self.settings_cache = {
+            'data': None,
+            'timestamp': 0
+        }
+        self.allowed_cities_cache = (None, DEFAULT_ALLOWED_CITIES)
+        self.group_committer = None
+        if GROUP_COMMIT:
+            self.group_committer = GroupCommitter(
+                storage,
+                max_latency=GROUP_COMMIT_MAX_LATENCY_MS / 1000,
+                max_batch=GROUP_COMMIT_MAX_BATCH
             )
-            if response.status_code == 200:
-                data = response.json()
-                logger.info(f"Данные от OSM API: {data}")
-                if 'address' in data:
-                    city = data['address'].get('city', '').lower()
-                    if not city:
-                        city = data['address'].get('town', '').lower()
-                    if not city:
-                        city = data['address'].get('village', '').lower()
-                    if not city and 'state' in data['address'] and 'дагестан' in data['address']['state'].lower():
-                        city = 'махачкала'
-                        
-                    logger.info(f"Определен город через OSM API: {city}")
-                    
-                    return {
-                        'city': city,
-                        'region': data['address'].get('state', ''),
-                        'country': data['address'].get('country', '')
-                    }
-        except Exception as e:
-            logger.error(f"Ошибка при использовании OSM API: {e}")
+        self.registration_requests = IdempotencyTable(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL)
+        # Обход участников, ожидающих проверки местоположения, выполняет один процесс
+        self.verification_lock = InterProcessLock(os.path.splitext(settings_file)[0] + '.verification.lock')
         
-        # Создаем геокодер geopy
-        logger.info(f"Пробуем определить через geopy")
-        geolocator = Nominatim(user_agent="car_raffle_app_v2")
-        
-        # Получаем информацию о местоположении по координатам
-        location = geolocator.reverse(f"{lat}, {lng}", timeout=5)
+        # Создаем файл настроек, если он не существует
+        if not os.path.exists(settings_file):
+            settings = copy.deepcopy(DEFAULT_SETTINGS)
+            settings['backup_settings'] = copy.deepcopy(BACKUP_SETTINGS)
+            self.save_settings(settings)
+    
+    @classmethod
+    def create(cls, raffle_id):
+        """Дополнительный розыгрыш: все файлы в каталоге RAFFLES_DIR/<id>"""
+        directory = os.path.join(RAFFLES_DIR, raffle_id)
+        os.makedirs(directory, exist_ok=True)
+        data_file = os.path.join(directory, 'participants.json')
+        storage = create_participant_storage(
+            STORAGE_BACKEND,
+            data_file=data_file,
+            journal_file=os.path.join(directory, 'participants.jsonl'),
+            snapshot_file=os.path.join(directory, 'participants.snapshot.json'),
+            sqlite_file=os.path.join(directory, 'participants.db')
+        )
+        return cls(raffle_id, storage, os.path.join(directory, 'settings.json'))
+    
+    @property
+    def is_default(self):
+        return self.id is None
+    
+    @property
+    def url_prefix(self):
+        """Префикс адресов розыгрыша ('' для основного)"""
+        return '' if self.is_default else f'/r/{self.id}'
+    
+    def load_settings(self):
+        """Загрузка настроек из файла с кэшированием"""
+        current_time = datetime.now().timestamp()
+        cache = self.settings_cache
         
-        if location and location.raw.get('address'):
-            address_data = location.raw['address']
-            logger.info(f"Данные от geopy: {address_data}")
-            
-            city = address_data.get('city', '').lower()
-            if not city:
-                city = address_data.get('town', '').lower()
-            if not city:
-                city = address_data.get('village', '').lower()
-            if not city and 'locality' in address_data:
-                city = address_data.get('locality', '').lower()
-            if not city and 'suburb' in address_data:
-                city = address_data.get('suburb', '').lower()
-            
-            # Проверка на районы Махачкалы
-            if not city and 'state' in address_data and 'state_district' in address_data:
-                state = address_data.get('state', '').lower()
-                district = address_data.get('state_district', '').lower()
-                if 'дагестан' in state and ('махачкала' in district or 'махачкалинский' in district):
-                    city = 'махачкала'
-                    
-            # Запасной вариант для Дагестана
-            if not city and 'state' in address_data and 'дагестан' in address_data.get('state', '').lower():
-                # Проверяем попадание в координаты Махачкалы (грубое приближение)
-                if 42.9 <= float(lat) <= 43.1 and 47.3 <= float(lng) <= 47.6:
-                    city = 'махачкала'
-            
-            logger.info(f"Определен город через geopy: {city}")
-                    
-            return {
-                'city': city,
-                'region': address_data.get('state', ''),
-                'country': address_data.get('country', '')
-            }
-        else:
-            logger.warning(f"Geopy не вернул данных для координат {lat}, {lng}")
+        # Если есть актуальные данные в кэше, возвращаем их
+        if cache['data'] is not None and current_time - cache['timestamp'] < SETTINGS_CACHE_TTL:
+            return cache['data']
         
-        # Проверка попадания в область Махачкалы (грубый вариант)
-        if 42.9 <= float(lat) <= 43.1 and 47.3 <= float(lng) <= 47.6:
-            logger.info(f"Координаты {lat}, {lng} попадают в регион Махачкалы")
-            return {
-                'city': 'махачкала',
-                'region': 'Дагестан',
-                'country': 'Россия'
-            }
+        # Иначе загружаем из файла
+        with self.settings_lock:
+            try:
+                with open(self.settings_file, 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except Exception:
+                # В случае ошибки возвращаем настройки по умолчанию
+                settings = copy.deepcopy(DEFAULT_SETTINGS)
+            # Обновляем кэш
+            cache['data'] = settings
+            cache['timestamp'] = current_time
+            return settings
+    
+    def save_settings(self, settings_data):
+        """Сохранение настроек в файл"""
+        with self.settings_lock:
+            with open(self.settings_file, 'w', encoding='utf-8') as f:
+                json.dump(settings_data, f, ensure_ascii=False, indent=4)
             
-        # В случае неудачи, возвращаем данные по умолчанию
-        logger.warning(f"Не удалось определить город по координатам, возвращаем данные по умолчанию")
-        return {
-            'city': 'неизвестный город',
-            'region': 'неизвестный регион',
-            'country': 'Россия'
-        }
-    except Exception as e:
-        logger.error(f"Критическая ошибка при определении местоположения по координатам: {e}")
-        # Безопасное возвращение значения по умолчанию в случае ошибки
-        return {
-            'city': 'неизвестный город',
-            'region': 'неизвестный регион',
-            'country': 'Россия'
-        }
+            # Обновляем кэш
+            self.settings_cache['data'] = settings_data
+            self.settings_cache['timestamp'] = datetime.now().timestamp()
+    
+    def allowed_cities(self):
+        """Разрешённые города: список allowed_cities из настроек розыгрыша или ALLOWED_CITIES"""
+        cities = self.load_settings().get('allowed_cities') or None
+        source, allowed = self.allowed_cities_cache
+        if cities is not source:
+            allowed = frozenset(city.strip().lower() for city in cities) if cities else DEFAULT_ALLOWED_CITIES
+            self.allowed_cities_cache = (cities, allowed)
+        return allowed
+    
+    def ticket_session_key(self):
+        """Ключ сессии с номером участника: у каждого розыгрыша свой номер"""
+        return 'ticket_number' if self.is_default else f'ticket_number:{self.id}'
 
-# Кэш для участников с временем жизни
-participants_cache = {
-    'data': None,
-    'timestamp': 0
-}
-PARTICIPANTS_CACHE_TTL = 60  # 60 секунд
+
+def _create_raffles():
+    raffles = collections.OrderedDict()
+    raffles[None] = Raffle(None, create_participant_storage(STORAGE_BACKEND), SETTINGS_FILE)
+    for raffle_id in RAFFLE_IDS:
+        if not RAFFLE_ID_PATTERN.match(raffle_id):
+            raise ValueError(f"Недопустимый идентификатор розыгрыша в RAFFLE_IDS: {raffle_id}")
+        if raffle_id not in raffles:
+            raffles[raffle_id] = Raffle.create(raffle_id)
+    return raffles
+
+raffles = _create_raffles()
+default_raffle = raffles[None]
+# Хранилище основного розыгрыша (для скриптов обслуживания)
+participant_storage = default_raffle.storage
+logger.info(f"Хранилище участников: {participant_storage.name}, розыгрышей: {len(raffles)}")
+
+def current_raffle():
+    """Розыгрыш текущего запроса (вне запроса - основной)"""
+    if has_request_context():
+        return g.get('raffle', default_raffle)
+    return default_raffle
+
+# Префикс адресов дополнительного розыгрыша; маршруты с ним добавляются в конце модуля
+RAFFLE_URL_PREFIX = '/r/<raffle_id>'
+
+@app.url_value_preprocessor
+def pull_raffle_id(endpoint, values):
+    """Выбор розыгрыша по префиксу адреса /r/<raffle_id>"""
+    raffle_id = values.pop('raffle_id', None) if values else None
+    if raffle_id is None:
+        g.raffle = default_raffle
+        return
+    raffle = raffles.get(raffle_id)
+    if raffle is None:
+        abort(404)
+    g.raffle = raffle
+
+@app.url_defaults
+def add_raffle_id(endpoint, values):
+    """url_for внутри дополнительного розыгрыша строит адреса с его префиксом"""
+    if 'raffle_id' in values or endpoint == 'static':
+        return
+    raffle = current_raffle()
+    if not raffle.is_default and app.url_map.is_endpoint_expecting(endpoint, 'raffle_id'):
+        values['raffle_id'] = raffle.id
+
+@app.context_processor
+def inject_raffle():
+    """Префикс адресов текущего розыгрыша для запросов fetch в шаблонах"""
+    raffle = current_raffle()
+    return {'raffle_id': raffle.id, 'raffle_prefix': raffle.url_prefix}
 
 def load_participants():
-    """Загрузка данных участников из файла с кэшированием"""
-    global participants_cache
-    current_time = datetime.now().timestamp()
-    
-    # Если есть актуальные данные в кэше, возвращаем их
-    if participants_cache['data'] is not None and current_time - participants_cache['timestamp'] < PARTICIPANTS_CACHE_TTL:
-        return participants_cache['data']
-    
-    # Иначе загружаем из файла
-    with data_lock:
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                participants = json.load(f)
-                # Обновляем кэш
-                participants_cache['data'] = participants
-                participants_cache['timestamp'] = current_time
-                return participants
-        except:
-            return []
+    """Загрузка данных участников с кэшированием"""
+    return current_raffle().storage.load_all()
+
+def count_participants():
+    """Количество зарегистрированных участников"""
+    return current_raffle().storage.count()
 
 def save_participant(participant_data):
-    """Сохранение данных участника в файл"""
-    with data_lock:
-        participants = load_participants()
-        participants.append(participant_data)
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(participants, f, ensure_ascii=False, indent=4)
-        
-        # Обновляем кэш
-        participants_cache['data'] = participants
-        participants_cache['timestamp'] = datetime.now().timestamp()
+    """Сохранение данных участника. Номер участника выделяется атомарно вместе с записью.
+    
+    Если телефон уже зарегистрирован, выбрасывает PhoneAlreadyRegistered.
+    """
+    raffle = current_raffle()
+    if raffle.group_committer is not None:
+        return raffle.group_committer.submit(participant_data)
+    return raffle.storage.add(participant_data)
+
+def remove_participants(ticket_numbers):
+    """Удаление участников по номерам. Возвращает список удалённых номеров"""
+    return current_raffle().storage.delete_tickets(ticket_numbers)
+
+def remove_all_participants():
+    """Удаление всех участников"""
+    current_raffle().storage.clear()
+
+def verify_participants(workers=None, raffle=None):
+    """Проверка целостности хранилища участников и перестроение индексов; возвращает отчёт"""
+    raffle = raffle or current_raffle()
+    report = raffle.storage.verify(VERIFY_WORKERS if workers is None else workers)
+    problems = _verification_problems(report)
+    log = logger.warning if problems else logger.info
+    log(f"Проверка участников: {report['records']} записей, проблем {problems}, "
+        f"без контрольной суммы {report['without_checksum']}, {report['elapsed']:.2f} сек.")
+    return report
 
 def is_phone_registered(phone):
     """Проверка, зарегистрирован ли уже данный номер телефона"""
-    participants = load_participants()
-    # Нормализуем телефон для сравнения (удаляем все, кроме цифр)
-    normalized_phone = ''.join(filter(str.isdigit, phone))
-    
-    for participant in participants:
-        normalized_participant_phone = ''.join(filter(str.isdigit, participant['phone']))
-        if normalized_participant_phone == normalized_phone:
-            return True
-    return False
+    return current_raffle().storage.is_phone_registered(phone)
+
+def find_participant_by_phone(phone):
+    """Поиск участника по номеру телефона"""
+    return current_raffle().storage.find_by_phone(phone)
 
 def get_ticket_by_phone(phone):
     """Получение данных участника по номеру телефона"""
-    participants = load_participants()
-    # Нормализуем телефон для сравнения (удаляем все, кроме цифр)
-    normalized_phone = ''.join(filter(str.isdigit, phone))
-    
-    for participant in participants:
-        # Убедимся, что у участника есть номер телефона
-        if not participant.get('phone'):
-            continue
-            
-        normalized_participant_phone = ''.join(filter(str.isdigit, participant['phone']))
-        
-        # Сначала проверяем точное совпадение
-        if normalized_participant_phone == normalized_phone:
-            return {
-                'ticket_number': participant.get('ticket_number'),
-                'full_name': participant.get('full_name')
-            }
-        
-        # Если номера имеют разную длину, но последние 10 цифр совпадают 
-        # (разные форматы записи российских номеров: +7/8 в начале)
-        if (len(normalized_participant_phone) >= 10 and len(normalized_phone) >= 10 and 
-            normalized_participant_phone[-10:] == normalized_phone[-10:]):
-            return {
-                'ticket_number': participant.get('ticket_number'),
-                'full_name': participant.get('full_name')
-            }
+    participant = current_raffle().storage.find_by_phone(phone)
+    if participant is None:
+        return None
+    return {
+        'ticket_number': participant.get('ticket_number'),
+        'full_name': participant.get('full_name'),
+        'verification': participant.get('verification', 'confirmed')
+    }
+
+def check_registration_location(latitude, longitude, ip_address, raffle=None):
+    """Проверка места регистрации: сначала по координатам, затем по IP.
+    Возвращает (разрешено ли участие, местоположение)"""
+    location = None
+    if latitude and longitude:
+        location = get_location_from_coordinates(latitude, longitude, raffle)
+        if location and check_location_allowed(location.get('city', '').lower(), raffle):
+            return True, location
     
-    return None
+    # Если координаты не предоставлены или не удалось определить местоположение,
+    # пробуем определить по IP
+    if ip_address == '127.0.0.1':  # Для локальной разработки
+        return True, location
+    if not ip_address:
+        return False, location
+    ip_location = get_location_from_ip(ip_address)
+    if ip_location and check_location_allowed(ip_location.get('city', '').lower(), raffle):
+        return True, ip_location
+    return False, location or ip_location
+
 
-# Функция для генерации уникального 4-значного номера
-def generate_unique_ticket_number():
-    """Генерация последовательного номера участника (1, 2, 3, ...)"""
-    participants = load_participants()
+class LocationVerifier:
+    """Отложенная проверка местоположения участников в фоновых потоках (DEFERRED_VERIFICATION).
     
-    # Если список участников пуст, начинаем с 1
-    if not participants:
-        return 1
+    /register сохраняет участника со статусом 'pending' и сразу отвечает. Фоновый поток собирает
+    участников в пачку (до max_batch штук или max_latency секунд с момента первого), города
+    определяются параллельно в пуле потоков так же, как при обычной регистрации, и результаты
+    каждого розыгрыша записываются одним update_many ('confirmed' или 'rejected'), а не
+    отдельной перезаписью хранилища на каждого участника.
     
-    # Находим максимальный существующий номер
-    max_number = 0
-    for participant in participants:
-        ticket_number = participant.get('ticket_number', 0)
-        if isinstance(ticket_number, (int, float)) and ticket_number > max_number:
-            max_number = ticket_number
+    Очередь своя в каждом процессе gunicorn. Участников, оставшихся в 'pending' дольше
+    retry_after секунд (например, после перезапуска), подбирает обход; его выполняет только
+    процесс, захвативший блокировку проверки розыгрыша, поэтому остальные не повторяют
+    те же запросы к сервисам и ту же запись.
+    """
     
-    # Получаем следующий номер (просто увеличиваем максимальный на 1)
-    next_number = max_number + 1
+    def __init__(self, workers, retry_after, max_latency, max_batch):
+        self.workers = workers
+        self.retry_after = retry_after
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.executor = None
+        self.queue = None
+        self.pid = None
+        # (розыгрыш, номер участника), проверка которых уже стоит в очереди этого процесса
+        self.in_flight = set()
     
-    return next_number
+    def ensure_started(self):
+        # Потоки не переживают fork, поэтому пул, очередь и обход запускаются в каждом процессе заново
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                  thread_name_prefix='location-check')
+            self.queue = queue.Queue()
+            self.in_flight = set()
+            self.pid = os.getpid()
+            threading.Thread(target=self._batch_loop, daemon=True).start()
+            threading.Thread(target=self._sweep_loop, daemon=True).start()
+    
+    def submit(self, raffle, participant):
+        """Постановка участника в очередь проверки. Возвращает False, если он уже в очереди"""
+        self.ensure_started()
+        key = (raffle.id, participant.get('ticket_number'))
+        with self.lock:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+        self.queue.put((raffle, participant))
+        return True
+    
+    def _collect_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _batch_loop(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                self.verify_batch(batch)
+            except Exception as e:
+                # Участники остаются в статусе 'pending' и будут проверены при обходе
+                logger.error(f"Ошибка при записи результатов проверки местоположения: {e}")
+            finally:
+                with self.lock:
+                    for raffle, participant in batch:
+                        self.in_flight.discard((raffle.id, participant.get('ticket_number')))
+    
+    def _check(self, item):
+        """Изменения участника по результату проверки (None, если проверка не удалась)"""
+        raffle, participant = item
+        try:
+            coordinates = participant.get('coordinates') or {}
+            is_allowed, location = check_registration_location(
+                coordinates.get('latitude'), coordinates.get('longitude'), participant.get('ip_address'), raffle)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке местоположения участника {participant.get('ticket_number')}: {e}")
+            return None
+        changes = {'verification': 'confirmed' if is_allowed else 'rejected', 'location': location}
+        if coordinates:
+            changes['coordinates'] = dict(coordinates, city=location.get('city', '') if location else None)
+        return changes
+    
+    def verify_batch(self, batch):
+        """Проверка пачки [(розыгрыш, участник)]: города определяются параллельно, а результаты
+        каждого розыгрыша записываются одним update_many. Возвращает число изменённых участников"""
+        updates = collections.OrderedDict()
+        for (raffle, participant), changes in zip(batch, self.executor.map(self._check, batch)):
+            if changes is not None:
+                updates.setdefault(raffle, {})[participant.get('ticket_number')] = changes
+        updated = 0
+        for raffle, changes in updates.items():
+            done = raffle.storage.update_many(changes)
+            updated += len(done)
+            if len(done) < len(changes):
+                logger.warning(f"Удалены до завершения проверки местоположения: {sorted(set(changes) - set(done))}")
+        if updated:
+            logger.info(f"Проверено местоположение участников: {updated}")
+        return updated
+    
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.retry_after)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка при обходе участников, ожидающих проверки местоположения: {e}")
+    
+    def sweep(self):
+        """Проверка участников, ожидающих её дольше retry_after секунд. Каждый розыгрыш обходит
+        только один процесс - захвативший его блокировку проверки. Возвращает число изменённых"""
+        self.ensure_started()
+        cutoff = (datetime.now() - timedelta(seconds=self.retry_after)).strftime(_REGISTRATION_TIME_FORMAT)
+        updated = 0
+        for raffle in raffles.values():
+            if not raffle.verification_lock.acquire(blocking=False):
+                continue
+            try:
+                with self.lock:
+                    in_flight = set(self.in_flight)
+                # Время 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' сравнивается строкой
+                pending = [participant for participant in raffle.storage.pending_verification()
+                           if str(participant.get('registration_time', '')) <= cutoff
+                           and (raffle.id, participant.get('ticket_number')) not in in_flight]
+                for start in range(0, len(pending), self.max_batch):
+                    updated += self.verify_batch([(raffle, participant)
+                                                  for participant in pending[start:start + self.max_batch]])
+            finally:
+                raffle.verification_lock.release()
+        return updated
+
+
+location_verifier = LocationVerifier(DEFERRED_VERIFICATION_WORKERS, DEFERRED_VERIFICATION_RETRY,
+                                     DEFERRED_VERIFICATION_MAX_LATENCY_MS / 1000, DEFERRED_VERIFICATION_MAX_BATCH)
+
+@app.before_request
+def start_location_verifier():
+    """Фоновая проверка местоположения запускается в каждом процессе при первом запросе"""
+    if DEFERRED_VERIFICATION:
+        location_verifier.ensure_started()
 
 @app.route('/')
 def index():
@@ -674,12 +4598,48 @@ def check_phone():
     
     return jsonify({"exists": False})
 
-@app.route('/register', methods=['POST'])
-def register():
-    """Регистрация участника"""
-    # Проверка на AJAX-запрос
-    is_ajax_request = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+def _registration_success_response(result, is_ajax_request):
+    """Ответ на успешную регистрацию (в том числе на повтор запроса с тем же ключом)"""
+    # Сохраняем номер билета в сессии для возможности получения его позже
+    session[current_raffle().ticket_session_key()] = result['ticket_number']
+    
+    verification = result.get('verification') or 'confirmed'
+    message = 'Вы успешно зарегистрированы для участия в розыгрыше!'
+    if verification == 'pending':
+        message = 'Вы зарегистрированы! Номер участника станет действительным после проверки местоположения.'
+    
+    # Возвращаем разные ответы в зависимости от типа запроса
+    if is_ajax_request:
+        return jsonify({
+            'success': True, 
+            'message': message,
+            'participant_number': result['participant_number'],
+            'ticket_number': result['ticket_number'],  # Отправляем номер билета в ответе
+            'verification': verification
+        })
+    
+    # Перенаправление на страницу успеха с передачей номера билета в URL
+    flash(message, 'success')
+    return redirect(url_for('success', ticket=result['ticket_number']))
+
+def _phone_registered_response(existing, request_key, is_ajax_request):
+    """Ответ, когда телефон уже зарегистрирован. Возвращает (ответ, результат регистрации)"""
+    # Повтор нашего же запроса, который уже сохранён (например, другим процессом gunicorn)
+    if request_key and existing.get('request_key') == request_key:
+        result = {
+            'ticket_number': existing.get('ticket_number'),
+            'participant_number': count_participants(),
+            'verification': existing.get('verification')
+        }
+        return _registration_success_response(result, is_ajax_request), result
     
+    if is_ajax_request:
+        return (jsonify({'success': False, 'message': 'Этот номер телефона уже зарегистрирован в розыгрыше. Регистрация возможна только один раз.'}), 400), None
+    flash('Этот номер телефона уже зарегистрирован в розыгрыше. Регистрация возможна только один раз.', 'danger')
+    return redirect(url_for('index')), None
+
+def _process_registration(is_ajax_request, request_key):
+    """Регистрация участника. Возвращает (ответ, результат регистрации или None)"""
     # Получение данных из формы
     full_name = request.form.get('full_name')
     phone = request.form.get('phone')
@@ -689,16 +4649,14 @@ def register():
     # Валидация данных
     if not full_name or not phone or not age or not gender:
         if is_ajax_request:
-            return jsonify({'success': False, 'message': 'Пожалуйста, заполните все поля формы!'}), 400
+            return (jsonify({'success': False, 'message': 'Пожалуйста, заполните все поля формы!'}), 400), None
         flash('Пожалуйста, заполните все поля формы!', 'danger')
-        return redirect(url_for('index'))
+        return redirect(url_for('index')), None
     
     # Проверка, зарегистрирован ли уже данный номер телефона
-    if is_phone_registered(phone):
-        if is_ajax_request:
-            return jsonify({'success': False, 'message': 'Этот номер телефона уже зарегистрирован в розыгрыше. Регистрация возможна только один раз.'}), 400
-        flash('Этот номер телефона уже зарегистрирован в розыгрыше. Регистрация возможна только один раз.', 'danger')
-        return redirect(url_for('index'))
+    existing = find_participant_by_phone(phone)
+    if existing is not None:
+        return _phone_registered_response(existing, request_key, is_ajax_request)
     
     # Получение координат
     latitude = request.form.get('latitude')
@@ -706,37 +4664,23 @@ def register():
     
     # Проверка местоположения по координатам, если они предоставлены
     location = None
-    is_allowed = False
+    verification = None
     
     # Если установлена переменная окружения, то разрешаем всем
     if os.environ.get('ALLOW_ALL_LOCATIONS') == 'true':
         is_allowed = True
+    elif DEFERRED_VERIFICATION:
+        # Номер выделяется сразу, а местоположение проверяется в фоне после сохранения
+        is_allowed = True
+        verification = 'pending'
     else:
-        if latitude and longitude:
-            location = get_location_from_coordinates(latitude, longitude)
-            if location and check_location_allowed(location.get('city', '').lower()):
-                is_allowed = True
-        
-        # Если координаты не предоставлены или не удалось определить местоположение,
-        # пробуем определить по IP
-        if not is_allowed:
-            ip_address = request.remote_addr
-            if ip_address == '127.0.0.1':  # Для локальной разработки
-                is_allowed = True
-            else:
-                ip_location = get_location_from_ip(ip_address)
-                if ip_location and check_location_allowed(ip_location.get('city', '').lower()):
-                    is_allowed = True
-                    location = ip_location
+        is_allowed, location = check_registration_location(latitude, longitude, request.remote_addr)
     
     # Если пользователь не из разрешенного города
     if not is_allowed:
         if is_ajax_request:
-            return jsonify({'success': False, 'message': 'К сожалению, вы не можете участвовать в розыгрыше. Розыгрыш доступен только для жителей Махачкалы и Каспийска.'}), 400
-        return redirect(url_for('index'))
-    
-    # Генерация уникального номера участника
-    ticket_number = generate_unique_ticket_number()
+            return (jsonify({'success': False, 'message': 'К сожалению, вы не можете участвовать в розыгрыше. Розыгрыш доступен только для жителей Махачкалы и Каспийска.'}), 400), None
+        return redirect(url_for('index')), None
     
     # Создание записи об участнике
     participant = {
@@ -751,32 +4695,70 @@ def register():
             'longitude': longitude,
             'city': location.get('city', '') if location else None
         } if latitude and longitude else None,
-        'registration_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'ticket_number': ticket_number  # Используем уникальный 4-значный номер
+        'registration_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
+    if request_key:
+        # Ключ сохраняется вместе с участником, чтобы распознать повтор в любом процессе
+        participant['request_key'] = request_key
+    if verification:
+        participant['verification'] = verification
     
-    # Сохранение данных участника
-    save_participant(participant)
+    # Сохранение данных участника (номер участника выделяется при сохранении).
+    # Телефон проверяется ещё раз под блокировкой хранилища: одновременный запрос
+    # с тем же номером мог сохраниться после проверки выше
+    try:
+        save_participant(participant)
+    except PhoneAlreadyRegistered as e:
+        return _phone_registered_response(e.participant, request_key, is_ajax_request)
+    except RegistrationStateUnknown as e:
+        # Регистрация может сохраниться позже: не сообщаем об ошибке, а просим проверить номер по телефону.
+        # Повтор с тем же ключом найдёт сохранённого участника по телефону и ключу запроса
+        logger.warning(f"{e} (телефон {phone})")
+        message = ('Регистрация ещё сохраняется. Через минуту отправьте форму ещё раз '
+                   'или проверьте свой номер участника по телефону.')
+        if is_ajax_request:
+            return (jsonify({'success': False, 'state_unknown': True, 'message': message}), 503), None
+        flash(message, 'warning')
+        return redirect(url_for('index')), None
+    if verification:
+        location_verifier.submit(current_raffle(), participant)
     
     # Получаем общее количество участников для определения номера
-    participants = load_participants()
-    participant_number = len(participants)
+    result = {
+        'ticket_number': participant['ticket_number'],
+        'participant_number': count_participants(),
+        'verification': verification
+    }
+    return _registration_success_response(result, is_ajax_request), result
+
+@app.route('/register', methods=['POST'])
+def register():
+    """Регистрация участника"""
+    # Проверка на AJAX-запрос
+    is_ajax_request = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
     
-    # Сохраняем номер билета в сессии для возможности получения его позже
-    session['ticket_number'] = participant['ticket_number']
+    # Ключ идемпотентности: клиент повторяет запрос с тем же ключом при сбое сети
+    request_key = (request.headers.get('Idempotency-Key') or request.form.get('request_key') or '').strip()[:100]
+    if not request_key:
+        return _process_registration(is_ajax_request, None)[0]
     
-    # Возвращаем разные ответы в зависимости от типа запроса
-    if is_ajax_request:
-        return jsonify({
-            'success': True, 
-            'message': 'Вы успешно зарегистрированы для участия в розыгрыше!',
-            'participant_number': participant_number,
-            'ticket_number': participant['ticket_number']  # Отправляем номер билета в ответе
-        })
+    registration_requests = current_raffle().registration_requests
+    entry, is_first = registration_requests.begin(request_key)
+    if not is_first:
+        # Повтор: ждём первый запрос и отдаём его результат, не обращаясь к хранилищу и геолокации
+        result = registration_requests.wait(entry)
+        if result is not None:
+            logger.info(f"Повтор регистрации с ключом {request_key}: номер участника {result['ticket_number']}")
+            return _registration_success_response(result, is_ajax_request)
+        # Первый запрос завершился неуспешно - выполняем регистрацию заново
+        return _process_registration(is_ajax_request, request_key)[0]
     
-    # Перенаправление на страницу успеха с передачей номера билета в URL
-    flash('Вы успешно зарегистрированы для участия в розыгрыше!', 'success')
-    return redirect(url_for('success', ticket=participant['ticket_number']))
+    result = None
+    try:
+        response, result = _process_registration(is_ajax_request, request_key)
+        return response
+    finally:
+        registration_requests.finish(request_key, entry, result)
 
 @app.route('/success')
 def success():
@@ -786,7 +4768,7 @@ def success():
 @app.route('/get-ticket-number')
 def get_ticket_number():
     """Получение номера участника из сессии"""
-    ticket_number = session.get('ticket_number')
+    ticket_number = session.get(current_raffle().ticket_session_key())
     if ticket_number:
         return jsonify({'success': True, 'ticket_number': ticket_number})
     else:
@@ -827,9 +4809,19 @@ def admin():
         end_idx = min(start_idx + per_page, total_participants)
         current_participants = all_participants[start_idx:end_idx]
         
+        try:
+            geo_cache_stats = geo_cache.stats()
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось получить статистику кэша геолокации: {e}")
+            geo_cache_stats = None
+        
         return render_template('admin.html', 
                               participants=current_participants, 
                               settings=settings,
+                              geo_cache_stats=geo_cache_stats,
+                              geo_provider_stats=geo_provider_stats.snapshot(),
+                              geo_clients_stats={name: client.stats() for name, client in geo_clients.items()},
+                              verification_labels=VERIFICATION_LABELS,
                               pagination={
                                   'page': page,
                                   'per_page': per_page,
@@ -846,49 +4838,80 @@ def delete_participants():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
     
     try:
-        # Очистка файла participants.json
-        with data_lock:
-            with open(DATA_FILE, 'w') as f:
-                json.dump([], f)
-            
-            # Обновляем кэш
-            participants_cache['data'] = []
-            participants_cache['timestamp'] = datetime.now().timestamp()
-            
+        # Очистка списка участников
+        remove_all_participants()
+        
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/delete-participant/<int:index>', methods=['POST'])
-def delete_participant(index):
+@app.route('/delete-participant/<int:ticket_number>', methods=['POST'])
+def delete_participant(ticket_number):
     # Проверка, что пользователь является администратором
     if not session.get('admin'):
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
     
     try:
-        # Загрузка списка участников
-        with data_lock:
-            participants = load_participants()
-            
-            # Проверка валидности индекса
-            if index < 0 or index >= len(participants):
-                return jsonify({'success': False, 'message': 'Участник не найден'}), 404
-            
-            # Удаление участника
-            del participants[index]
-            
-            # Сохранение обновленного списка
-            with open(DATA_FILE, 'w', encoding='utf-8') as f:
-                json.dump(participants, f, ensure_ascii=False, indent=4)
-            
-            # Обновляем кэш
-            participants_cache['data'] = participants
-            participants_cache['timestamp'] = datetime.now().timestamp()
-                
+        # Удаление участника по номеру: номер не меняется, даже если список изменился после загрузки страницы
+        if not remove_participants([ticket_number]):
+            return jsonify({'success': False, 'message': 'Участник не найден'}), 404
+        
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/delete-participants/batch', methods=['POST'])
+def delete_participants_batch():
+    """Удаление нескольких участников по номерам одним запросом"""
+    # Проверка, что пользователь является администратором
+    if not session.get('admin'):
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    ticket_numbers = data.get('ticket_numbers')
+    if (not isinstance(ticket_numbers, list) or not ticket_numbers
+            or not all(isinstance(number, int) and not isinstance(number, bool) for number in ticket_numbers)):
+        return jsonify({'success': False, 'message': 'Передайте список номеров участников в поле ticket_numbers'}), 400
+    
+    try:
+        deleted = remove_participants(ticket_numbers)
+        return jsonify({'success': True, 'deleted': deleted})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/verify-participants', methods=['POST'])
+def verify_participants_route():
+    """Проверка целостности участников из административной панели"""
+    # Проверка, что пользователь является администратором
+    if not session.get('admin'):
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+    
+    try:
+        report = verify_participants()
+        return jsonify({'success': True, 'problems': _verification_problems(report), 'report': report})
+    except Exception as e:
+        logger.error(f"Ошибка при проверке участников: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/geo-cache-stats')
+def geo_cache_stats():
+    """Статистика кэша геолокации (по всем процессам) и сервисов геолокации (в этом процессе)"""
+    # Проверка, что пользователь является администратором
+    if not session.get('admin'):
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+    
+    try:
+        return jsonify({
+            'success': True,
+            'stats': geo_cache.stats(),
+            'providers': geo_provider_stats.snapshot(),
+            'coalesced': geo_flights.coalesced,
+            'clients': {name: client.stats() for name, client in geo_clients.items()}
+        })
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики кэша геолокации: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @app.route('/export-to-excel', methods=['GET'])
 def export_to_excel():
     """Генерация Excel-файла с данными участников"""
@@ -930,11 +4953,12 @@ def export_to_excel():
         worksheet.set_column('I:I', 25)  # Время регистрации
         worksheet.set_column('J:J', 30)  # Координаты
         worksheet.set_column('K:K', 20)  # IP-адрес
+        worksheet.set_column('L:L', 25)  # Проверка местоположения
         
         # Заголовки столбцов
         headers = [
             'Имя', 'Номер участника', 'Телефон', 'Возраст', 'Пол', 'Город', 'Регион', 'Страна', 
-            'Время регистрации', 'Координаты', 'IP-адрес'
+            'Время регистрации', 'Координаты', 'IP-адрес', 'Проверка местоположения'
         ]
         
         for col, header in enumerate(headers):
@@ -985,6 +5009,9 @@ def export_to_excel():
             # Время регистрации
             reg_time = str(participant.get('registration_time', ''))
             
+            # Статус проверки местоположения
+            verification = VERIFICATION_LABELS.get(participant.get('verification', 'confirmed'), '')
+            
             # Капитализация строк
             if city:
                 city = city.capitalize()
@@ -1005,7 +5032,8 @@ def export_to_excel():
                 country,
                 reg_time,
                 coords,
-                ip_address
+                ip_address,
+                verification
             ]
             
             # Запись данных в Excel
@@ -1206,16 +5234,27 @@ def send_backup_to_yadisk(json_data, token):
     """Загрузка резервной копии данных на Яндекс.Диск"""
     try:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Копии дополнительных розыгрышей отличаются по имени файла
+        raffle = current_raffle()
+        if not raffle.is_default:
+            timestamp = f"{raffle.id}_{timestamp}"
         logger.info(f"[{datetime.now()}] Начинаем создание резервной копии и загрузку на Яндекс.Диск")
         
         # Создаем Excel-файл
         excel_data = create_excel_backup(json_data)
         logger.info(f"[{datetime.now()}] Excel файл создан в памяти")
         
-        # Создаем JSON-файл
-        json_str = json.dumps(json_data, ensure_ascii=False, indent=4)
-        json_bytes = json_str.encode('utf-8')
-        logger.info(f"[{datetime.now()}] JSON файл создан в памяти")
+        # Создаем файл с данными: в формате packed он в разы меньше JSON с отступами
+        if DATA_FORMAT == 'packed':
+            packed_buffer = io.BytesIO()
+            _write_packed(packed_buffer, json_data, DATA_COMPRESSION)
+            json_bytes = packed_buffer.getvalue()
+            data_extension = 'pack'
+        else:
+            json_str = json.dumps(json_data, ensure_ascii=False, indent=4, default=_participant_json_default)
+            json_bytes = json_str.encode('utf-8')
+            data_extension = 'json'
+        logger.info(f"[{datetime.now()}] Файл с данными ({data_extension}) создан в памяти: {len(json_bytes)} байт")
         
         # Путь на Яндекс.Диске, где будут храниться резервные копии
         folder_path = "/kvdarit_avto35_backup"
@@ -1260,7 +5299,7 @@ def send_backup_to_yadisk(json_data, token):
             return False
         
         # Загружаем JSON-файл
-        json_filename = f"participants_{timestamp}.json"
+        json_filename = f"participants_{timestamp}.{data_extension}"
         json_params = {
             "path": f"{folder_path}/{json_filename}",
             "overwrite": "true"
@@ -1308,7 +5347,8 @@ def create_excel_backup(json_data):
     })
     
     # Заголовки
-    headers = ['№', 'Номер участника', 'ФИО', 'Телефон', 'Возраст', 'Пол', 'Город', 'Дата регистрации', 'IP-адрес']
+    headers = ['№', 'Номер участника', 'ФИО', 'Телефон', 'Возраст', 'Пол', 'Город', 'Дата регистрации', 'IP-адрес',
+               'Проверка местоположения']
     for col, header in enumerate(headers):
         worksheet.write(0, col, header, header_format)
     
@@ -1332,9 +5372,10 @@ def create_excel_backup(json_data):
         
         worksheet.write(row, 7, participant.get('registration_time', ''), cell_format)
         worksheet.write(row, 8, participant.get('ip_address', ''), cell_format)
+        worksheet.write(row, 9, VERIFICATION_LABELS.get(participant.get('verification', 'confirmed'), ''), cell_format)
     
     # Автонастройка ширины столбцов
-    for i, width in enumerate([5, 15, 25, 15, 8, 10, 15, 20, 15]):
+    for i, width in enumerate([5, 15, 25, 15, 8, 10, 15, 20, 15, 25]):
         worksheet.set_column(i, i, width)
         
     workbook.close()
@@ -1381,16 +5422,17 @@ def create_backup():
         logger.error(traceback.format_exc())
         return False
 
-# Инициализация настроек резервного копирования при запуске
+# Инициализация настроек резервного копирования при запуске (во всех розыгрышах)
 def init_backup_settings():
-    settings = load_settings()
-    if 'backup_settings' not in settings:
-        settings['backup_settings'] = copy.deepcopy(BACKUP_SETTINGS)
-        save_settings(settings)
-    elif 'yandex_token' not in settings['backup_settings'] or not settings['backup_settings']['yandex_token']:
-        # Если токен отсутствует или пустой, добавляем его из настроек по умолчанию
-        settings['backup_settings']['yandex_token'] = BACKUP_SETTINGS['yandex_token']
-        save_settings(settings)
+    for raffle in raffles.values():
+        settings = raffle.load_settings()
+        if 'backup_settings' not in settings:
+            settings['backup_settings'] = copy.deepcopy(BACKUP_SETTINGS)
+            raffle.save_settings(settings)
+        elif 'yandex_token' not in settings['backup_settings'] or not settings['backup_settings']['yandex_token']:
+            # Если токен отсутствует или пустой, добавляем его из настроек по умолчанию
+            settings['backup_settings']['yandex_token'] = BACKUP_SETTINGS['yandex_token']
+            raffle.save_settings(settings)
 
 # Планировщик резервного копирования
 def run_scheduler():
@@ -1576,17 +5618,6 @@ def init_app(flask_app):
 # Предотвращаем автоматический запуск при импорте
 # init_app(app)
 
-# Убедимся, что планировщик запускается только при непосредственном запуске приложения
-if __name__ == '__main__':
-    # Инициализация настроек резервного копирования
-    init_backup_settings()
-    # Запуск планировщика резервного копирования
-    start_backup_scheduler()
-    
-    # Для продакшена используйте WSGI-сервер (gunicorn или uwsgi)
-    # gunicorn -w 4 -b 0.0.0.0:5000 app:app
-    app.run(debug=False, host='0.0.0.0') 
-
 @app.route('/find-ticket', methods=['POST'])
 def find_ticket():
     """Поиск номера участника по номеру телефона"""
@@ -1602,10 +5633,7 @@ def find_ticket():
     if len(normalized_phone) < 11:
         return jsonify({'success': False, 'message': 'Пожалуйста, введите полный номер телефона.'})
     
-    # Если номер начинается с 8, заменяем на 7 для стандартизации
-    if normalized_phone.startswith('8') and len(normalized_phone) == 11:
-        normalized_phone = '7' + normalized_phone[1:]
-    
+    # Формат записи (+7/8 в начале) учитывается каноническим ключом телефона
     ticket_data = get_ticket_by_phone(normalized_phone)
     
     if ticket_data:
@@ -1613,10 +5641,35 @@ def find_ticket():
             'success': True, 
             'message': 'Номер участника найден!',
             'ticket_number': ticket_data['ticket_number'],
-            'full_name': ticket_data['full_name']
+            'full_name': ticket_data['full_name'],
+            'verification': ticket_data['verification']
         })
     else:
         return jsonify({
             'success': False, 
             'message': 'Этот номер телефона не зарегистрирован в розыгрыше.'
         }) 
+
+def add_raffle_routes(flask_app):
+    """Каждый маршрут (кроме статических файлов) доступен и с префиксом /r/<raffle_id>"""
+    for rule in list(flask_app.url_map.iter_rules()):
+        if rule.endpoint == 'static' or 'raffle_id' in rule.arguments:
+            continue
+        flask_app.add_url_rule(
+            RAFFLE_URL_PREFIX + rule.rule,
+            endpoint=rule.endpoint,
+            methods=sorted(rule.methods - {'HEAD', 'OPTIONS'})
+        )
+
+add_raffle_routes(app)
+
+# Убедимся, что планировщик запускается только при непосредственном запуске приложения
+if __name__ == '__main__':
+    # Инициализация настроек резервного копирования
+    init_backup_settings()
+    # Запуск планировщика резервного копирования
+    start_backup_scheduler()
+    
+    # Для продакшена используйте WSGI-сервер (gunicorn или uwsgi)
+    # gunicorn -w 4 -b 0.0.0.0:5000 app:app
+    app.run(debug=False, host='0.0.0.0')
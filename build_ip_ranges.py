@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Скрипт для построения локальной базы IP-диапазонов из CSV.
+Использование:
+    python build_ip_ranges.py ranges.csv
+    python build_ip_ranges.py ranges.csv ip_ranges.bin --lookup 176.15.10.20
+Строка CSV: начало,конец,город,регион,страна (IPv4 или IPv6) или сеть/префикс,,город,регион,страна.
+Результат записывается в двоичный файл (по умолчанию IP_RANGES_FILE), который приложение
+перечитывает после замены без перезапуска.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from app import IP_RANGES_FILE, IpRangeTable
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Построение локальной базы IP-диапазонов')
+    parser.add_argument('source', help='CSV-файл с диапазонами')
+    parser.add_argument('destination', nargs='?', default=IP_RANGES_FILE,
+                        help='двоичный файл базы (по умолчанию IP_RANGES_FILE)')
+    parser.add_argument('--lookup', action='append', default=[], metavar='IP',
+                        help='проверить адрес по построенной базе (можно указать несколько раз)')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    try:
+        with open(args.source, encoding='utf-8-sig', newline='') as f:
+            table = IpRangeTable.from_csv(f)
+    except ValueError as e:
+        print(f"Ошибка в {args.source}: {e}")
+        sys.exit(1)
+    table.write(args.destination)
+    print(f"Записано диапазонов: {len(table)} (мест: {len(table.locations)}), "
+          f"{os.path.getsize(args.destination)} байт за {time.monotonic() - started:.2f} сек.")
+
+    # Проверяем именно записанный файл
+    table = IpRangeTable.read(args.destination)
+    for ip_address in args.lookup:
+        print(f"{ip_address}: {table.lookup(ip_address) or 'не найден'}")
+
+
+if __name__ == "__main__":
+    main()
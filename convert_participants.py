@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Скрипт для перевода файла участников между форматами json и packed.
+Использование:
+    python convert_participants.py participants.json participants.pack --format packed --compression lzma
+    python convert_participants.py participants.pack participants.json --format json
+    python convert_participants.py participants.json participants.json --format json --add-checksums
+Формат исходного файла определяется автоматически. Файлы читаются и записываются под той же
+блокировкой, что и у хранилища участников, поэтому запускать скрипт можно и при работающем приложении.
+Участники, помеченные удалёнными, в результат не попадают. Если у исходного файла есть холодные
+сегменты (COLD_AFTER_DAYS), в нём лежит только часть участников, поэтому записать его можно только
+на место исходного.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from app import (PACKED_COMPRESSIONS, ColdSegments, InterProcessLock, SharedCounter, _read_journal_entries,
+                 _read_participants_file, _write_participants_file, participant_checksum)
+
+
+def storage_locks(*paths):
+    """Блокировки хранилищ, которым принадлежат файлы (по одной на базовое имя, в постоянном порядке)"""
+    bases = sorted({os.path.splitext(os.path.abspath(path))[0] for path in paths})
+    return [(base, InterProcessLock(base + '.lock')) for base in bases]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перевод файла участников между форматами json и packed')
+    parser.add_argument('source', help='исходный файл участников')
+    parser.add_argument('destination', help='файл, в который записать результат')
+    parser.add_argument('--format', choices=['json', 'packed'], default='packed',
+                        help='формат результата (по умолчанию packed)')
+    parser.add_argument('--compression', choices=sorted(PACKED_COMPRESSIONS), default='gzip',
+                        help='сжатие сегментов для формата packed (по умолчанию gzip)')
+    parser.add_argument('--add-checksums', action='store_true',
+                        help='добавить контрольные суммы записям, сохранённым до их появления')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    locks = storage_locks(args.source, args.destination)
+    for _, lock in locks:
+        lock.acquire()
+    try:
+        # Под блокировкой хранилища регистрация не может записать файл между чтением и записью
+        source_base = os.path.splitext(os.path.abspath(args.source))[0]
+        destination_base = os.path.splitext(os.path.abspath(args.destination))[0]
+        if source_base != destination_base and ColdSegments.load(source_base + '.cold'):
+            print(f"У {args.source} есть холодные сегменты ({source_base}.cold): файл содержит не всех участников. "
+                  f"Для перехода на другое хранилище смените STORAGE_BACKEND - участники будут импортированы полностью")
+            sys.exit(1)
+        participants = _read_participants_file(args.source)
+        tombstones = set(_read_journal_entries(source_base + '.tombstones')[0])
+        if tombstones and source_base != destination_base:
+            # Метки удаления остаются рядом с исходным файлом, поэтому удалённые участники отбрасываются сразу
+            participants = [participant for participant in participants
+                            if participant.get('ticket_number') not in tombstones]
+        if args.add_checksums:
+            added = 0
+            for participant in participants:
+                if 'checksum' not in participant:
+                    participant['checksum'] = participant_checksum(participant)
+                    added += 1
+            print(f"Добавлено контрольных сумм: {added}")
+        _write_participants_file(args.destination, participants, args.format, args.compression)
+        # Процессы приложения, работающие с этим файлом, перечитают его при следующем обращении
+        version_file = os.path.splitext(os.path.abspath(args.destination))[0] + '.version'
+        if os.path.exists(version_file):
+            version_counter = SharedCounter(version_file)
+            version_counter.set(version_counter.get() + 1)
+    finally:
+        for _, lock in reversed(locks):
+            lock.release()
+    print(f"Записано участников: {len(participants)} ({args.format}), "
+          f"{os.path.getsize(args.source)} -> {os.path.getsize(args.destination)} байт "
+          f"за {time.monotonic() - started:.2f} сек.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Скрипт для проверки целостности хранилища участников.
+Использование:
+    python verify_participants.py
+    python verify_participants.py --workers 4 --json
+    python verify_participants.py --raffle spring
+Хранилище и файлы берутся из тех же переменных окружения, что и у приложения
+(STORAGE_BACKEND, DATA_FILE и т.д.). Проверяются контрольные суммы записей, повторы
+телефонов и номеров участников; индексы поиска перестраиваются. По умолчанию
+проверяется основной розыгрыш, --raffle выбирает один из RAFFLE_IDS. Код возврата 1,
+если найдены проблемы.
+"""
+
+import argparse
+import json
+import sys
+
+from app import VERIFY_WORKERS, _verification_problems, raffles, verify_participants
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка целостности хранилища участников')
+    parser.add_argument('--workers', type=int, default=VERIFY_WORKERS,
+                        help='число процессов проверки (0 - по числу ядер, по умолчанию VERIFY_WORKERS)')
+    parser.add_argument('--json', action='store_true', help='вывести полный отчёт в формате JSON')
+    parser.add_argument('--raffle', help='идентификатор розыгрыша из RAFFLE_IDS (по умолчанию основной)')
+    args = parser.parse_args()
+
+    if args.raffle not in raffles:
+        parser.error(f"неизвестный розыгрыш: {args.raffle} (допустимые: {', '.join(filter(None, raffles))})")
+
+    report = verify_participants(args.workers, raffles[args.raffle])
+    problems = _verification_problems(report)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=4))
+    else:
+        print(f"Записей: {report['records']}, с верной контрольной суммой: {report['verified']}, "
+              f"без контрольной суммы: {report['without_checksum']} "
+              f"({report['workers']} процессов, {report['elapsed']:.2f} сек.)")
+        if report['error']:
+            print(f"Файл прочитан не полностью: {report['error']}")
+        for item in report['corrupt']:
+            print(f"Повреждена запись {item['position'] + 1} (номер {item['ticket_number']}): {item['error']}")
+        for item in report['duplicate_phones']:
+            print(f"Телефон {item['phone_key']} у нескольких участников: {item['ticket_numbers']}")
+        for item in report['duplicate_tickets']:
+            print(f"Номер {item['ticket_number']} встречается {item['count']} раз")
+        print("Индексы перестроены" if report['index_rebuilt']
+              else "Индексы не перестроены: данные изменились во время проверки")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()